@@ -0,0 +1,61 @@
+import argparse
+import sqlite3
+import sys
+
+from migrations import migrate
+
+
+# Trigger-maintained tables and the views they are derived from. Both sides
+# list the same columns in the same order.
+DERIVED_TABLES = {
+    'TreatmentExpiry': ('TreatmentExpirySource', 'appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom'),
+    'TreatmentSeasonCount': ('TreatmentSeasonCountSource', 'season, plantId, treatmentTypeId, applications, lastDate'),
+}
+
+
+def rebuild(conn, table):
+    source, columns = DERIVED_TABLES[table]
+    with conn:
+        conn.execute('DELETE FROM %s' % table)
+        conn.execute('INSERT INTO %s(%s) SELECT %s FROM %s' % (table, columns, columns, source))
+    return conn.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+
+def differences(conn, table):
+    # rows missing from the table, followed by rows the table should not have
+    source, columns = DERIVED_TABLES[table]
+    missing = conn.execute('SELECT %s FROM %s EXCEPT SELECT %s FROM %s' % (columns, source, columns, table)).fetchall()
+    extra = conn.execute('SELECT %s FROM %s EXCEPT SELECT %s FROM %s' % (columns, table, columns, source)).fetchall()
+    return missing, extra
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check or rebuild the trigger-maintained aggregate tables.')
+    parser.add_argument('command', choices=('check', 'rebuild'))
+    parser.add_argument('tables', nargs='*', help='one or more of %s (default: all)' % ', '.join(sorted(DERIVED_TABLES)))
+    parser.add_argument('--database', default='test.db')
+    args = parser.parse_args(argv)
+    for table in args.tables:
+        if table not in DERIVED_TABLES:
+            parser.error('unknown table %s' % table)
+
+    conn = sqlite3.connect(args.database)
+    migrate(conn)
+    inconsistent = 0
+    try:
+        for table in args.tables or sorted(DERIVED_TABLES):
+            if args.command == 'rebuild':
+                print(table, ':', rebuild(conn, table), 'rows')
+                continue
+            missing, extra = differences(conn, table)
+            for row in missing:
+                print(table, ': missing', tuple(row))
+            for row in extra:
+                print(table, ': unexpected', tuple(row))
+            print(table, ':', 'OK' if not (missing or extra) else '%d missing, %d unexpected rows' % (len(missing), len(extra)))
+            inconsistent += len(missing) + len(extra)
+    finally:
+        conn.close()
+    return 1 if inconsistent else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,199 +1,935 @@
-import sqlite3
-from flask import Flask, render_template
+import base64
+import collections
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from flask import (Flask, abort, before_render_template, current_app, g, has_request_context, jsonify, render_template, request,
+                   stream_with_context, template_rendered, url_for)
+from jinja2 import ChoiceLoader, ModuleLoader
+from werkzeug.routing import BaseConverter, ValidationError
 from markupsafe import escape
-from datetime import date
-
-def treatment_date_limits_in_effect(conn, as_of_date):
-    QUERY = '''
-    SELECT p.description as plant, tt.description as treatment, date(t.date) as treatmentDate, date(t.date + l.daysBetweenApplications) as safeToRepeatDate
-      FROM AppliedTreatment t
-      LEFT JOIN Plant p
-      ON t.plantId = p.id
-      INNER JOIN SafetyLimit l
-      ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-      LEFT JOIN TreatmentType tt
-      ON t.treatmentTypeId = tt.id
-      WHERE t.date <= julianday(?) AND t.date + l.daysBetweenApplications >= julianday(?)
-    '''
-    return conn.execute(QUERY, (as_of_date, as_of_date))
-
-def safe_to_consume_dates(conn, as_of_date):
-    QUERY='''
-    SELECT plant, treatment, treatmentDate, max(safeToConsumeDate) as safeToConsumeDate
-      FROM
-      (SELECT p.description as plant, tt.description as treatment, date(t.date) as treatmentDate, date(t.date + l.minDaysBeforeConsumption) as safeToConsumeDate
-      FROM AppliedTreatment t
-      LEFT JOIN Plant p
-      ON t.plantId = p.id
-      INNER JOIN SafetyLimit l
-      ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-      LEFT JOIN TreatmentType tt
-      ON t.treatmentTypeId = tt.id
-      WHERE t.date <= julianday(?) AND t.date + l.minDaysBeforeConsumption >= julianday(?)
-      )
-      GROUP BY plant
-    '''
-    return conn.execute(QUERY, (as_of_date, as_of_date))
-
-def treatments_no_longer_applicable(conn, as_of_date):
-    QUERY='''
-    SELECT plantDescription, treatmentDescription, treatments, maxApplications
-    FROM
-    (SELECT plantId, plantDescription, treatmentTypeId, treatmentDescription, COUNT(treatmentDate) as treatments, maxApplications
-    FROM
-    (SELECT p.id as plantId, p.description as plantDescription, t.treatmentTypeId as treatmentTypeId, tt.description as treatmentDescription, t.date as treatmentDate, l.maxApplications as maxApplications
-    FROM AppliedTreatment t
-    LEFT JOIN Plant p
-    ON t.plantId = p.id
-    INNER JOIN SafetyLimit l
-    ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-    LEFT JOIN TreatmentType tt
-    ON t.treatmentTypeId = tt.id
-    WHERE t.date <= julianday(?) and t.date >= julianday(?)
-    )
-    GROUP BY plantId, treatmentTypeId
-    )
-    WHERE treatments >= maxApplications
-    '''
-    
-    start_of_year = as_of_date[0:4] + '-01-01'
-    return conn.execute(QUERY, (as_of_date, start_of_year))
-
-def treatments_applied_without_limit_info(conn, as_of_date):
-    QUERY='''
-    SELECT tt.description as treatment, date(t.date) as date, p.description as plant
-    FROM AppliedTreatment t
-    LEFT JOIN Plant p
-    ON t.plantId = p.id
-    LEFT JOIN SafetyLimit l
-    ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-    LEFT JOIN TreatmentType tt
-    ON t.treatmentTypeId = tt.id
-    WHERE l.id IS NULL AND t.date >= julianday(?)
-    '''
-
-    start_of_year = as_of_date[0:4] + '-01-01'
-    return conn.execute(QUERY, (start_of_year,))
-
-def all_limit_info_for_treatment(conn, treatment_id):
-    QUERY='''
-    SELECT t.description as treatment,
-       p.name as species,
-       l.maxApplications as maxApplications,
-       l.daysBetweenApplications as daysBetweenApplications,
-       l.applyBefore as applyBefore,
-       l.minDaysBeforeConsumption as minDaysBeforeConsumption
-    FROM TreatmentType t
-    LEFT JOIN SafetyLimit l
-    ON t.id = l.treatmentTypeId
-    LEFT JOIN PlantSpecies p
-    ON l.speciesId = p.id
-    WHERE t.id = ?
-    '''
-    return conn.execute(QUERY, (treatment_id,))
-
-def list_of_treatments(conn):
-    QUERY='''
-    SELECT id, description
-    FROM TreatmentType
-    '''
-    return conn.execute(QUERY)
-
-def treatment_description(conn, treatment_id):
-    QUERY='''
-    SELECT description
-    FROM TreatmentType
-    WHERE id = ?
-    '''
-    return conn.execute(QUERY, (treatment_id,))
-
-def all_treatments_for_plant(conn, as_of_date, plant_id):
-    QUERY='''SELECT p.id as plantId, p.description as plantDescription, t.treatmentTypeId as treatmentTypeId, tt.description as treatmentDescription, date(t.date) as treatmentDate
-    FROM AppliedTreatment t
-    LEFT JOIN Plant p
-    ON t.plantId = p.id
-    LEFT JOIN TreatmentType tt
-    ON t.treatmentTypeId = tt.id
-    WHERE t.date <= julianday(?) and t.date >= julianday(?) and p.id = ?
-    '''
-    start_of_year = as_of_date[0:4] + '-01-01'
-    return conn.execute(QUERY, (as_of_date, start_of_year, plant_id))
-    
-def list_of_plants(conn):
-    QUERY='''
-    SELECT id, description
-    FROM Plant
-    '''
-    return conn.execute(QUERY)
-
-def plant_description(conn, plant_id):
-    QUERY='''
-    SELECT description
-    FROM Plant
-    WHERE id = ?
-    '''
-    return conn.execute(QUERY, (plant_id,))
-
-
-app = Flask(__name__)
+from datetime import date, timedelta
+
+from cache import REPORT_TABLES, cache_from_config, data_versions
+from queries import (REPORT_KEYS, AsOfDate, Lookups, all_limit_info_for_treatment, all_treatments_for_plant, plant_calendar, plant_description,
+                     safe_to_consume_dates, search_plants, search_treatments, treatment_date_limits_in_effect, treatment_description,
+                     treatments_no_longer_applicable)
+from db import ReplicaRefresher, pool_from_config, replica_path
+from instrumentation import InstrumentedConnection, Metrics, RequestRecorder, describe_metrics
+from migrations import migrate
+from shards import ShardRouter, Tenant, TenantMiddleware, UnknownTenant
+from snapshots import SNAPSHOT_QUERIES, SnapshotRefresher, snapshot_rows, snapshot_status
+
+# The archive, compliance engine, spray planner (numpy), ingestion writer,
+# exporter and catalog search are imported by the functions using them, so
+# that a worker only pays for them once a request needs them, or during the
+# warm-up.
+
+DEFAULT_CONFIG = dict(
+    DATABASE = 'test.db',
+    DB_POOL_SIZE = 5,
+    DB_POOL_TIMEOUT = 10.0,
+    AUTO_MIGRATE = True,
+    REPORT_CACHE_ENABLED = True,
+    REPORT_CACHE_SIZE = 256,
+    REPORT_CACHE_TTL = 300.0,
+    REPORT_CACHE_SHARED_PATH = None,
+    REPORT_PAGE_SIZE = 1000,
+    REPORT_STREAMING = False,
+    REPORT_STREAM_BUFFER = 50,
+    API_GZIP_MIN_SIZE = 1024,
+    CALENDAR_MAX_DAYS = 366,
+    COMPLIANCE_ENGINE = 'sql',
+    ASYNC_WORKERS = None,
+    METRICS_ENABLED = True,
+    SLOW_QUERY_THRESHOLD = 0.5,
+    SLOW_QUERY_LOG_SIZE = 100,
+    PROFILE_REQUESTS = False,
+    PROFILE_DIR = 'profiles',
+    SNAPSHOTS_ENABLED = False,
+    SNAPSHOT_INTERVAL = 30.0,
+    SEARCH_RESULTS = 20,
+    SEARCH_MAX_RESULTS = 100,
+    SHARD_DIRECTORY = None,
+    SHARD_MAX_OPEN = 64,
+    INGEST_QUEUE_SIZE = 10000,
+    INGEST_BATCH_SIZE = 500,
+    INGEST_MAX_DELAY = 0.005,
+    INGEST_MAX_RECORDS = 1000,
+    INGEST_TIMEOUT = 10.0,
+    ARCHIVE_DIRECTORY = 'archive',
+    DB_READ_ONLY = False,
+    DB_REPLICA = False,
+    DB_REPLICA_INTERVAL = 60.0,
+    PRECOMPILE_TEMPLATES = False,
+    TEMPLATE_CACHE_DIR = 'template-cache',
+    WARM_UP = False,
+    EXPORT_CHUNK_SIZE = 5000,
+)
+
+# Views and request hooks are collected here and registered on each app built
+# by create_app(), under their plain function names as endpoints.
+VIEWS = []
+HOOKS = []
+
+class DayConverter(BaseConverter):
+    # <day:as_of_date>: a YYYY-MM-DD date, validated once when the URL is
+    # matched and handed to the view as an AsOfDate
+    regex = r'\d{4}-\d{2}-\d{2}'
+
+    def to_python(self, value):
+        try:
+            return AsOfDate(value)
+        except ValueError:
+            raise ValidationError()
+
+def route(rule, **options):
+    def register(view):
+        VIEWS.append((rule, view, options))
+        return view
+    return register
+
+def hook(name):
+    def register(function):
+        HOOKS.append((name, function))
+        return function
+    return register
+
+# Multi-tenant mode (SHARD_DIRECTORY set): a /t/<tenant>/ prefix selects the
+# tenant's shard (see shards.py). Everything derived from the database -- the
+# pools, lookups, compliance engine, planner, archive and the refresher and
+# writer threads -- belongs to the tenant's shards.Tenant, and goes when the
+# shard router evicts it. The Tenant of DATABASE is kept for good.
+
+def current_tenant():
+    return request.environ.get('gardenlog.tenant') if has_request_context() else None
+
+def get_tenant():
+    tenant = current_tenant()
+    if tenant is not None:
+        if not current_app.config['SHARD_DIRECTORY']:
+            abort(404)
+        try:
+            return get_shard_router().tenant(tenant)
+        except UnknownTenant:
+            abort(404, 'unknown tenant %r' % tenant)
+    if 'tenant' not in current_app.extensions:
+        pool = pool_from_config(current_app.config)
+        if current_app.config['AUTO_MIGRATE']:
+            conn = pool.acquire()
+            try:
+                migrate(conn)
+            finally:
+                pool.release(conn)
+        current_app.extensions['tenant'] = Tenant(None, pool)
+    return current_app.extensions['tenant']
+
+def tenant_extension(name, factory):
+    return get_tenant().extension(name, factory)
+
+def get_shard_router():
+    if 'shard_router' not in current_app.extensions:
+        current_app.extensions['shard_router'] = ShardRouter(current_app.config, current_app.config['SHARD_MAX_OPEN'])
+    return current_app.extensions['shard_router']
+
+def get_pool():
+    return get_tenant().pool
+
+# Request handlers read through get_read_pool(); only the ingestion writer and
+# the snapshot refresher write, through get_pool(). With DB_READ_ONLY the read
+# pool opens the database with mode=ro, with DB_REPLICA it reads a copy that
+# a ReplicaRefresher updates every DB_REPLICA_INTERVAL seconds.
+
+def get_read_pool():
+    if not (current_app.config['DB_READ_ONLY'] or current_app.config['DB_REPLICA']):
+        return get_pool()
+    database = get_pool().database
+    if current_app.config['DB_REPLICA']:
+        database = get_replica_refresher(database).replica
+    return tenant_extension('read_pool', lambda: pool_from_config(dict(current_app.config, DATABASE = database), read_only = True))
+
+def get_replica_refresher(database):
+    def start():
+        refresher = ReplicaRefresher(database, replica_path(database), current_app.config['DB_REPLICA_INTERVAL'])
+        # the first copy is made before any request reads the replica
+        refresher.refresh()
+        refresher.start()
+        return refresher
+    return tenant_extension('replica_refresher', start)
+
+def get_report_cache():
+    if 'report_cache' not in current_app.extensions:
+        current_app.extensions['report_cache'] = cache_from_config(current_app.config)
+    return current_app.extensions['report_cache']
+
+def get_lookups():
+    return tenant_extension('lookups', Lookups).refresh(get_db_connection())
+
+@hook('before_request')
+def check_tenant():
+    # unknown tenants get a 404 even on pages that do not touch the database
+    if current_tenant() is not None:
+        get_pool()
+
+# Instrumentation: every request gets a RequestRecorder that sums the time
+# spent in connect, query, fetch and render and times each query function;
+# the totals are scraped from /metrics. Requests carrying an
+# X-Gardenlog-Profile header are run under cProfile when PROFILE_REQUESTS is on.
+
+def get_metrics():
+    if 'metrics' not in current_app.extensions:
+        current_app.extensions['metrics'] = describe_metrics(Metrics())
+        current_app.extensions['slow_queries'] = collections.deque(maxlen = current_app.config['SLOW_QUERY_LOG_SIZE'])
+    return current_app.extensions['metrics']
+
+def get_recorder():
+    if 'recorder' not in g:
+        metrics = get_metrics()
+        g.recorder = RequestRecorder(metrics, current_app.config['SLOW_QUERY_THRESHOLD'], current_app.extensions['slow_queries'])
+    return g.recorder
+
+def record_span(name, seconds):
+    if current_app.config['METRICS_ENABLED']:
+        get_recorder().span(name, seconds)
+
+@hook('before_request')
+def start_request_metrics():
+    if current_app.config['METRICS_ENABLED']:
+        get_recorder()
+    if current_app.config['PROFILE_REQUESTS'] and 'X-Gardenlog-Profile' in request.headers:
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@hook('after_request')
+def add_request_metrics(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(current_app.config['PROFILE_DIR'], exist_ok = True)
+        path = os.path.join(current_app.config['PROFILE_DIR'], '%s-%d.prof' % (request.endpoint, time.time() * 1000))
+        profiler.dump_stats(path)
+        response.headers['X-Gardenlog-Profile-File'] = path
+    if 'recorder' in g:
+        response.headers['Server-Timing'] = g.recorder.server_timing()
+    return response
+
+def template_render_started(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+def template_render_finished(sender, template, context, **extra):
+    started = g.pop('render_started', None)
+    if started is not None:
+        record_span('render', time.perf_counter() - started)
+
+def get_archive():
+    from archive import Archive
+    tenant = current_tenant()
+    directory = current_app.config['ARCHIVE_DIRECTORY']
+    return tenant_extension('archive', lambda: Archive(os.path.join(directory, tenant) if tenant else directory))
+
+def get_compliance_engine():
+    from compliance import engine_from_config
+    return tenant_extension('compliance_engine', lambda: engine_from_config(current_app.config))
+
+# Reports the in-memory compliance engine can answer, with the engine method
+# standing in for the SQL query.
+ENGINE_REPORTS = {
+    'date_limits': (treatment_date_limits_in_effect, 'date_limits'),
+    'safe': (safe_to_consume_dates, 'safe_to_consume'),
+    'not_applicable': (treatments_no_longer_applicable, 'no_longer_applicable'),
+}
+
+def get_snapshot_refresher():
+    # started lazily so that every worker process runs its own thread
+    def start():
+        refresher = SnapshotRefresher(get_pool(), current_app.config['SNAPSHOT_INTERVAL'])
+        refresher.start()
+        return refresher
+    return tenant_extension('snapshot_refresher', start)
+
+def report_query(report):
+    # With SNAPSHOTS_ENABLED the compliance reports are read from the daily
+    # snapshot when one is current for the requested date; otherwise they
+    # come from the compliance engine or SQL.
+    query = live_report_query(report)
+    if not current_app.config['SNAPSHOTS_ENABLED'] or report not in SNAPSHOT_QUERIES:
+        return query
+    get_snapshot_refresher()
+
+    def snapshot_or_live(conn, as_of_date, after=None, limit=-1):
+        rows = snapshot_rows(conn, report, as_of_date, after, limit)
+        return rows if rows is not None else query(conn, as_of_date, after, limit)
+    return snapshot_or_live
+
+def live_report_query(report):
+    if report not in ENGINE_REPORTS:
+        return SNAPSHOT_QUERIES[report]
+    sql_query, method = ENGINE_REPORTS[report]
+    engine = get_compliance_engine()
+    if engine is None:
+        return sql_query
+
+    def query(conn, as_of_date, after=None, limit=-1):
+        engine.refresh(conn)
+        return getattr(engine, method)(as_of_date, after, limit)
+    return query
+
+def season_report(conn, report, as_of_date, after = None, limit = -1):
+    # a report reading rows of archived seasons merges them into the SQL
+    # report; snapshots and the compliance engine only see the database
+    from archive import ARCHIVED_REPORTS, archived_report_seasons
+    archive = get_archive()
+    if archived_report_seasons(conn, archive, report, as_of_date):
+        return ARCHIVED_REPORTS[report](conn, archive, as_of_date, after, limit)
+    return report_query(report)(conn, as_of_date, after, limit)
 
 def get_db_connection():
-    conn = sqlite3.connect("test.db")
-    conn.row_factory = sqlite3.Row
-    return conn
-    
-@app.route('/')
-@app.route('/index/')
+    if 'db' not in g:
+        started = time.perf_counter()
+        g.db_pool = get_read_pool()
+        g.db = g.db_pool.acquire()
+        record_span('connect', time.perf_counter() - started)
+        if current_app.config['METRICS_ENABLED']:
+            g.instrumented_db = InstrumentedConnection(g.db, get_recorder())
+    return g.get('instrumented_db', g.db)
+
+@hook('teardown_request')
+def finish_request_metrics(exception):
+    recorder = g.pop('recorder', None)
+    if recorder is not None:
+        recorder.finish(g.get('db'), request.endpoint)
+    g.pop('instrumented_db', None)
+
+@hook('teardown_appcontext')
+def release_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        g.pop('db_pool').release(conn)
+
+def rows(cursor):
+    return [dict(row) for row in cursor]
+
+def cached_report(report, args, compute):
+    conn = get_db_connection()
+    if not current_app.config['REPORT_CACHE_ENABLED']:
+        return compute(conn)
+    tenant = current_tenant()
+    if tenant is not None:
+        args = (tenant,) + args
+    return get_report_cache().get_or_compute(report, args, data_versions(conn), lambda: compute(conn))
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode().rstrip('=')
+
+def decode_cursor(token, length):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        abort(400, 'malformed page cursor')
+    if not isinstance(values, list) or len(values) != length:
+        abort(400, 'malformed page cursor')
+    return tuple(values)
+
+def page_arguments(report):
+    token = request.args.get('after')
+    after = decode_cursor(token, len(REPORT_KEYS[report])) if token else None
+    limit = request.args.get('limit', current_app.config['REPORT_PAGE_SIZE'], type=int)
+    return after, limit if limit and limit > 0 else -1
+
+def streaming():
+    return bool(request.args.get('stream', current_app.config['REPORT_STREAMING'], type=int))
+
+def report_rows(report, args, after, limit, query):
+    # Streaming hands the live cursor to the template; otherwise the page is
+    # materialized once and cached.
+    if streaming():
+        return query(get_db_connection())
+    page = (encode_cursor(after) if after else '', limit)
+    return cached_report(report, args + page, lambda conn: rows(query(conn)))
+
+def report_context(report, limit, context):
+    def next_page(last_row):
+        args = request.args.to_dict()
+        args['after'] = encode_cursor(last_row[key] for key in REPORT_KEYS[report])
+        return url_for(request.endpoint, **request.view_args, **args)
+
+    context.update(page_size = limit, next_page = next_page)
+    return context
+
+def render_report(template, report, limit, context):
+    context = report_context(report, limit, context)
+    if not streaming():
+        return render_template(template, **context)
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template).stream(context)
+    stream.enable_buffering(current_app.config['REPORT_STREAM_BUFFER'])
+    return current_app.response_class(stream_with_context(stream), mimetype='text/html')
+
+def get_spray_planner():
+    from planning import SprayPlanner
+    try:
+        planner = tenant_extension('spray_planner', SprayPlanner)
+    except RuntimeError as error:
+        abort(501, str(error))
+    planner.refresh(get_db_connection())
+    return planner
+
+def planned_dates():
+    first_day, last_day, plant_ids = date_range_arguments(default = date.today())
+    days = [date.fromordinal(day) for day in range(first_day.toordinal(), last_day.toordinal() + 1)]
+    return days, plant_ids
+
+@route('/stats/pool')
+def pool_stats():
+    return jsonify(get_pool().stats())
+
+@route('/stats/cache')
+def cache_stats():
+    return jsonify(get_report_cache().stats())
+
+@route('/stats/slow_queries')
+def slow_query_stats():
+    get_metrics()
+    return jsonify(list(current_app.extensions['slow_queries']))
+
+@route('/metrics')
+def metrics():
+    pool = get_pool().stats()
+    cache = get_report_cache().stats()
+    gauges = [
+        ('gardenlog_pool_connections', (('state', 'open'),), pool['open']),
+        ('gardenlog_pool_connections', (('state', 'idle'),), pool['idle']),
+        ('gardenlog_pool_waits_total', (), pool['waits']),
+    ] + [('gardenlog_report_cache_lookups_total', (('result', result),), cache[result])
+         for result in ('hits', 'shared_hits', 'misses', 'stale', 'expired')]
+    return current_app.response_class(get_metrics().render(gauges), mimetype = 'text/plain; version=0.0.4')
+
+@route('/stats/snapshots')
+def snapshot_stats():
+    refresher = get_tenant().extensions.get('snapshot_refresher')
+    return jsonify({'refresher': refresher.stats() if refresher is not None else None,
+                    'snapshots': snapshot_status(get_db_connection())})
+
+@route('/stats/replica')
+def replica_stats():
+    refresher = get_tenant().extensions.get('replica_refresher')
+    return jsonify({'read_pool': get_read_pool().stats(), 'refresher': refresher.stats() if refresher is not None else None})
+
+@route('/stats/shards')
+def shard_stats():
+    if not current_app.config['SHARD_DIRECTORY']:
+        return jsonify({'directory': None})
+    return jsonify(get_shard_router().stats())
+
+@route('/stats/compliance')
+def compliance_stats():
+    engine = get_compliance_engine()
+    return jsonify(engine.stats() if engine is not None else {'engine': 'sql'})
+
+@route('/')
+@route('/index/')
 def index():
+    # plants and treatments are picked through the typeahead search, so the
+    # page does not grow with the catalog
     today = date.today()
     as_of = today.strftime("%Y-%m-%d")
-    conn = get_db_connection()
-    treatment_list = list_of_treatments(conn).fetchall()
-    plant_list = list_of_plants(conn).fetchall()
-    conn.close()
-    return render_template('index.html', as_of = as_of, treatments = treatment_list, plants = plant_list)
+    plan_until = (today + timedelta(days = 13)).strftime("%Y-%m-%d")
+    return render_template('index.html', as_of = as_of, plan_until = plan_until)
 
-@app.route('/date_limits/<as_of_date>')
+# Report pages are built in two steps: the *_page functions run the query and
+# return (template, report, page size, template context), render_report turns
+# that into HTML. The async server (asgi.py) runs the same two steps apart.
+
+def date_limits_page(as_of_date):
+    after, limit = page_arguments('date_limits')
+    current_limits = report_rows('date_limits', (as_of_date,), after, limit,
+                                 lambda conn: season_report(conn, 'date_limits', as_of_date, after, limit))
+    return 'date_limits.html', 'date_limits', limit, dict(as_of = as_of_date, date_limits = current_limits)
+
+def safe_page(as_of_date):
+    after, limit = page_arguments('safe')
+    dates = report_rows('safe', (as_of_date,), after, limit,
+                        lambda conn: season_report(conn, 'safe', as_of_date, after, limit))
+    return 'safe.html', 'safe', limit, dict(as_of = as_of_date, dates = dates)
+
+def not_applicable_page(as_of_date):
+    after, limit = page_arguments('not_applicable')
+    treatments = report_rows('not_applicable', (as_of_date,), after, limit,
+                             lambda conn: season_report(conn, 'not_applicable', as_of_date, after, limit))
+    return 'not_applicable.html', 'not_applicable', limit, dict(as_of = as_of_date, treatments = treatments)
+
+def no_info_page(as_of_date):
+    after, limit = page_arguments('no_info')
+    treatments = report_rows('no_info', (as_of_date,), after, limit,
+                             lambda conn: season_report(conn, 'no_info', as_of_date, after, limit))
+    return 'no_info.html', 'no_info', limit, dict(as_of = as_of_date, treatments = treatments)
+
+def plant_info_query(as_of_date):
+    # seasons moved to the archive are read from there
+    if as_of_date.season not in get_archive().seasons():
+        return all_treatments_for_plant
+    from archive import treatments_for_plant
+    lookups = get_lookups()
+    return lambda conn, *args: treatments_for_plant(conn, get_archive(), lookups, *args)
+
+def plant_info_page(as_of_date, plant_id):
+    after, limit = page_arguments('plant_info')
+    query = plant_info_query(as_of_date)
+    plant_info = report_rows('plant_info', (as_of_date, plant_id), after, limit,
+                             lambda conn: query(conn, as_of_date, plant_id, after, limit))
+    selected_plant = plant_description(get_db_connection(), plant_id).fetchone()
+    return 'plant_info.html', 'plant_info', limit, dict(plant = selected_plant['description'], plant_info = plant_info)
+
+# endpoint -> page function
+REPORT_PAGES = {
+    'date_limits': date_limits_page,
+    'safe': safe_page,
+    'not_applicable': not_applicable_page,
+    'no_info': no_info_page,
+    'plant_info': plant_info_page,
+}
+
+@route('/date_limits/<day:as_of_date>')
 def date_limits(as_of_date):
-    conn = get_db_connection()
-    current_limits = treatment_date_limits_in_effect(conn, as_of_date).fetchall()
-    conn.close()
-    return render_template('date_limits.html', as_of = as_of_date, date_limits = current_limits)
+    return render_report(*date_limits_page(as_of_date))
 
-@app.route('/safe/<as_of_date>')
+@route('/safe/<day:as_of_date>')
 def safe(as_of_date):
-    conn = get_db_connection()
-    dates = safe_to_consume_dates(conn, as_of_date).fetchall()
-    conn.close()
-    return render_template('safe.html', as_of = as_of_date, dates = dates)
+    return render_report(*safe_page(as_of_date))
 
-@app.route('/not_applicable/<as_of_date>')
+@route('/not_applicable/<day:as_of_date>')
 def not_applicable(as_of_date):
-    conn = get_db_connection()
-    treatments = treatments_no_longer_applicable(conn, as_of_date).fetchall()
-    conn.close()
-    return render_template('not_applicable.html', as_of = as_of_date, treatments = treatments)
+    return render_report(*not_applicable_page(as_of_date))
 
-@app.route('/no_info/<as_of_date>')
+@route('/no_info/<day:as_of_date>')
 def no_info(as_of_date):
-    conn = get_db_connection()
-    treatments = treatments_applied_without_limit_info(conn, as_of_date).fetchall()
-    conn.close()
-    return render_template('no_info.html', as_of = as_of_date, treatments = treatments)
+    return render_report(*no_info_page(as_of_date))
 
-@app.route('/treatment_info/<treatment_id>')
+@route('/plant_info/<day:as_of_date>/<plant_id>')
+def plant_info(as_of_date, plant_id):
+    return render_report(*plant_info_page(as_of_date, plant_id))
+
+@route('/treatment_info/<treatment_id>')
 def treatment_info(treatment_id):
-    conn = get_db_connection()
-    treatment_info = all_limit_info_for_treatment(conn, treatment_id).fetchall()
-    selected_treatment = treatment_description(conn, treatment_id).fetchone()
-    conn.close()
+    treatment_info, selected_treatment = cached_report('treatment_info', (treatment_id,),
+        lambda conn: (rows(all_limit_info_for_treatment(conn, treatment_id)), dict(treatment_description(conn, treatment_id).fetchone())))
     return render_template('treatment_info.html', treatment = selected_treatment['description'], treatment_info = treatment_info)
 
-@app.route('/plant_info/<as_of_date>/<plant_id>')
-def plant_info(as_of_date, plant_id):
+
+@route('/plan/<treatment_id>')
+def plan(treatment_id):
+    days, plant_ids = planned_dates()
+    selected_treatment = treatment_description(get_db_connection(), treatment_id).fetchone()
+    if selected_treatment is None:
+        abort(404)
+    plan = get_spray_planner().plan(int(treatment_id), days, plant_ids)
+    return render_template('plan.html', treatment = selected_treatment['description'], days = days, plan = plan)
+
+
+
+# JSON API: the same data as the report pages, as compact JSON pages
+# ({"rows": [...], "next": cursor}) or as an NDJSON stream of rows.
+# ETags are derived from the DataVersion counters, so polling clients get
+# a 304 without any report query being run.
+
+def json_dumps(value):
+    return json.dumps(value, separators = (',', ':'))
+
+def wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def wants_gzip():
+    return request.accept_encodings['gzip'] > 0
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
+
+def ndjson_lines(cursor, batch = 100):
+    lines = []
+    for row in cursor:
+        lines.append(json_dumps(dict(row)))
+        if len(lines) >= batch:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def api_etag(conn, report):
+    versions = data_versions(conn)
+    state = ','.join('%s=%d' % (table, versions[table]) for table in REPORT_TABLES[report])
+    return hashlib.sha1((state + '|' + request.script_root + request.full_path).encode()).hexdigest()
+
+def not_modified(etag):
+    response = current_app.response_class(status = 304)
+    response.set_etag(etag, weak = True)
+    return response
+
+def json_response(payload, etag):
+    body = json_dumps(payload).encode()
+    compressed = wants_gzip() and len(body) >= current_app.config['API_GZIP_MIN_SIZE']
+    if compressed:
+        body = gzip.compress(body, 6)
+    response = current_app.response_class(body, mimetype = 'application/json')
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak = True)
+    return response
+
+def api_report(report, args, query):
+    conn = get_db_connection()
+    etag = api_etag(conn, report)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+
+    if report in REPORT_KEYS:
+        after, limit = page_arguments(report)
+    else:
+        after, limit = None, -1
+    if not wants_ndjson():
+        page = cached_report(report, args + (encode_cursor(after) if after else '', limit),
+                             lambda conn: rows(query(conn, after, limit)))
+        next_cursor = None
+        if report in REPORT_KEYS and limit > 0 and len(page) >= limit:
+            next_cursor = encode_cursor(page[-1][key] for key in REPORT_KEYS[report])
+        response = json_response({'rows': page, 'next': next_cursor}, etag)
+        response.vary.add('Accept')
+        return response
+
+    if 'limit' not in request.args:
+        limit = -1
+    body = ndjson_lines(query(conn, after, limit))
+    response = current_app.response_class(stream_with_context(gzip_stream(body) if wants_gzip() else body),
+                                  mimetype = 'application/x-ndjson')
+    if wants_gzip():
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak = True)
+    return response
+
+@route('/api/v1/date_limits/<day:as_of_date>')
+def api_date_limits(as_of_date):
+    return api_report('date_limits', (as_of_date,),
+                      lambda conn, after, limit: season_report(conn, 'date_limits', as_of_date, after, limit))
+
+@route('/api/v1/safe/<day:as_of_date>')
+def api_safe(as_of_date):
+    return api_report('safe', (as_of_date,),
+                      lambda conn, after, limit: season_report(conn, 'safe', as_of_date, after, limit))
+
+@route('/api/v1/not_applicable/<day:as_of_date>')
+def api_not_applicable(as_of_date):
+    return api_report('not_applicable', (as_of_date,),
+                      lambda conn, after, limit: season_report(conn, 'not_applicable', as_of_date, after, limit))
+
+@route('/api/v1/no_info/<day:as_of_date>')
+def api_no_info(as_of_date):
+    return api_report('no_info', (as_of_date,),
+                      lambda conn, after, limit: season_report(conn, 'no_info', as_of_date, after, limit))
+
+@route('/api/v1/treatment_info/<treatment_id>')
+def api_treatment_info(treatment_id):
+    return api_report('treatment_info', (treatment_id,),
+                      lambda conn, after, limit: all_limit_info_for_treatment(conn, treatment_id))
+
+@route('/api/v1/plant_info/<day:as_of_date>/<plant_id>')
+def api_plant_info(as_of_date, plant_id):
+    query = plant_info_query(as_of_date)
+    return api_report('plant_info', (as_of_date, plant_id),
+                      lambda conn, after, limit: query(conn, as_of_date, plant_id, after, limit))
+
+@route('/api/v1/treatments')
+def api_treatments():
+    return api_report('treatments', (), lambda conn, after, limit: get_lookups().treatments)
+
+@route('/api/v1/plants')
+def api_plants():
+    return api_report('plants', (), lambda conn, after, limit: get_lookups().plants)
+
+def search_arguments():
+    prefix = request.args.get('q', '').strip()
+    limit = request.args.get('limit', current_app.config['SEARCH_RESULTS'], type=int)
+    return prefix, max(1, min(limit or 1, current_app.config['SEARCH_MAX_RESULTS']))
+
+# Ingestion: POSTed treatments are handed to the tenant's TreatmentWriter
+# (ingest.py) and acknowledged once their batch is committed. Records are
+# identified by a client-supplied clientId, so a retry after a lost response
+# or a 503 is answered with the row created the first time.
+
+def get_treatment_writer():
+    def start():
+        from ingest import TreatmentWriter
+        refresher = get_snapshot_refresher() if current_app.config['SNAPSHOTS_ENABLED'] else None
+        writer = TreatmentWriter(get_pool(), current_app.config['INGEST_QUEUE_SIZE'], current_app.config['INGEST_BATCH_SIZE'],
+                                 current_app.config['INGEST_MAX_DELAY'], on_commit = refresher and refresher.wake)
+        writer.start()
+        return writer
+    return tenant_extension('treatment_writer', start)
+
+def ingest_records():
+    if request.mimetype == 'application/x-ndjson':
+        lines = request.get_data(as_text = True).splitlines()
+        try:
+            records = [json.loads(line) for line in lines if line.strip()]
+        except ValueError:
+            abort(400, 'malformed NDJSON')
+    else:
+        records = request.get_json(silent = True)
+        if isinstance(records, dict):
+            records = [records]
+    if not isinstance(records, list) or not records:
+        abort(400, 'expected a treatment record or a list of them')
+    if len(records) > current_app.config['INGEST_MAX_RECORDS']:
+        abort(413, 'at most %d records per request' % current_app.config['INGEST_MAX_RECORDS'])
+    from importer import treatment_date
+    for position, record in enumerate(records):
+        if not isinstance(record, dict) or not all(isinstance(record.get(field), str) and record[field]
+                                                   for field in ('clientId', 'plant', 'treatment', 'date')):
+            abort(400, 'record %d needs clientId, plant, treatment and date' % position)
+        # stored as written, so only the form julianday() reads
+        record['date'] = treatment_date(record['date'])
+        if record['date'] is None:
+            abort(400, 'record %d: date must be YYYY-MM-DD' % position)
+    return records
+
+@route('/api/v1/applied_treatments', methods = ['POST'])
+def api_ingest():
+    from concurrent.futures import TimeoutError as FutureTimeout
+    from ingest import QueueFull
+    records = ingest_records()
+    try:
+        futures = get_treatment_writer().submit(records)
+    except QueueFull:
+        response = jsonify({'error': 'ingestion queue is full, retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    deadline = time.monotonic() + current_app.config['INGEST_TIMEOUT']
+    try:
+        results = [future.result(max(0.0, deadline - time.monotonic())) for future in futures]
+    except FutureTimeout:
+        # the records stay queued; retrying with the same clientIds is safe
+        abort(504, 'treatments were not committed in time')
+    return jsonify({'results': results})
+
+@route('/stats/ingest')
+def ingest_stats():
+    writer = get_tenant().extensions.get('treatment_writer')
+    return jsonify(writer.stats() if writer is not None else None)
+
+@route('/api/v1/history/<int:plant_id>')
+def api_history(plant_id):
+    # a plant's treatments over any number of seasons, archived or not
+    first_day = request.args.get('from', '0001-01-01')
+    last_day = request.args.get('to', '9999-12-31')
+    try:
+        date.fromisoformat(first_day), date.fromisoformat(last_day)
+    except ValueError:
+        abort(400, 'from and to must be YYYY-MM-DD')
+    from archive import plant_history
+    return api_report('history', (plant_id, first_day, last_day),
+                      lambda conn, after, limit: plant_history(conn, get_archive(), get_lookups(), plant_id, first_day, last_day))
+
+@route('/api/v1/export')
+def api_export():
+    # the joined treatment history in CSV or columnar chunks; ?after= the
+    # plantId,date,id of the last row received resumes an interrupted download
+    from export import FORMATS, export_chunks, export_rows, parse_after
+    export_format = request.args.get('format', 'csv')
+    try:
+        if export_format not in FORMATS:
+            raise ValueError(export_format)
+        first_day = AsOfDate(request.args['from']) if 'from' in request.args else None
+        last_day = AsOfDate(request.args['to']) if 'to' in request.args else None
+        plant_ids = [int(plant_id) for plant_id in request.args.getlist('plant')] or None
+        after = parse_after(request.args['after']) if 'after' in request.args else None
+    except ValueError:
+        abort(400, 'expected ?format=csv|columnar[&from=YYYY-MM-DD][&to=YYYY-MM-DD][&plant=<id>...][&after=<plantId>,<date>,<id>]')
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    rows = export_rows(get_db_connection(), get_archive(), first_day, last_day, plant_ids, after, chunk_size)
+    body = (data for data, _ in export_chunks(rows, export_format, chunk_size, header = after is None))
+    _, _, mimetype, extension = FORMATS[export_format]
+    compressed = export_format == 'csv' and wants_gzip()
+    response = current_app.response_class(stream_with_context(gzip_stream(body) if compressed else body), mimetype = mimetype)
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.headers['Content-Disposition'] = 'attachment; filename=treatments.%s' % extension
+    return response
+
+@route('/api/v1/plants/search')
+def api_plant_search():
+    prefix, limit = search_arguments()
+    return api_report('plant_search', (limit, prefix), lambda conn, after, _: search_plants(conn, prefix, limit))
+
+@route('/api/v1/treatments/search')
+def api_treatment_search():
+    prefix, limit = search_arguments()
+    return api_report('treatment_search', (limit, prefix), lambda conn, after, _: search_treatments(conn, prefix, limit))
+
+@route('/api/v1/search')
+def api_search():
+    # ranked full-text search over plants, treatment types and species;
+    # ?kind=plant|treatment|species (repeatable) restricts the results
+    from search import KINDS, search_catalog
+    text, limit = search_arguments()
+    kinds = sorted(set(request.args.getlist('kind')))
+    if not set(kinds) <= KINDS.keys():
+        abort(400, 'kind must be one of %s' % ', '.join(sorted(KINDS)))
+    return api_report('search', (limit, ','.join(kinds), text), lambda conn, after, _: search_catalog(conn, text, kinds, limit))
+
+def date_range_arguments(default = None):
+    # ?from=<date> &to=<date> &plant=<id> (repeatable, default all plants)
+    try:
+        first_day = date.fromisoformat(request.args['from']) if default is None else \
+            request.args.get('from', default, type = date.fromisoformat)
+        last_day = request.args.get('to', first_day, type = date.fromisoformat)
+        plant_ids = [int(plant_id) for plant_id in request.args.getlist('plant')] or None
+    except (KeyError, ValueError):
+        abort(400, 'expected ?from=YYYY-MM-DD[&to=YYYY-MM-DD][&plant=<id>...]')
+    if not 0 <= (last_day - first_day).days < current_app.config['CALENDAR_MAX_DAYS']:
+        abort(400, 'date range must be ascending and shorter than %d days' % current_app.config['CALENDAR_MAX_DAYS'])
+    return first_day, last_day, plant_ids
+
+@route('/api/v1/calendar')
+def api_calendar():
+    first_day, last_day, plant_ids = date_range_arguments()
+    conn = get_db_connection()
+    etag = api_etag(conn, 'calendar')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    plants = cached_report('calendar', (first_day, last_day, ','.join(map(str, plant_ids or ()))),
+                           lambda conn: plant_calendar(conn, plant_ids, first_day, last_day))
+    return json_response({'from': first_day.isoformat(), 'to': last_day.isoformat(), 'plants': plants}, etag)
+
+@route('/api/v1/plan/<int:treatment_id>')
+def api_plan(treatment_id):
+    days, plant_ids = planned_dates()
     conn = get_db_connection()
-    plant_info = all_treatments_for_plant(conn, as_of_date, plant_id).fetchall()
-    selected_plant = plant_description(conn, plant_id).fetchone()
-    conn.close()
-    return render_template('plant_info.html', plant = selected_plant['description'], plant_info = plant_info)
+    etag = api_etag(conn, 'plan')
+    if request.if_none_match.contains_weak(etag):
+        return not_modified(etag)
+    plan = get_spray_planner().plan(treatment_id, days, plant_ids)
+    return json_response({'treatmentTypeId': treatment_id, 'from': days[0].isoformat(), 'to': days[-1].isoformat(), 'plants': plan}, etag)
+
+@route('/stats/startup')
+def startup_stats():
+    return jsonify(current_app.extensions.get('startup'))
+
+# Startup: create_app() builds an app from DEFAULT_CONFIG, GARDENLOG_ environment
+# variables and `config`, in that order. The module-level `app` (FLASK_APP=app,
+# gunicorn app:app, asgi.py) is created on first access; servers that fork
+# workers can call create_app() per worker instead.
+
+def create_app(config = None, warm_up = None):
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_prefixed_env('GARDENLOG')
+    app.config.update(config or {})
+    app.wsgi_app = TenantMiddleware(app.wsgi_app)
+    app.url_map.converters['day'] = DayConverter
+    for rule, view, options in VIEWS:
+        app.add_url_rule(rule, view_func = view, **options)
+    for name, function in HOOKS:
+        getattr(app, name)(function)
+    before_render_template.connect(template_render_started, app)
+    template_rendered.connect(template_render_finished, app)
+    if app.config['PRECOMPILE_TEMPLATES']:
+        precompile_templates(app)
+    app.extensions['startup'] = {'pid': os.getpid(), 'create_app_seconds': time.perf_counter() - started, 'warm_up': None}
+    if app.config['WARM_UP'] if warm_up is None else warm_up:
+        app.extensions['startup']['warm_up'] = warm_up_app(app)
+    return app
+
+def precompile_templates(app):
+    # Compiles every template into a Python module under TEMPLATE_CACHE_DIR, in
+    # a directory named after a hash of the template sources, and loads them
+    # from there: workers import compiled templates (and their .pyc) instead
+    # of parsing each template on its first render. Edited templates get a
+    # new directory; the async overlay in asgi.py keeps compiling from source.
+    environment = app.jinja_env
+    loader = environment.loader
+    sources = hashlib.sha1()
+    for name in sorted(environment.list_templates()):
+        sources.update(name.encode() + b'\0' + loader.get_source(environment, name)[0].encode() + b'\0')
+    directory = os.path.join(app.config['TEMPLATE_CACHE_DIR'], sources.hexdigest()[:16])
+    if not os.path.isdir(directory):
+        temporary = '%s.%d.tmp' % (directory, os.getpid())
+        environment.compile_templates(temporary, zip = None, ignore_errors = False)
+        try:
+            os.rename(temporary, directory)
+        except OSError:
+            # another worker compiled them first
+            shutil.rmtree(temporary)
+    environment.loader = ChoiceLoader([ModuleLoader(directory), loader])
+    return directory
+
+def warm_up_app(app):
+    # Runs before the worker takes traffic: opens every pooled connection,
+    # reads the database file once so its pages are in the OS page cache
+    # (SQLite reads them through mmap), then requests each report for today
+    # once, which runs every report query and loads the lookups, the
+    # compliance engine and the templates. Tenants are warmed on first use.
+    timings = {}
+    started = time.perf_counter()
+    with app.app_context():
+        pool = get_read_pool()
+        connections = [pool.acquire() for _ in range(pool.size)]
+        try:
+            for conn in connections:
+                # parses the schema into the connection
+                conn.execute('SELECT count(*) FROM sqlite_master').fetchone()
+            plant = connections[0].execute('SELECT min(id) FROM Plant').fetchone()[0]
+            treatment = connections[0].execute('SELECT min(id) FROM TreatmentType').fetchone()[0]
+        finally:
+            for conn in connections:
+                pool.release(conn)
+        timings['pool'] = time.perf_counter() - started
+        started = time.perf_counter()
+        with open(pool.database, 'rb') as database:
+            while database.read(1 << 20):
+                pass
+        timings['page_cache'] = time.perf_counter() - started
+
+    today = date.today().isoformat()
+    urls = ['/'] + ['/%s/%s' % (report, today) for report in ('date_limits', 'safe', 'not_applicable', 'no_info')]
+    if plant is not None:
+        urls.append('/plant_info/%s/%d' % (today, plant))
+    if treatment is not None:
+        urls.append('/treatment_info/%d' % treatment)
+    client = app.test_client()
+    timings['requests'] = {}
+    for url in urls:
+        started = time.perf_counter()
+        status = client.get(url).status_code
+        timings['requests'][url] = time.perf_counter() - started
+        if status != 200:
+            app.logger.warning('warm-up request %s returned %d', url, status)
+    timings['seconds'] = timings['pool'] + timings['page_cache'] + sum(timings['requests'].values())
+    return timings
+
+app_lock = threading.Lock()
 
+def __getattr__(name):
+    global app
+    if name != 'app':
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    with app_lock:
+        if 'app' not in globals():
+            app = create_app()
+    return app
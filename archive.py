@@ -0,0 +1,535 @@
+import argparse
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from datetime import date
+from heapq import merge
+from itertools import chain, islice
+from operator import itemgetter
+
+from compliance import iso_date
+from migrations import migrate
+from queries import (REPORT_KEYS, AsOfDate, Lookups, all_treatments_for_plant, as_tuples, julian_day,
+                     treatment_date_limits_in_effect, treatments_applied_without_limit_info)
+
+
+# Closed seasons can be moved out of AppliedTreatment into one file per season,
+# <directory>/season-<year>.gla:
+#
+#   header     magic, byte order, season, column count, row count
+#   directory  per column: name, array typecode, offset of its data
+#   data       the columns as fixed-width arrays, each 8-byte aligned
+#
+# Dates are day numbers (see queries.julian_day). Files written before dates
+# became integers (GLARCH01) hold julianday() values in a float column and
+# are still read, shifted by half a day.
+#
+# Rows are sorted by (plantId, date, id), so one plant's history is a
+# contiguous slice found by bisecting the plantId column. Files are mapped
+# read-only and the columns are memoryviews over the mapping; nothing is
+# copied or parsed when a season is opened.
+
+MAGIC = b'GLARCH02'
+MAGIC_JULIAN_DATES = b'GLARCH01'
+HEADER = struct.Struct('<8scxxxiIq')
+COLUMN = struct.Struct('<16scxxxxxxxQ')
+COLUMNS = (('id', 'q'), ('plantId', 'i'), ('treatmentTypeId', 'i'), ('date', 'i'))
+BYTE_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+
+def season_path(directory, season):
+    return os.path.join(directory, 'season-%d.gla' % season)
+
+def season_range(season):
+    # day numbers [first, last) of a calendar year
+    return julian_day(date(season, 1, 1)), julian_day(date(season + 1, 1, 1))
+
+
+class SeasonArchive:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.readers = 0
+        self.retired = False
+        with open(path, 'rb') as stream:
+            self.map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byte_order, self.season, column_count, self.rows = HEADER.unpack_from(self.map, 0)
+        if magic not in (MAGIC, MAGIC_JULIAN_DATES):
+            raise ValueError('%s is not a season archive' % path)
+        self.date_offset = 0.5 if magic == MAGIC_JULIAN_DATES else 0
+        if byte_order != BYTE_ORDER:
+            raise ValueError('%s was written on a machine with the other byte order' % path)
+        view = memoryview(self.map)
+        self.columns = {}
+        for position in range(column_count):
+            name, typecode, offset = COLUMN.unpack_from(self.map, HEADER.size + position * COLUMN.size)
+            typecode = typecode.decode()
+            size = array(typecode).itemsize
+            self.columns[name.rstrip(b'\0').decode()] = view[offset:offset + self.rows * size].cast(typecode)
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.map.close()
+
+    def release(self):
+        # ends a read started by Archive.season()
+        with self.lock:
+            self.readers -= 1
+            idle = self.retired and not self.readers
+        if idle:
+            self.close()
+
+    def retire(self):
+        # replaced by a newer file: closed once the last reader is done
+        with self.lock:
+            self.retired = True
+            idle = not self.readers
+        if idle:
+            self.close()
+
+    def plant_rows(self, plant_id, first_day=None, last_day=None):
+        # (date, id, treatmentTypeId) of one plant, by date, within [first_day, last_day]
+        plants = self.columns['plantId']
+        dates = self.columns['date']
+        lo = bisect_left(plants, plant_id)
+        hi = bisect_right(plants, plant_id, lo)
+        if first_day is not None:
+            lo = bisect_left(dates, first_day - self.date_offset, lo, hi)
+        if last_day is not None:
+            hi = bisect_right(dates, last_day - self.date_offset, lo, hi)
+        ids = self.columns['id']
+        treatment_types = self.columns['treatmentTypeId']
+        for position in range(lo, hi):
+            yield int(dates[position] + self.date_offset), ids[position], treatment_types[position]
+
+    def rows_between(self, first_day, last_day):
+        # (date, id, plantId, treatmentTypeId) of every plant within
+        # [first_day, last_day], by plant and date
+        plants = self.columns['plantId']
+        dates = self.columns['date']
+        ids = self.columns['id']
+        treatment_types = self.columns['treatmentTypeId']
+        first, last = first_day - self.date_offset, last_day - self.date_offset
+        lo = 0
+        while lo < self.rows:
+            plant_id = plants[lo]
+            hi = bisect_right(plants, plant_id, lo)
+            for position in range(bisect_left(dates, first, lo, hi), bisect_right(dates, last, lo, hi)):
+                yield int(dates[position] + self.date_offset), ids[position], plant_id, treatment_types[position]
+            lo = hi
+
+    def records(self):
+        records = zip(*(self.columns[name] for name, _ in COLUMNS))
+        if self.date_offset:
+            records = ((treatment_id, plant_id, treatment_type_id, int(day + self.date_offset))
+                       for treatment_id, plant_id, treatment_type_id, day in records)
+        return records
+
+
+def write_season_file(path, season, records):
+    # records: (id, plantId, treatmentTypeId, date) sorted by (plantId, date, id)
+    columns = [array(typecode) for _, typecode in COLUMNS]
+    for record in records:
+        for column, value in zip(columns, record):
+            column.append(value)
+    rows = len(columns[0])
+    offset = HEADER.size + len(COLUMNS) * COLUMN.size
+    directory = []
+    for (name, typecode), column in zip(COLUMNS, columns):
+        offset += -offset % 8
+        directory.append(COLUMN.pack(name.encode(), typecode.encode(), offset))
+        offset += rows * column.itemsize
+
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as stream:
+        stream.write(HEADER.pack(MAGIC, BYTE_ORDER, season, len(COLUMNS), rows))
+        stream.write(b''.join(directory))
+        for column in columns:
+            stream.write(b'\0' * (-stream.tell() % 8))
+            column.tofile(stream)
+        stream.flush()
+        os.fsync(stream.fileno())
+    os.replace(temporary, path)
+    return rows
+
+
+class Archive:
+    # The archived seasons of one database, opened on first use.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.opened = {}
+
+    def seasons(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = (name for name in os.listdir(self.directory) if name.startswith('season-') and name.endswith('.gla'))
+        return sorted(int(name[7:-4]) for name in names if name[7:-4].isdigit())
+
+    @contextmanager
+    def season(self, season):
+        # the opened file of a season, kept open while the block runs
+        path = season_path(self.directory, season)
+        stat = os.stat(path)
+        with self.lock:
+            archive = self.opened.get(season)
+            if archive is None or archive.file_id != (stat.st_ino, stat.st_mtime_ns):
+                # (re)written by an archive run; readers still holding the
+                # older mapping finish with it before it is closed
+                if archive is not None:
+                    archive.retire()
+                archive = SeasonArchive(path)
+                archive.file_id = (stat.st_ino, stat.st_mtime_ns)
+                self.opened[season] = archive
+            with archive.lock:
+                archive.readers += 1
+        try:
+            yield archive
+        finally:
+            archive.release()
+
+    def close(self):
+        # mappings still being read are closed when their readers are done
+        with self.lock:
+            opened, self.opened = self.opened, {}
+        for archive in opened.values():
+            archive.retire()
+
+    def overlapping(self, first_day, last_day):
+        # the archived seasons with days in [first_day, last_day]
+        seasons = []
+        for season in self.seasons():
+            season_first, season_last = season_range(season)
+            if season_last > first_day and season_first <= last_day:
+                seasons.append(season)
+        return seasons
+
+    def plant_rows(self, plant_id, first_day, last_day):
+        # (date, id, treatmentTypeId) of one plant over the archived seasons
+        # overlapping [first_day, last_day], by date
+        for season in self.overlapping(first_day, last_day):
+            with self.season(season) as archived:
+                yield from archived.plant_rows(plant_id, first_day, last_day)
+
+    def rows_between(self, first_day, last_day):
+        # (date, id, plantId, treatmentTypeId) within [first_day, last_day],
+        # by season, plant and date
+        for season in self.overlapping(first_day, last_day):
+            with self.season(season) as archived:
+                yield from archived.rows_between(first_day, last_day)
+
+
+def closed_season_problem(conn, season, today=None):
+    # why a season may not be archived yet, or None
+    today = today or date.today()
+    if season >= today.year:
+        return 'season %d is not over' % season
+    first_day, last_day = season_range(season)
+    QUERY = '''
+    SELECT max(max(repeatAllowedFrom, safeToConsumeFrom))
+    FROM TreatmentExpiry
+    WHERE date >= ? AND date < ?
+    '''
+    latest = as_tuples(conn).execute(QUERY, (first_day, last_day)).fetchone()[0]
+    if latest is not None and latest >= julian_day(today):
+        return 'limits of season %d are in effect until %s' % (season, iso_date(latest))
+    return None
+
+def unique_ids(records, key=itemgetter(0)):
+    # rows of a run whose delete did not commit are both archived and hot
+    last_id = None
+    for record in records:
+        if key(record) != last_id:
+            yield record
+        last_id = key(record)
+
+def archive_season(conn, directory, season):
+    # Writes the season's rows (merged with an earlier archive of the same
+    # season) to its file, then deletes them from AppliedTreatment in the
+    # same transaction; the derived tables follow through their triggers.
+    first_day, last_day = season_range(season)
+    path = season_path(directory, season)
+    os.makedirs(directory, exist_ok=True)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        hot = as_tuples(conn).execute('''
+        SELECT id, plantId, treatmentTypeId, date
+        FROM AppliedTreatment
+        WHERE date >= ? AND date < ?
+        ORDER BY plantId, date, id
+        ''', (first_day, last_day)).fetchall()
+        archived = []
+        if os.path.exists(path):
+            previous = SeasonArchive(path)
+            archived = list(previous.records())
+            previous.close()
+        records = merge(archived, hot, key=lambda row: (row[1], row[3], row[0]))
+        rows = write_season_file(path, season, unique_ids(records))
+        conn.execute('DELETE FROM AppliedTreatment WHERE date >= ? AND date < ?', (first_day, last_day))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return len(hot), rows
+
+
+def treatments_for_plant(conn, archive, lookups, as_of_date, plant_id, after=None, limit=-1):
+    # all_treatments_for_plant for a season that has been archived: the
+    # archived rows plus any entered for that season since, same columns and
+    # order
+    plants = {plant['id']: plant['description'] for plant in lookups.plants}
+    treatments = {treatment['id']: treatment['description'] for treatment in lookups.treatments}
+    try:
+        plant_id = int(plant_id)
+    except ValueError:
+        return []
+    if plant_id not in plants:
+        return []
+    as_of = AsOfDate(as_of_date)
+    first_day, last_day = as_of.season_start, as_of.day
+    after = tuple(after or (0, 0, 0))
+    result = [dict(row) for row in all_treatments_for_plant(conn, as_of_date, plant_id, after)]
+    for treatment_date, treatment_id, treatment_type_id in archive.plant_rows(plant_id, first_day, last_day):
+        if (treatment_date, treatment_type_id, treatment_id) > after:
+            result.append({
+                'id': treatment_id,
+                'sortDate': treatment_date,
+                'plantId': plant_id,
+                'plantDescription': plants[plant_id],
+                'treatmentTypeId': treatment_type_id,
+                'treatmentDescription': treatments.get(treatment_type_id),
+                'treatmentDate': iso_date(treatment_date),
+            })
+    result.sort(key=lambda row: (row['sortDate'], row['treatmentTypeId'], row['id']))
+    return result if limit < 0 else result[:limit]
+
+def plant_history(conn, archive, lookups, plant_id, first_day, last_day):
+    # every treatment of a plant between two ISO dates, archived or not
+    treatments = {treatment['id']: treatment['description'] for treatment in lookups.treatments}
+    first_day, last_day = AsOfDate(first_day).day, AsOfDate(last_day).day
+    QUERY = '''
+    SELECT date, id, treatmentTypeId
+    FROM AppliedTreatment
+    WHERE plantId = ? AND date >= ? AND date <= ?
+    ORDER BY date, id
+    '''
+    hot = as_tuples(conn).execute(QUERY, (plant_id, first_day, last_day))
+    archived = ((treatment_date, treatment_id, treatment_type_id, True)
+                for treatment_date, treatment_id, treatment_type_id in archive.plant_rows(plant_id, first_day, last_day))
+    for treatment_date, treatment_id, treatment_type_id, *from_archive in merge(archived, hot):
+        yield {'id': treatment_id, 'treatmentTypeId': treatment_type_id, 'treatment': treatments.get(treatment_type_id),
+               'date': iso_date(treatment_date), 'archived': bool(from_archive)}
+
+
+# The season-bounded reports for as-of dates that read rows of archived
+# seasons: the SQL report over the database merged with the same rows worked
+# out from the archive, in the report's order and with its keyset cursor.
+
+class ReportCatalog:
+    # what the report queries join an applied treatment with
+
+    def __init__(self, conn):
+        conn = as_tuples(conn)
+        self.plants = {plant_id: (description, species_id)
+                       for plant_id, description, species_id in conn.execute('SELECT id, description, speciesId FROM Plant')}
+        self.treatments = dict(conn.execute('SELECT id, description FROM TreatmentType'))
+        self.limits = {(treatment_type_id, species_id): limit for treatment_type_id, species_id, *limit in conn.execute(
+            'SELECT treatmentTypeId, speciesId, maxApplications, daysBetweenApplications, minDaysBeforeConsumption FROM SafetyLimit')}
+
+    def limit(self, plant_id, treatment_type_id):
+        # (maxApplications, daysBetweenApplications, minDaysBeforeConsumption) or None
+        plant = self.plants.get(plant_id)
+        return self.limits.get((treatment_type_id, plant[1])) if plant else None
+
+    def longest(self, position):
+        return max((limit[position] for limit in self.limits.values()), default=0)
+
+
+def archived_report_seasons(conn, archive, report, as_of_date):
+    # the archived seasons holding rows the report for as_of_date reads
+    seasons = archive.seasons()
+    if not seasons:
+        return []
+    as_of = AsOfDate(as_of_date)
+    if report == 'not_applicable':
+        return [season for season in seasons if season == as_of.season]
+    if report == 'no_info':
+        return [season for season in seasons if season >= as_of.season]
+    # treatments up to as_of_date whose limits may still run on it
+    QUERY = '''
+    SELECT max(max(daysBetweenApplications, minDaysBeforeConsumption))
+    FROM SafetyLimit
+    '''
+    longest = as_tuples(conn).execute(QUERY).fetchone()[0] or 0
+    return archive.overlapping(as_of.day - longest, as_of.day)
+
+def report_page(report, archived, live, limit):
+    # archived: rows in the report's order, made as the page needs them
+    key = itemgetter(*REPORT_KEYS[report])
+    rows = unique_ids(merge(archived, (dict(row) for row in live), key=key), key=itemgetter('id'))
+    return list(rows if limit < 0 else islice(rows, limit))
+
+def date_limits_in_effect(conn, archive, as_of_date, after=None, limit=-1):
+    catalog = ReportCatalog(conn)
+    day = AsOfDate(as_of_date).day
+    start = tuple(after or (0, 0))
+    found = []
+    for treatment_date, treatment_id, plant_id, treatment_type_id in archive.rows_between(day - catalog.longest(1), day):
+        safety = catalog.limit(plant_id, treatment_type_id)
+        if safety is not None and treatment_date + safety[1] >= day and (treatment_date, treatment_id) > start:
+            found.append((treatment_date, treatment_id, plant_id, treatment_type_id, treatment_date + safety[1]))
+    archived = ({
+        'id': treatment_id,
+        'sortDate': treatment_date,
+        'plant': catalog.plants[plant_id][0],
+        'treatment': catalog.treatments.get(treatment_type_id),
+        'treatmentDate': iso_date(treatment_date),
+        'safeToRepeatDate': iso_date(repeat_allowed_from),
+    } for treatment_date, treatment_id, plant_id, treatment_type_id, repeat_allowed_from in sorted(found))
+    return report_page('date_limits', archived, treatment_date_limits_in_effect(conn, as_of_date, after, limit), limit)
+
+def safe_to_consume(conn, archive, as_of_date, after=None, limit=-1):
+    # per plant the row safe_to_consume_dates picks: latest safe date, then
+    # latest treatment date, then highest id, whether archived or not
+    catalog = ReportCatalog(conn)
+    day = AsOfDate(as_of_date).day
+    after_plant = after[0] if after else None
+
+    def archived():
+        for treatment_date, treatment_id, plant_id, treatment_type_id in archive.rows_between(day - catalog.longest(2), day):
+            safety = catalog.limit(plant_id, treatment_type_id)
+            if safety is not None and treatment_date + safety[2] >= day:
+                yield treatment_date, treatment_id, plant_id, treatment_type_id, treatment_date + safety[2]
+    QUERY = '''
+    SELECT date, appliedTreatmentId, plantId, treatmentTypeId, safeToConsumeFrom
+    FROM TreatmentExpiry
+    WHERE date <= ? AND safeToConsumeFrom >= ?
+    '''
+    live = as_tuples(conn).execute(QUERY, (day, day))
+    latest = {}
+    for treatment_date, treatment_id, plant_id, treatment_type_id, safe_to_consume_from in chain(archived(), live):
+        if plant_id not in catalog.plants:
+            continue
+        plant = catalog.plants[plant_id][0]
+        if after_plant is not None and plant <= after_plant:
+            continue
+        key = (safe_to_consume_from, treatment_date, treatment_id)
+        if plant not in latest or key > latest[plant][0]:
+            latest[plant] = (key, treatment_type_id)
+    result = [{
+        'plant': plant,
+        'treatment': catalog.treatments.get(treatment_type_id),
+        'treatmentDate': iso_date(treatment_date),
+        'safeToConsumeDate': iso_date(safe_to_consume_from),
+    } for plant, ((safe_to_consume_from, treatment_date, _), treatment_type_id) in sorted(latest.items())]
+    return result if limit < 0 else result[:limit]
+
+def no_longer_applicable(conn, archive, as_of_date, after=None, limit=-1):
+    # counted from the archive and the rows of the season entered since
+    catalog = ReportCatalog(conn)
+    as_of = AsOfDate(as_of_date)
+    start = tuple(after or (0, 0))
+    treatments = {}
+    for treatment_date, treatment_id, plant_id, treatment_type_id in archive.rows_between(as_of.season_start, as_of.day):
+        treatments.setdefault((plant_id, treatment_type_id), set()).add(treatment_id)
+    QUERY = '''
+    SELECT id, plantId, treatmentTypeId
+    FROM AppliedTreatment
+    WHERE season = ? AND date <= ?
+    '''
+    for treatment_id, plant_id, treatment_type_id in as_tuples(conn).execute(QUERY, (as_of.season, as_of.day)):
+        treatments.setdefault((plant_id, treatment_type_id), set()).add(treatment_id)
+    result = []
+    for (plant_id, treatment_type_id), ids in sorted(treatments.items()):
+        safety = catalog.limit(plant_id, treatment_type_id)
+        if safety is None or len(ids) < safety[0] or (plant_id, treatment_type_id) <= start:
+            continue
+        if len(result) == limit:
+            break
+        result.append({
+            'plantId': plant_id,
+            'treatmentTypeId': treatment_type_id,
+            'plantDescription': catalog.plants[plant_id][0],
+            'treatmentDescription': catalog.treatments.get(treatment_type_id),
+            'treatments': len(ids),
+            'maxApplications': safety[0],
+        })
+    return result
+
+def applied_without_limit_info(conn, archive, as_of_date, after=None, limit=-1):
+    catalog = ReportCatalog(conn)
+    start = tuple(after or (0, 0, 0, 0))
+    found = []
+    for treatment_date, treatment_id, plant_id, treatment_type_id in archive.rows_between(AsOfDate(as_of_date).season_start,
+                                                                                          julian_day(date.max)):
+        if catalog.limit(plant_id, treatment_type_id) is None and (treatment_date, plant_id, treatment_type_id, treatment_id) > start:
+            found.append((treatment_date, plant_id, treatment_type_id, treatment_id))
+    archived = ({
+        'id': treatment_id,
+        'sortDate': treatment_date,
+        'plantId': plant_id,
+        'treatmentTypeId': treatment_type_id,
+        'treatment': catalog.treatments.get(treatment_type_id),
+        'date': iso_date(treatment_date),
+        'plant': catalog.plants[plant_id][0] if plant_id in catalog.plants else None,
+    } for treatment_date, plant_id, treatment_type_id, treatment_id in sorted(found))
+    return report_page('no_info', archived, treatments_applied_without_limit_info(conn, as_of_date, after, limit), limit)
+
+# report -> its query over the database and the archive
+ARCHIVED_REPORTS = {
+    'date_limits': date_limits_in_effect,
+    'safe': safe_to_consume,
+    'not_applicable': no_longer_applicable,
+    'no_info': applied_without_limit_info,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move closed seasons of applied treatments into columnar archive files.')
+    parser.add_argument('command', choices=('list', 'archive', 'history'))
+    parser.add_argument('argument', nargs='?', type=int, help='season to archive, or plant id for history')
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--directory', default='archive')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    archive = Archive(args.directory)
+    try:
+        migrate(conn)
+        if args.command == 'list':
+            for season in archive.seasons():
+                with archive.season(season) as archived:
+                    print(season, len(archived), 'rows', season_path(args.directory, season))
+            for season, count in conn.execute('SELECT season, COUNT(*) FROM AppliedTreatment GROUP BY season'):
+                print(season, count, 'rows in the database')
+        elif args.command == 'archive':
+            if args.argument is None:
+                parser.error('archive needs a season')
+            problem = closed_season_problem(conn, args.argument)
+            if problem:
+                print('not archived:', problem)
+                return 1
+            moved, rows = archive_season(conn, args.directory, args.argument)
+            print('season', args.argument, ':', moved, 'rows moved,', rows, 'rows in', season_path(args.directory, args.argument))
+        else:
+            if args.argument is None:
+                parser.error('history needs a plant id')
+            for row in plant_history(conn, archive, Lookups().refresh(conn), args.argument, '0001-01-01', '9999-12-31'):
+                print(row['date'], row['treatment'], row['id'], 'archived' if row['archived'] else '')
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+import asyncio
+import contextvars
+import functools
+import io
+import itertools
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.exceptions import HTTPException
+
+import app as gardenlog
+from shards import split_tenant
+
+
+class AsyncReportServer:
+    # ASGI front end for the Flask app. Report pages run their query on a
+    # bounded thread pool (sharing the app's connection pool) and are rendered
+    # with Jinja's async API on the event loop; identical report requests
+    # that arrive while one is being computed wait for that one instead of
+    # querying again. Everything else is passed to the WSGI app on the pool.
+
+    def __init__(self, app, workers=None):
+        self.app = app
+        self.workers = workers
+        self.executor = None
+        # from source: templates precompiled for the sync environment cannot
+        # be rendered asynchronously
+        self.jinja_env = app.jinja_env.overlay(enable_async=True, loader=app.create_global_jinja_loader())
+        self.in_flight = {}
+        self.requests = 0
+        self.coalesced = 0
+        self.delegated = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        if self.executor is None:
+            workers = self.workers or self.app.config['ASYNC_WORKERS'] or self.app.config['DB_POOL_SIZE']
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='gardenlog')
+        body = await read_body(receive)
+        environ = split_tenant(wsgi_environ(scope, body))
+        self.requests += 1
+
+        if scope['path'] == '/stats/async':
+            response = (200, [('Content-Type', 'application/json')], json.dumps(self.stats()).encode())
+        else:
+            endpoint, view_args = self.match(environ)
+            if scope['method'] == 'GET' and endpoint in gardenlog.REPORT_PAGES and b'stream=' not in scope['query_string']:
+                response = await self.coalesce((scope['path'], scope['query_string']),
+                                               lambda: self.report(environ, endpoint, view_args))
+            else:
+                self.delegated += 1
+                return await self.stream(send, environ)
+        await send_response(send, *response)
+
+    def match(self, environ):
+        try:
+            return self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None, None
+
+    async def run(self, function, *args, context=None, **kwargs):
+        # the Flask request and app contexts live in context variables, so
+        # the worker thread gets a copy of the caller's
+        if context is None:
+            context = contextvars.copy_context()
+        call = functools.partial(context.run, function, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def stream(self, send, environ):
+        # The WSGI response is sent chunk by chunk as the app produces it, so
+        # streamed pages, NDJSON and exports keep their flat memory use. Every
+        # step runs in one context: a stream_with_context generator pushes
+        # the request context on its first chunk and pops it on its last.
+        context = contextvars.copy_context()
+        status, headers, result, chunks = await self.run(start_wsgi, self.app.wsgi_app, environ, context=context)
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            while True:
+                chunk = await self.run(next, chunks, None, context=context)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await self.run(result.close, context=context)
+
+    async def coalesce(self, key, compute):
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+        future = asyncio.ensure_future(compute())
+        self.in_flight[key] = future
+        try:
+            return await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.in_flight.pop(key, None)
+            else:
+                future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+    async def report(self, environ, endpoint, view_args):
+        context = self.app.request_context(environ)
+        context.push()
+        try:
+            try:
+                template, report, limit, values = await self.run(gardenlog.REPORT_PAGES[endpoint], **view_args)
+                values = gardenlog.report_context(report, limit, values)
+                self.app.update_template_context(values)
+                started = time.perf_counter()
+                html = await self.jinja_env.get_template(template).render_async(values)
+                gardenlog.record_span('render', time.perf_counter() - started)
+                response = self.app.response_class(html, mimetype='text/html')
+            except HTTPException as error:
+                response = error.get_response(environ)
+            return response.status_code, list(response.headers.items()), response.get_data()
+        finally:
+            context.pop()
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def stats(self):
+        return {'requests': self.requests, 'coalesced': self.coalesced, 'delegated': self.delegated,
+                'in_flight': len(self.in_flight)}
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+def start_wsgi(wsgi_app, environ):
+    # (status, headers, WSGI result, iterator over its body)
+    started = []
+
+    def start_response(status, headers, exc_info=None):
+        started[:] = [int(status.split(' ', 1)[0]), headers]
+
+    result = wsgi_app(environ, start_response)
+    chunks = iter(result)
+    if not started:
+        # start_response may wait for the first chunk
+        chunks = itertools.chain([next(chunks, b'')], chunks)
+    return started[0], started[1], result, chunks
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = AsyncReportServer(gardenlog.app)
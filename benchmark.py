@@ -0,0 +1,278 @@
+import argparse
+import collections
+import json
+import os
+import random
+import resource
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import queries
+from migrations import migrate
+from queries import julian_day
+
+
+def generate_garden(conn, plants=10000, species=200, treatment_types=100, treatments=5000000, years=10,
+                    last_year=None, limit_coverage=0.8, seed=0, batch_size=10000):
+    # Builds a reproducible synthetic garden: every treatment type has a safety
+    # limit for roughly limit_coverage of the species, and applications are
+    # spread over the growing season (March to October) of each year.
+    rng = random.Random(seed)
+    last_year = last_year or date.today().year
+    first_year = last_year - years + 1
+    migrate(conn)
+    with conn:
+        conn.executemany('INSERT INTO PlantSpecies(id, name) VALUES(?,?)',
+                         [(i, 'species %d' % i) for i in range(1, species + 1)])
+        conn.executemany('INSERT INTO Plant(id, speciesId, description) VALUES(?,?,?)',
+                         [(i, rng.randint(1, species), 'plant %d' % i) for i in range(1, plants + 1)])
+        conn.executemany('INSERT INTO TreatmentType(id, description) VALUES(?,?)',
+                         [(i, 'treatment %d' % i) for i in range(1, treatment_types + 1)])
+        conn.executemany('INSERT INTO SafetyLimit(treatmentTypeId,speciesId,maxApplications,daysBetweenApplications,applyBefore,minDaysBeforeConsumption) VALUES(?,?,?,?,?,?)',
+                         [(t, s, rng.choice((1, 2, 3, 4, 6, 99)), rng.choice((0, 7, 8, 10, 14, 199)), 'N/A', rng.choice((0, 3, 7, 14, 21, 28)))
+                          for t in range(1, treatment_types + 1) for s in range(1, species + 1) if rng.random() < limit_coverage])
+
+    season_days = 245
+    batch = []
+    for _ in range(treatments):
+        day = date(rng.randint(first_year, last_year), 3, 1) + timedelta(days=rng.randrange(season_days))
+        batch.append((rng.randint(1, treatment_types), rng.randint(1, plants), julian_day(day)))
+        if len(batch) >= batch_size:
+            with conn:
+                conn.executemany('INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,?)', batch)
+            batch.clear()
+    if batch:
+        with conn:
+            conn.executemany('INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,?)', batch)
+    conn.execute('ANALYZE')
+    return {'plants': plants, 'species': species, 'treatment_types': treatment_types, 'treatments': treatments,
+            'first_year': first_year, 'last_year': last_year, 'seed': seed}
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def summarize(latencies, rows, peak_memory):
+    total = sum(latencies)
+    return {
+        'runs': len(latencies),
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p90_ms': percentile(latencies, 0.90) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'rows': rows,
+        'rows_per_sec': rows / total if total else 0.0,
+        'peak_python_memory_bytes': peak_memory,
+    }
+
+def measure(call, arguments):
+    # tracemalloc slows every allocation down, so the calls are timed in an
+    # untraced pass and the peak comes from a second, traced pass
+    arguments = list(arguments)
+    latencies = []
+    rows = 0
+    for args in arguments:
+        started = time.perf_counter()
+        rows += call(*args)
+        latencies.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        for args in arguments:
+            call(*args)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return summarize(latencies, rows, peak_memory)
+
+
+def benchmark_cases(rng, dataset):
+    import app
+
+    def random_date():
+        day = date(rng.randint(dataset['first_year'], dataset['last_year']), 3, 1) + timedelta(days=rng.randrange(245))
+        return day.isoformat()
+
+    def random_plant():
+        return rng.randint(1, dataset['plants'])
+
+    def random_treatment():
+        return rng.randint(1, dataset['treatment_types'])
+
+    query_cases = [
+        ('treatment_date_limits_in_effect', queries.treatment_date_limits_in_effect, lambda: (random_date(),)),
+        ('safe_to_consume_dates', queries.safe_to_consume_dates, lambda: (random_date(),)),
+        ('treatments_no_longer_applicable', queries.treatments_no_longer_applicable, lambda: (random_date(),)),
+        ('treatments_applied_without_limit_info', queries.treatments_applied_without_limit_info, lambda: (random_date(),)),
+        ('all_limit_info_for_treatment', queries.all_limit_info_for_treatment, lambda: (random_treatment(),)),
+        ('all_treatments_for_plant', queries.all_treatments_for_plant, lambda: (random_date(), random_plant())),
+    ]
+    routes = [
+        ('/', lambda: ()),
+        ('/date_limits/%s', lambda: (random_date(),)),
+        ('/safe/%s', lambda: (random_date(),)),
+        ('/not_applicable/%s', lambda: (random_date(),)),
+        ('/no_info/%s', lambda: (random_date(),)),
+        ('/treatment_info/%s', lambda: (random_treatment(),)),
+        ('/plant_info/%s/%s', lambda: (random_date(), random_plant())),
+        ('/api/v1/export?plant=%s', lambda: (random_plant(),)),
+        ('/api/v1/search?q=plant+%s', lambda: (random_plant(),)),
+    ]
+    return app, query_cases, routes
+
+# Runs in a fresh interpreter: the time to import the app, create it (and warm
+# it up, when the config asks for it) and serve a first request.
+STARTUP_PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+response = application.test_client().get(sys.argv[2])
+finished = time.perf_counter()
+warm_up = application.extensions['startup']['warm_up']
+print(json.dumps({'import': imported - started, 'create_app': created - imported, 'first_request': finished - created,
+                  'warm_up': warm_up and warm_up['seconds'], 'status': response.status_code}))
+'''
+
+def measure_startup(config, url, runs):
+    samples = collections.defaultdict(list)
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', STARTUP_PROBE, json.dumps(config), url], check=True, capture_output=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), text=True).stdout
+        probe = json.loads(output.splitlines()[-1])
+        if probe.pop('status') != 200:
+            raise RuntimeError('%s returned an error on startup' % url)
+        for name, seconds in probe.items():
+            if seconds is not None:
+                samples[name].append(seconds)
+    results = {}
+    for name, latencies in samples.items():
+        summary = summarize(latencies, 0, 0)
+        for key in ('rows', 'rows_per_sec', 'peak_python_memory_bytes'):
+            summary.pop(key)
+        results[name] = summary
+    return results
+
+def run_benchmarks(database, dataset, runs=20, seed=0, cache=False, startup_runs=5):
+    rng = random.Random(seed)
+    app, query_cases, routes = benchmark_cases(rng, dataset)
+    results = {'queries': {}, 'routes': {}, 'startup': {}}
+
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    for name, query, make_args in query_cases:
+        results['queries'][name] = measure(lambda *args: len(query(conn, *args).fetchall()),
+                                           [make_args() for _ in range(runs)])
+        results['queries'][name + ' (tuples)'] = measure(lambda *args: len(query(queries.as_tuples(conn), *args).fetchall()),
+                                                         [make_args() for _ in range(runs)])
+    conn.close()
+
+    config = {'DATABASE': os.path.abspath(database), 'REPORT_CACHE_ENABLED': cache}
+    client = app.create_app(config).test_client()
+
+    def get(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %s' % (url, response.status_code))
+        return len(response.data)
+
+    for pattern, make_args in routes:
+        summary = measure(lambda *args: get(pattern % args), [make_args() for _ in range(runs)])
+        summary['response_bytes'] = summary.pop('rows')
+        summary.pop('rows_per_sec')
+        results['routes'][pattern.replace('%s', '<arg>')] = summary
+
+    # cold: the first request pays for connecting, loading and compiling;
+    # warmed: create_app() did that before serving
+    url = '/date_limits/%s' % routes[1][1]()
+    for name, settings in (('cold', {}), ('warmed', {'WARM_UP': True}),
+                           ('precompiled', {'WARM_UP': True, 'PRECOMPILE_TEMPLATES': True})):
+        for step, summary in measure_startup(dict(config, **settings), url, startup_runs).items():
+            results['startup']['%s (%s)' % (step, name)] = summary
+    return results
+
+
+def compare(baseline, current, threshold=1.2):
+    # prints p50 ratios; returns the cases that got slower than threshold
+    regressions = []
+    for section in ('queries', 'routes', 'startup'):
+        for name, result in current.get(section, {}).items():
+            before = baseline.get(section, {}).get(name)
+            if before is None:
+                continue
+            ratio = result['p50_ms'] / before['p50_ms'] if before['p50_ms'] else float('inf')
+            print('%-8s %-40s %9.3f ms -> %9.3f ms  x%.2f' % (section, name, before['p50_ms'], result['p50_ms'], ratio))
+            if ratio > threshold:
+                regressions.append((section, name, ratio))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic garden and benchmark the gardenlog queries and routes.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='create a synthetic database')
+    generate.add_argument('--database', default='bench.db')
+    generate.add_argument('--plants', type=int, default=10000)
+    generate.add_argument('--species', type=int, default=200)
+    generate.add_argument('--treatment-types', type=int, default=100)
+    generate.add_argument('--treatments', type=int, default=5000000)
+    generate.add_argument('--years', type=int, default=10)
+    generate.add_argument('--seed', type=int, default=0)
+
+    run = subparsers.add_parser('run', help='time every query function and route')
+    run.add_argument('--database', default='bench.db')
+    run.add_argument('--runs', type=int, default=20)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--cache', action='store_true', help='keep the report cache enabled for the route timings')
+    run.add_argument('--startup-runs', type=int, default=5, help='fresh processes started to time startup')
+    run.add_argument('--output', default='benchmark-results.json')
+
+    diff = subparsers.add_parser('compare', help='compare two result files')
+    diff.add_argument('baseline')
+    diff.add_argument('current')
+    diff.add_argument('--threshold', type=float, default=1.2)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        if os.path.exists(args.database):
+            parser.error('%s already exists' % args.database)
+        conn = sqlite3.connect(args.database)
+        started = time.perf_counter()
+        dataset = generate_garden(conn, args.plants, args.species, args.treatment_types, args.treatments, args.years, seed=args.seed)
+        conn.execute('CREATE TABLE BenchmarkDataset (settings TEXT NOT NULL)')
+        conn.execute('INSERT INTO BenchmarkDataset(settings) VALUES(?)', (json.dumps(dataset),))
+        conn.commit()
+        conn.close()
+        print('generated', args.database, 'in %.1fs' % (time.perf_counter() - started), dataset)
+    elif args.command == 'run':
+        conn = sqlite3.connect(args.database)
+        dataset = json.loads(conn.execute('SELECT settings FROM BenchmarkDataset').fetchone()[0])
+        conn.close()
+        results = run_benchmarks(args.database, dataset, args.runs, args.seed, args.cache, args.startup_runs)
+        results.update(dataset=dataset, runs=args.runs, sqlite_version=sqlite3.sqlite_version,
+                       python_version=sys.version.split()[0], created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        for section in ('queries', 'routes', 'startup'):
+            for name, result in results[section].items():
+                print('%-8s %-40s p50 %9.3f ms  p99 %9.3f ms' % (section, name, result['p50_ms'], result['p99_ms']))
+        print('results written to', args.output)
+    else:
+        with open(args.baseline) as baseline, open(args.current) as current:
+            regressions = compare(json.load(baseline), json.load(current), args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
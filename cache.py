@@ -0,0 +1,155 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Tables each cached report reads from. An entry stays valid only as long as
+# the DataVersion counters of exactly these tables are unchanged.
+REPORT_TABLES = {
+    'date_limits': ('AppliedTreatment', 'SafetyLimit', 'Plant', 'TreatmentType'),
+    'safe': ('AppliedTreatment', 'SafetyLimit', 'Plant', 'TreatmentType'),
+    'not_applicable': ('AppliedTreatment', 'SafetyLimit', 'Plant', 'TreatmentType'),
+    'no_info': ('AppliedTreatment', 'SafetyLimit', 'Plant', 'TreatmentType'),
+    'treatment_info': ('TreatmentType', 'SafetyLimit', 'PlantSpecies'),
+    'plant_info': ('AppliedTreatment', 'Plant', 'TreatmentType'),
+    'calendar': ('AppliedTreatment', 'SafetyLimit', 'Plant', 'TreatmentType'),
+    'plan': ('AppliedTreatment', 'SafetyLimit', 'Plant'),
+    'plants': ('Plant',),
+    'treatments': ('TreatmentType',),
+    'history': ('AppliedTreatment', 'TreatmentType'),
+    'plant_search': ('Plant',),
+    'treatment_search': ('TreatmentType',),
+    'search': ('Plant', 'TreatmentType', 'PlantSpecies'),
+}
+
+
+def data_versions(conn):
+    return dict(conn.execute('SELECT tableName, version FROM DataVersion').fetchall())
+
+
+class SqliteCacheTier:
+    # Second cache level shared by all worker processes on a host. Values are
+    # pickled; stale entries are simply overwritten on the next store.
+
+    TABLE = '''
+    CREATE TABLE IF NOT EXISTS ReportCache (
+       key TEXT PRIMARY KEY,
+       versions TEXT NOT NULL,
+       expiresAt REAL NOT NULL,
+       value BLOB NOT NULL
+       ) WITHOUT ROWID
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute(self.TABLE)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, versions):
+        row = self._conn().execute('SELECT versions, expiresAt, value FROM ReportCache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] != versions or row[1] < time.time():
+            return None
+        return pickle.loads(row[2])
+
+    def put(self, key, versions, expires_at, value):
+        try:
+            self._conn().execute('INSERT OR REPLACE INTO ReportCache(key, versions, expiresAt, value) VALUES(?,?,?,?)',
+                                 (key, versions, expires_at, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        except sqlite3.OperationalError:
+            # another worker holds the write lock; the entry is only an optimization
+            pass
+
+
+class ReportCache:
+    # In-process LRU with a TTL, optionally backed by a shared tier. Entries
+    # are keyed by report name and arguments, and remember the data versions
+    # of the tables they were computed from.
+
+    def __init__(self, max_entries=256, ttl=300.0, shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get_or_compute(self, report, args, versions, compute):
+        key = '%s:%s' % (report, '/'.join(str(arg) for arg in args))
+        versions = ','.join('%s=%d' % (table, versions[table]) for table in REPORT_TABLES[report])
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_versions, expires_at, value = entry
+                if entry_versions == versions and expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if entry_versions != versions:
+                    self.stale += 1
+                else:
+                    self.expired += 1
+                del self._entries[key]
+
+        value = self.shared.get(key, versions) if self.shared is not None else None
+        if value is not None:
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            value = compute()
+            if self.shared is not None:
+                self.shared.put(key, versions, now + self.ttl, value)
+
+        with self._lock:
+            self._entries[key] = (versions, now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
+
+
+def cache_from_config(config):
+    shared_path = config.get('REPORT_CACHE_SHARED_PATH')
+    return ReportCache(max_entries=int(config.get('REPORT_CACHE_SIZE', 256)),
+                       ttl=float(config.get('REPORT_CACHE_TTL', 300.0)),
+                       shared=SqliteCacheTier(shared_path) if shared_path else None)
@@ -0,0 +1,271 @@
+import argparse
+import math
+import random
+import sqlite3
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import date
+from functools import lru_cache
+from heapq import merge
+
+import queries
+from queries import JULIAN_DAY_OF_ORDINAL_ZERO, AsOfDate
+
+
+def julian_day(as_of_date):
+    # day number of an ISO date; anything else raises ValueError
+    return AsOfDate(as_of_date).day
+
+@lru_cache(maxsize=4096)
+def iso_date(julian):
+    return date.fromordinal(math.floor(julian - JULIAN_DAY_OF_ORDINAL_ZERO)).isoformat()
+
+
+class IntervalIndex:
+    # Intervals [start, start + length] grouped by length, each group sorted
+    # by (start, id) in parallel arrays. The intervals of one length that
+    # contain a day are exactly those starting in [day - length, day], one
+    # contiguous slice, so a stabbing query is a bisect per group and a merge.
+
+    def __init__(self):
+        self.groups = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, start, interval_id, end):
+        starts, ids = self.groups.setdefault(end - start, (array('q'), array('q')))
+        self.size += 1
+        if not starts or (starts[-1], ids[-1]) < (start, interval_id):
+            starts.append(start)
+            ids.append(interval_id)
+            return
+        lo = bisect_left(starts, start)
+        position = bisect_left(ids, interval_id, lo, bisect_right(starts, start, lo))
+        starts.insert(position, start)
+        ids.insert(position, interval_id)
+
+    def stab(self, day):
+        # (start, id, end) of every interval containing day, ordered by (start, id)
+        def group(length, starts, ids):
+            for position in range(bisect_left(starts, day - length), bisect_right(starts, day)):
+                yield starts[position], ids[position], starts[position] + length
+        return merge(*(group(length, starts, ids) for length, (starts, ids) in self.groups.items()))
+
+
+class ComplianceEngine:
+    # In-process answers to the date limit, safe-to-consume and exhausted
+    # treatment reports. Everything is loaded once; refresh() picks up new
+    # applied treatments and reloads from scratch after any other write.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = None
+
+    def load(self, conn):
+        self.plants = {}
+        for plant_id, species_id, description in conn.execute('SELECT id, speciesId, description FROM Plant'):
+            self.plants[plant_id] = (species_id, description)
+        self.treatment_types = dict(conn.execute('SELECT id, description FROM TreatmentType'))
+        self.limits = {}
+        for treatment_type_id, species_id, max_applications, days_between, min_days in conn.execute(
+                'SELECT treatmentTypeId, speciesId, maxApplications, daysBetweenApplications, minDaysBeforeConsumption FROM SafetyLimit'):
+            self.limits[treatment_type_id, species_id] = (max_applications, days_between, min_days)
+
+        self.treatments = {}
+        self.repeat = IntervalIndex()
+        self.consume = IntervalIndex()
+        # season -> (plantId, treatmentTypeId) -> sorted application dates,
+        # and per season the date each pair ran out of applications, sorted
+        self.seasons = {}
+        self.exhausted = {}
+        self.last_id = 0
+        self.count = 0
+        for row in conn.execute('SELECT id, plantId, treatmentTypeId, date, season FROM AppliedTreatment ORDER BY date, id'):
+            self.add(*row)
+        self.versions = self.data_versions(conn)
+
+    def data_versions(self, conn):
+        return dict(conn.execute('SELECT tableName, version FROM DataVersion'))
+
+    def add(self, treatment_id, plant_id, treatment_type_id, treatment_date, season):
+        self.last_id = max(self.last_id, treatment_id)
+        self.count += 1
+        dates = self.seasons.setdefault(season, {}).setdefault((plant_id, treatment_type_id), array('q'))
+        if dates and dates[-1] > treatment_date:
+            insort(dates, treatment_date)
+        else:
+            dates.append(treatment_date)
+        self.exhausted.pop(season, None)
+
+        plant = self.plants.get(plant_id)
+        limit = plant and self.limits.get((treatment_type_id, plant[0]))
+        if limit is None:
+            return
+        self.treatments[treatment_id] = (plant_id, treatment_type_id)
+        self.repeat.add(treatment_date, treatment_id, treatment_date + limit[1])
+        self.consume.add(treatment_date, treatment_id, treatment_date + limit[2])
+
+    def exhausted_from(self, season):
+        if season not in self.exhausted:
+            entries = []
+            for (plant_id, treatment_type_id), dates in self.seasons.get(season, {}).items():
+                plant = self.plants.get(plant_id)
+                limit = plant and self.limits.get((treatment_type_id, plant[0]))
+                # the report lists pairs with at least one application and no
+                # fewer than maxApplications
+                needed = max(limit[0], 1) if limit else len(dates) + 1
+                if len(dates) >= needed:
+                    entries.append((dates[needed - 1], plant_id, treatment_type_id))
+            entries.sort()
+            self.exhausted[season] = (array('q', [entry[0] for entry in entries]), [entry[1:] for entry in entries])
+        return self.exhausted[season]
+
+    def refresh(self, conn):
+        with self.lock:
+            versions = self.data_versions(conn)
+            if versions == self.versions:
+                return False
+            changed = [table for table in versions if versions[table] != (self.versions or {}).get(table)]
+            if changed == ['AppliedTreatment']:
+                new_rows = conn.execute('SELECT id, plantId, treatmentTypeId, date, season FROM AppliedTreatment WHERE id > ? ORDER BY id',
+                                        (self.last_id,)).fetchall()
+                total = conn.execute('SELECT COUNT(*) FROM AppliedTreatment').fetchone()[0]
+                # every write bumps the counter once per row, so only pure
+                # inserts advance it by exactly the number of new rows
+                if versions['AppliedTreatment'] - self.versions['AppliedTreatment'] == len(new_rows) and self.count + len(new_rows) == total:
+                    for row in new_rows:
+                        self.add(*row)
+                    self.versions = versions
+                    return True
+            self.load(conn)
+            return True
+
+    def date_limits(self, as_of_date, after=None, limit=-1):
+        day = julian_day(as_of_date)
+        after = tuple(after or (0, 0))
+        result = []
+        with self.lock:
+            for treatment_date, treatment_id, repeat_allowed_from in self.repeat.stab(day):
+                if (treatment_date, treatment_id) <= after:
+                    continue
+                if len(result) == limit:
+                    break
+                plant_id, treatment_type_id = self.treatments[treatment_id]
+                result.append({
+                    'id': treatment_id,
+                    'sortDate': treatment_date,
+                    'plant': self.plants[plant_id][1],
+                    'treatment': self.treatment_types.get(treatment_type_id),
+                    'treatmentDate': iso_date(treatment_date),
+                    'safeToRepeatDate': iso_date(repeat_allowed_from),
+                })
+        return result
+
+    def safe_to_consume(self, as_of_date, after=None, limit=-1):
+        day = julian_day(as_of_date)
+        after_plant = after[0] if after else None
+        latest = {}
+        with self.lock:
+            for treatment_date, treatment_id, safe_to_consume_from in self.consume.stab(day):
+                plant_id, treatment_type_id = self.treatments[treatment_id]
+                plant = self.plants[plant_id][1]
+                if after_plant is not None and plant <= after_plant:
+                    continue
+                # ties go to the latest treatment, then the highest id, as in the SQL
+                key = (safe_to_consume_from, treatment_date, treatment_id)
+                if plant not in latest or key > latest[plant][0]:
+                    latest[plant] = (key, treatment_type_id)
+        result = [{
+            'plant': plant,
+            'treatment': self.treatment_types.get(treatment_type_id),
+            'treatmentDate': iso_date(treatment_date),
+            'safeToConsumeDate': iso_date(safe_to_consume_from),
+        } for plant, ((safe_to_consume_from, treatment_date, _), treatment_type_id) in sorted(latest.items())]
+        return result if limit < 0 else result[:limit]
+
+    def no_longer_applicable(self, as_of_date, after=None, limit=-1):
+        as_of = AsOfDate(as_of_date)
+        day, season = as_of.day, as_of.season
+        after = tuple(after or (0, 0))
+        result = []
+        with self.lock:
+            thresholds, keys = self.exhausted_from(season)
+            exhausted = sorted(key for key in keys[:bisect_right(thresholds, day)] if key > after)
+            dates = self.seasons.get(season, {})
+            for plant_id, treatment_type_id in exhausted if limit < 0 else exhausted[:limit]:
+                plant = self.plants[plant_id]
+                result.append({
+                    'plantId': plant_id,
+                    'treatmentTypeId': treatment_type_id,
+                    'plantDescription': plant[1],
+                    'treatmentDescription': self.treatment_types.get(treatment_type_id),
+                    'treatments': bisect_right(dates[plant_id, treatment_type_id], day),
+                    'maxApplications': self.limits[treatment_type_id, plant[0]][0],
+                })
+        return result
+
+    def stats(self):
+        return {'treatments': self.count, 'with_limits': len(self.repeat), 'seasons': len(self.seasons),
+                'repeat_lengths': len(self.repeat.groups), 'consume_lengths': len(self.consume.groups)}
+
+
+def engine_from_config(config):
+    if config['COMPLIANCE_ENGINE'] == 'memory':
+        return ComplianceEngine()
+    if config['COMPLIANCE_ENGINE'] != 'sql':
+        raise ValueError('COMPLIANCE_ENGINE must be sql or memory, not %r' % config['COMPLIANCE_ENGINE'])
+    return None
+
+
+def parity(conn, engine, as_of_dates):
+    # yields (report, as_of_date, sql rows, engine rows) for every mismatch
+    reports = [
+        ('date_limits', queries.treatment_date_limits_in_effect, engine.date_limits, ('id', 'plant', 'treatment', 'treatmentDate', 'safeToRepeatDate')),
+        ('safe', queries.safe_to_consume_dates, engine.safe_to_consume, ('plant', 'treatment', 'treatmentDate', 'safeToConsumeDate')),
+        ('not_applicable', queries.treatments_no_longer_applicable, engine.no_longer_applicable,
+         ('plantId', 'treatmentTypeId', 'plantDescription', 'treatmentDescription', 'treatments', 'maxApplications')),
+    ]
+    for as_of_date in as_of_dates:
+        for report, sql_query, engine_query, columns in reports:
+            expected = [tuple(row[column] for column in columns) for row in sql_query(conn, as_of_date)]
+            actual = [tuple(row[column] for column in columns) for row in engine_query(as_of_date)]
+            if expected != actual:
+                yield report, as_of_date, expected, actual
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the in-memory compliance engine with the SQL report queries.')
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--dates', type=int, default=50, help='number of random dates to check besides the application dates')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    conn.row_factory = sqlite3.Row
+    engine = ComplianceEngine()
+    engine.load(conn)
+    first, last = conn.execute('SELECT min(date), max(date) FROM AppliedTreatment').fetchone()
+    as_of_dates = set()
+    if first is not None:
+        rng = random.Random(args.seed)
+        treatment_dates = [iso_date(day) for day, in conn.execute('SELECT DISTINCT date FROM AppliedTreatment')]
+        as_of_dates.update(rng.sample(treatment_dates, min(args.dates, len(treatment_dates))))
+        as_of_dates.update(iso_date(rng.randint(first - 30, last + 30)) for _ in range(args.dates))
+    mismatches = 0
+    try:
+        for report, as_of_date, expected, actual in parity(conn, engine, sorted(as_of_dates)):
+            print(report, as_of_date, ': sql', len(expected), 'rows, engine', len(actual), 'rows')
+            for row in sorted(set(expected) ^ set(actual))[:10]:
+                print('   ', 'sql only' if row in expected else 'engine only', row)
+            mismatches += 1
+    finally:
+        conn.close()
+    print('checked', len(as_of_dates), 'dates:', 'OK' if not mismatches else '%d mismatches' % mismatches)
+    return 1 if mismatches else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -16000,
+}
+
+
+logger = logging.getLogger('gardenlog.db')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    # Hands out at most `size` sqlite connections; idle ones are kept open so
+    # their page cache survives between requests. Connections inherited over
+    # fork() are dropped and the pool starts afresh in the child process.
+
+    def __init__(self, database, size=5, timeout=10.0, pragmas=None, row_factory=sqlite3.Row, cached_statements=256, read_only=False):
+        self.database = database
+        self.read_only = read_only
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        self.row_factory = row_factory
+        self.cached_statements = cached_statements
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _connect(self):
+        if self.read_only:
+            # mode=ro: never takes a write lock; under WAL it reads the last
+            # committed snapshot while a writer is busy
+            database = 'file:%s?mode=ro' % urllib.parse.quote(os.path.abspath(self.database))
+        else:
+            database = self.database
+        conn = sqlite3.connect(database, timeout=self.timeout, check_same_thread=False,
+                               cached_statements=self.cached_statements, uri=self.read_only)
+        conn.row_factory = self.row_factory
+        for name, value in self.pragmas.items():
+            if not (self.read_only and name == 'journal_mode'):
+                conn.execute('PRAGMA %s = %s' % (name, value)).fetchall()
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if not self._idle and self._open >= self.size:
+                self.waits += 1
+                started = time.perf_counter()
+                got_one = self._available.wait_for(lambda: self._idle or self._open < self.size, self.timeout)
+                self.wait_time += time.perf_counter() - started
+                if not got_one:
+                    self.timeouts += 1
+                    raise PoolTimeout('no database connection available after %s seconds' % self.timeout)
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+            self._open += 1
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._available.notify()
+            raise
+
+    def release(self, conn):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.append(conn)
+            self._available.notify()
+
+    def discard(self, conn):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._open -= 1
+                self._available.notify()
+        conn.close()
+
+    def busy(self):
+        with self._lock:
+            return self._pid == os.getpid() and self._open > len(self._idle)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'timeouts': self.timeouts,
+                'read_only': self.read_only,
+            }
+
+
+def replica_path(database):
+    root, extension = os.path.splitext(database)
+    return root + '.replica' + (extension or '.db')
+
+
+class ReplicaRefresher(threading.Thread):
+    # Copies the database into a replica file with the online backup API every
+    # `interval` seconds, if anything was committed since the last copy. The
+    # copy is one transaction on the replica (kept in WAL mode), so readers of
+    # the replica keep their snapshot while it is replaced and never wait on
+    # the primary's writers.
+
+    def __init__(self, database, replica, interval=60.0):
+        super().__init__(name='gardenlog-replica', daemon=True)
+        self.database = database
+        self.replica = replica
+        self.interval = interval
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.source = None
+        self.data_version = None
+        self.copies = 0
+        self.errors = 0
+        self.last_copy = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.refresh()
+            except sqlite3.Error:
+                self.errors += 1
+                logger.exception('copying %s to %s failed', self.database, self.replica)
+
+    def refresh(self):
+        with self.lock:
+            if self.source is None:
+                self.source = sqlite3.connect(self.database, check_same_thread=False)
+            # PRAGMA data_version moves whenever another connection commits
+            data_version = self.source.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == self.data_version and os.path.exists(self.replica):
+                return False
+            started = time.perf_counter()
+            target = sqlite3.connect(self.replica)
+            try:
+                target.execute('PRAGMA journal_mode = WAL').fetchall()
+                self.source.backup(target)
+            finally:
+                target.close()
+            self.data_version = data_version
+            self.copies += 1
+            self.last_copy = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': time.perf_counter() - started}
+            return True
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        with self.lock:
+            if self.source is not None:
+                self.source.close()
+                self.source = None
+
+    def stats(self):
+        return {'database': self.database, 'replica': self.replica, 'interval': self.interval, 'alive': self.is_alive(),
+                'copies': self.copies, 'errors': self.errors, 'last_copy': self.last_copy}
+
+
+def pool_from_config(config, read_only=False):
+    pragmas = dict(DEFAULT_PRAGMAS)
+    pragmas['synchronous'] = config.get('DB_SYNCHRONOUS', pragmas['synchronous'])
+    pragmas['mmap_size'] = int(config.get('DB_MMAP_SIZE', pragmas['mmap_size']))
+    pragmas['cache_size'] = int(config.get('DB_CACHE_SIZE', pragmas['cache_size']))
+    return ConnectionPool(config.get('DATABASE', 'test.db'),
+                          size=int(config.get('DB_POOL_SIZE', 5)),
+                          timeout=float(config.get('DB_POOL_TIMEOUT', 10.0)),
+                          pragmas=pragmas,
+                          cached_statements=int(config.get('DB_STATEMENT_CACHE', 256)),
+                          read_only=read_only)
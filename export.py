@@ -0,0 +1,295 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+from contextlib import ExitStack
+from datetime import date
+from heapq import merge
+
+from archive import Archive, unique_ids
+from compliance import iso_date
+from migrations import migrate
+from queries import AsOfDate, as_tuples, julian_day
+
+
+# The full treatment history (AppliedTreatment plus archived seasons) joined
+# with Plant, PlantSpecies, TreatmentType and SafetyLimit, for regulators and
+# offline analysis. Rows come in (plantId, date, id) order: the database rows
+# are read from one cursor with fetchmany(), archived rows are merged in plant
+# by plant, and everything is written out in chunks of chunk_size rows, so
+# memory does not grow with the history. Because the order is made of row
+# columns, an export can be resumed after the last row received.
+
+COLUMNS = (
+    ('id', 'q'), ('date', 's'), ('plantId', 'i'), ('plant', 's'), ('speciesId', 'i'), ('species', 's'),
+    ('treatmentTypeId', 'i'), ('treatment', 's'), ('maxApplications', 'i'), ('daysBetweenApplications', 'i'),
+    ('minDaysBeforeConsumption', 'i'), ('applyBefore', 's'), ('safeToRepeatDate', 's'), ('safeToConsumeDate', 's'),
+    ('archived', 'b'),
+)
+
+def resume_key(row):
+    # (plantId, date, id)
+    return row[2], row[1], row[0]
+
+def parse_after(text):
+    # "<plantId>,<YYYY-MM-DD>,<id>" of the last row received
+    plant_id, treatment_date, treatment_id = text.split(',')
+    return int(plant_id), AsOfDate(treatment_date), int(treatment_id)
+
+
+def live_rows(conn, first_day, last_day, plant_ids, after, chunk_size):
+    # Row values over (plantId, season, date, id) follow the plant index;
+    # season is implied by date, so the order is (plantId, date, id). Unary +
+    # keeps the date range out of index selection: sorting a date range
+    # would hold back the first row until the whole range is read.
+    QUERY = '''
+    SELECT t.id, date(t.date), t.plantId, p.description, p.speciesId, s.name, t.treatmentTypeId, tt.description,
+           l.maxApplications, l.daysBetweenApplications, l.minDaysBeforeConsumption, l.applyBefore,
+           date(t.date + l.daysBetweenApplications), date(t.date + l.minDaysBeforeConsumption), 0
+    FROM AppliedTreatment t
+    LEFT JOIN Plant p
+    ON t.plantId = p.id
+    LEFT JOIN PlantSpecies s
+    ON p.speciesId = s.id
+    LEFT JOIN TreatmentType tt
+    ON t.treatmentTypeId = tt.id
+    LEFT JOIN SafetyLimit l
+    ON l.treatmentTypeId = t.treatmentTypeId AND l.speciesId = p.speciesId
+    WHERE (t.plantId, t.season, t.date, t.id) > (?, ?, ?, ?) AND t.plantId <= ? AND +t.date >= ? AND +t.date <= ?
+      AND (? IS NULL OR t.plantId IN (SELECT value FROM json_each(?)))
+    ORDER BY t.plantId, t.season, t.date, t.id
+    '''
+    # the requested plants bound the index range
+    first_plant, last_plant = (min(plant_ids), max(plant_ids)) if plant_ids else (0, 2 ** 63 - 1)
+    if after is None:
+        after = (first_plant, 0, 0, 0)
+    else:
+        plant_id, treatment_date, treatment_id = after
+        after = (plant_id, treatment_date.season, treatment_date.day, treatment_id)
+    ids = json.dumps(sorted(plant_ids)) if plant_ids is not None else None
+    cursor = as_tuples(conn).execute(QUERY, (*after, last_plant, first_day, last_day, ids, ids))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+def archived_rows(conn, archive, seasons, first_day, last_day, plant_ids, after):
+    # the same columns for the rows of archived seasons in [first_day, last_day]
+    conn = as_tuples(conn)
+    plants = {plant_id: (description, species_id, species) for plant_id, description, species_id, species in conn.execute(
+        'SELECT p.id, p.description, p.speciesId, s.name FROM Plant p LEFT JOIN PlantSpecies s ON p.speciesId = s.id')}
+    treatments = dict(conn.execute('SELECT id, description FROM TreatmentType'))
+    limits = {(treatment_type_id, species_id): limit for treatment_type_id, species_id, *limit in conn.execute(
+        'SELECT treatmentTypeId, speciesId, maxApplications, daysBetweenApplications, minDaysBeforeConsumption, applyBefore FROM SafetyLimit')}
+    after = after or (0, '', 0)
+    with ExitStack() as opened:
+        seasons = [opened.enter_context(archive.season(season)) for season in seasons]
+        for plant_id in sorted(plants if plant_ids is None else plants.keys() & set(plant_ids)):
+            if plant_id < after[0]:
+                continue
+            description, species_id, species = plants[plant_id]
+            for season in seasons:
+                for day, treatment_id, treatment_type_id in season.plant_rows(plant_id, first_day, last_day):
+                    treatment_date = iso_date(day)
+                    if (plant_id, treatment_date, treatment_id) <= after:
+                        continue
+                    max_applications, days_between, min_days, apply_before = limits.get((treatment_type_id, species_id), (None,) * 4)
+                    yield (treatment_id, treatment_date, plant_id, description, species_id, species, treatment_type_id,
+                           treatments.get(treatment_type_id), max_applications, days_between, min_days, apply_before,
+                           None if days_between is None else iso_date(day + days_between),
+                           None if min_days is None else iso_date(day + min_days), 1)
+
+def export_rows(conn, archive, first_day=None, last_day=None, plant_ids=None, after=None, chunk_size=5000):
+    # first_day, last_day: ISO dates (inclusive); after: parse_after() of the
+    # last row already exported
+    first_day = AsOfDate(first_day).day if first_day else 0
+    last_day = AsOfDate(last_day).day if last_day else julian_day(date.max)
+    rows = live_rows(conn, first_day, last_day, plant_ids, after, chunk_size)
+    seasons = archive.overlapping(first_day, last_day)
+    if not seasons:
+        return rows
+    rows = merge(archived_rows(conn, archive, seasons, first_day, last_day, plant_ids, after), rows, key=resume_key)
+    # a row archived by a run whose delete did not commit is also still live
+    return unique_ids(rows)
+
+
+def csv_header():
+    return csv_chunk([[name for name, _ in COLUMNS]])
+
+def csv_chunk(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+# Columnar files, <name>.glx, are written chunk by chunk like Parquet row
+# groups, since the row count is not known up front:
+#
+#   header     magic, byte order, column count
+#   directory  per column: name, array typecode ('s' for UTF-8 text)
+#   row group  row count, then per column chunk:
+#              numbers  a flag byte; when it is 1, one validity byte per row
+#                       follows (NULLs are stored as 0); then the values as a
+#                       fixed-width array
+#              text     dictionary size, its int32 end offsets and UTF-8 data,
+#                       then an int32 dictionary index per row (-1 for NULL)
+
+MAGIC = b'GLEXPT01'
+HEADER = struct.Struct('<8scxxxI')
+COLUMN = struct.Struct('<24sc')
+COUNT = struct.Struct('<I')
+BYTE_ORDER = b'<' if sys.byteorder == 'little' else b'>'
+
+def columnar_header():
+    return HEADER.pack(MAGIC, BYTE_ORDER, len(COLUMNS)) + b''.join(
+        COLUMN.pack(name.encode(), typecode.encode()) for name, typecode in COLUMNS)
+
+def columnar_chunk(rows):
+    parts = [COUNT.pack(len(rows))]
+    for position, (_, typecode) in enumerate(COLUMNS):
+        values = [row[position] for row in rows]
+        if typecode == 's':
+            dictionary = {}
+            codes = array('i', (-1 if value is None else dictionary.setdefault(value, len(dictionary)) for value in values))
+            encoded = [value.encode() for value in dictionary]
+            offsets = array('i')
+            end = 0
+            for value in encoded:
+                end += len(value)
+                offsets.append(end)
+            parts += [COUNT.pack(len(dictionary)), offsets.tobytes(), *encoded, codes.tobytes()]
+        elif None in values:
+            parts += [b'\1', bytes(value is not None for value in values),
+                      array(typecode, (0 if value is None else value for value in values)).tobytes()]
+        else:
+            parts += [b'\0', array(typecode, values).tobytes()]
+    return b''.join(parts)
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError('truncated export file')
+    return data
+
+def read_array(stream, typecode, count):
+    values = array(typecode)
+    values.frombytes(read_exactly(stream, count * values.itemsize))
+    return values
+
+def read_columnar(stream):
+    # yields each row group as {column name: list of values}
+    magic, byte_order, column_count = HEADER.unpack(read_exactly(stream, HEADER.size))
+    if magic != MAGIC:
+        raise ValueError('not a columnar export')
+    if byte_order != BYTE_ORDER:
+        raise ValueError('export was written on a machine with the other byte order')
+    columns = []
+    for _ in range(column_count):
+        name, typecode = COLUMN.unpack(read_exactly(stream, COLUMN.size))
+        columns.append((name.rstrip(b'\0').decode(), typecode.decode()))
+    while True:
+        head = stream.read(COUNT.size)
+        if not head:
+            return
+        rows, = COUNT.unpack(head)
+        group = {}
+        for name, typecode in columns:
+            if typecode == 's':
+                size, = COUNT.unpack(read_exactly(stream, COUNT.size))
+                offsets = read_array(stream, 'i', size)
+                data = read_exactly(stream, offsets[-1] if size else 0)
+                dictionary = [data[start:end].decode() for start, end in zip([0, *offsets], offsets)]
+                group[name] = [None if code < 0 else dictionary[code] for code in read_array(stream, 'i', rows)]
+            elif read_exactly(stream, 1) == b'\1':
+                valid = read_exactly(stream, rows)
+                group[name] = [value if flag else None for value, flag in zip(read_array(stream, typecode, rows), valid)]
+            else:
+                group[name] = read_array(stream, typecode, rows).tolist()
+        yield group
+
+# format: (header, chunk writer, mimetype, file extension)
+FORMATS = {
+    'csv': (csv_header, csv_chunk, 'text/csv', 'csv'),
+    'columnar': (columnar_header, columnar_chunk, 'application/octet-stream', 'glx'),
+}
+
+def export_chunks(rows, format, chunk_size=5000, header=True):
+    # (data, last row) per chunk of rows, preceded by (header, None)
+    write_header, write_chunk = FORMATS[format][:2]
+    if header:
+        yield write_header(), None
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield write_chunk(chunk), chunk[-1]
+            chunk = []
+    if chunk:
+        yield write_chunk(chunk), chunk[-1]
+
+
+def export_file(conn, archive, path, format, first_day=None, last_day=None, plant_ids=None, chunk_size=5000, resume=False):
+    # Writes the export to path. After every chunk <path>.resume records the
+    # file size and the last row written; with resume=True an interrupted
+    # export is truncated to that size and continued with the same filters.
+    state_path = path + '.resume'
+    if resume and os.path.exists(state_path):
+        with open(state_path) as stream:
+            state = json.load(stream)
+        if os.path.getsize(path) < state['offset']:
+            raise ValueError('%s is shorter than its resume point' % path)
+        output = open(path, 'r+b')
+        output.truncate(state['offset'])
+        output.seek(state['offset'])
+    else:
+        state = {'format': format, 'from': first_day, 'to': last_day, 'plants': plant_ids, 'offset': 0, 'after': None}
+        output = open(path, 'wb')
+    after = parse_after(state['after']) if state['after'] else None
+    with output:
+        for data, last_row in export_chunks(export_rows(conn, archive, state['from'], state['to'], state['plants'], after, chunk_size),
+                                            state['format'], chunk_size, header=after is None and state['offset'] == 0):
+            output.write(data)
+            output.flush()
+            state['offset'] = output.tell()
+            if last_row is not None:
+                state['after'] = '%d,%s,%d' % resume_key(last_row)
+            with open(state_path + '.tmp', 'w') as stream:
+                json.dump(state, stream)
+            os.replace(state_path + '.tmp', state_path)
+    os.remove(state_path)
+    return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the applied treatment history with plant, species, treatment and safety limit columns.')
+    parser.add_argument('output', help='file to write')
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--archive', default='archive', help='directory of archived seasons')
+    parser.add_argument('--format', choices=sorted(FORMATS), default=None, help='defaults to the file extension (.csv or .glx)')
+    parser.add_argument('--from', dest='first_day', type=date.fromisoformat, help='first treatment date')
+    parser.add_argument('--to', dest='last_day', type=date.fromisoformat, help='last treatment date')
+    parser.add_argument('--plant', type=int, action='append', help='plant id to export (default all)')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted export of output')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    started = time.perf_counter()
+    try:
+        migrate(conn)
+        state = export_file(conn, Archive(args.archive), args.output, args.format or ('csv' if args.output.endswith('.csv') else 'columnar'),
+                            args.first_day and args.first_day.isoformat(), args.last_day and args.last_day.isoformat(), args.plant,
+                            args.chunk_size, args.resume)
+    finally:
+        conn.close()
+    print(args.output, ':', state['offset'], 'bytes in %.2fs' % (time.perf_counter() - started), '(last row %s)' % state['after'])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
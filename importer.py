@@ -0,0 +1,147 @@
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+import time
+from datetime import date
+
+from migrations import migrate
+from queries import Lookups
+
+
+# dates are stored as day numbers (see queries.julian_day)
+INSERT_TREATMENT = 'INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,CAST(julianday(?) + 0.5 AS INTEGER))'
+# rejected records are counted; only the first few are kept to be reported
+REJECTED_SAMPLES = 20
+
+
+def read_csv(stream):
+    for record in csv.DictReader(stream):
+        yield record
+
+def read_jsonl(stream):
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # rejected by import_treatments like any other bad record
+                yield line.rstrip('\n')
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+def treatment_date(value):
+    # the date as YYYY-MM-DD, or None; date.fromisoformat also takes forms
+    # julianday() reads as NULL ('20220801', '2022-W31-1')
+    try:
+        return date.fromisoformat(value).isoformat()
+    except (TypeError, ValueError):
+        return None
+
+def record_values(names, record):
+    # (treatmentTypeId, plantId, date) to insert for a record; ValueError
+    # says why it cannot be stored
+    if not isinstance(record, dict):
+        raise ValueError('not a record')
+    missing = [field for field in ('plant', 'treatment', 'date') if not (isinstance(record.get(field), str) and record[field])]
+    if missing:
+        raise ValueError('missing %s' % ', '.join(missing))
+    treatment_type_id = names.treatment_ids.get(record['treatment'])
+    plant_id = names.plant_ids.get(record['plant'])
+    if treatment_type_id is None or plant_id is None:
+        raise ValueError('unknown %s' % ('treatment' if treatment_type_id is None else 'plant'))
+    day = treatment_date(record['date'])
+    if day is None:
+        raise ValueError('date must be YYYY-MM-DD')
+    return treatment_type_id, plant_id, day
+
+
+class ImportStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imported = 0
+        self.rejected = 0
+        self.rejected_samples = []
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    @property
+    def rows_per_second(self):
+        return self.imported / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return '%d rows imported, %d rejected in %.2fs (%.0f rows/s)' % (self.imported, self.rejected, self.elapsed, self.rows_per_second)
+
+
+def import_treatments(conn, records, batch_size=1000, transaction_size=50000, progress=None):
+    # Rows are written with executemany in batches of batch_size and committed
+    # every transaction_size rows, so a failure only loses the open transaction.
+    # descriptions are resolved from in-memory maps, not per row
+    names = Lookups().refresh(conn)
+    stats = ImportStats()
+    batch = []
+    uncommitted = 0
+
+    def flush():
+        nonlocal uncommitted
+        conn.executemany(INSERT_TREATMENT, batch)
+        stats.imported += len(batch)
+        uncommitted += len(batch)
+        batch.clear()
+        if uncommitted >= transaction_size:
+            conn.commit()
+            uncommitted = 0
+            if progress is not None:
+                progress(stats)
+
+    for line_number, record in enumerate(records, 1):
+        try:
+            batch.append(record_values(names, record))
+        except ValueError as problem:
+            stats.rejected += 1
+            if len(stats.rejected_samples) < REJECTED_SAMPLES:
+                stats.rejected_samples.append((line_number, record, str(problem)))
+            continue
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    conn.commit()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import applied treatments from CSV or JSON lines (columns: plant, treatment, date).')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--format', choices=sorted(READERS), default=None, help='defaults to the file extension')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--transaction-size', type=int, default=50000)
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    migrate(conn)
+    rejected = 0
+    try:
+        for path in args.files:
+            reader = READERS[args.format or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')]
+            with open(path, newline='') as stream:
+                stats = import_treatments(conn, reader(stream), args.batch_size, args.transaction_size,
+                                          progress=lambda stats: print(path, ':', stats, file=sys.stderr))
+            for line_number, record, problem in stats.rejected_samples:
+                print('WARNING:', path, 'record', line_number, 'ignored (%s):' % problem, record, file=sys.stderr)
+            print(path, ':', stats)
+            rejected += stats.rejected
+    finally:
+        conn.close()
+    return 1 if rejected else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
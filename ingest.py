@@ -0,0 +1,153 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from importer import INSERT_TREATMENT, record_values
+from queries import Lookups
+
+
+logger = logging.getLogger('gardenlog.ingest')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class TreatmentWriter(threading.Thread):
+    # The only thread writing applied treatments posted to the API. Requests
+    # queue their records and wait on a Future per record; the writer takes
+    # whatever arrived within max_delay seconds (up to batch_size records)
+    # and commits it as one transaction, so a burst of requests costs a
+    # handful of fsyncs instead of one each. submit() refuses a request
+    # outright when its records do not fit in the queue.
+
+    def __init__(self, pool, queue_size=10000, batch_size=500, max_delay=0.005, on_commit=None):
+        super().__init__(name='gardenlog-ingest', daemon=True)
+        self.pool = pool
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.pid = os.getpid()
+        self.submit_lock = threading.Lock()
+        self.lookups = Lookups()
+        self.batches = 0
+        self.created = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.refused = 0
+        self.failed = 0
+
+    def submit(self, records):
+        # records: dicts with clientId, plant, treatment and date (ISO)
+        futures = [Future() for _ in records]
+        with self.submit_lock:
+            # the writer only ever takes items out, so the check holds until
+            # the records are queued
+            if self.queue.qsize() + len(records) > self.queue.maxsize:
+                self.refused += 1
+                raise QueueFull('%d records queued' % self.queue.qsize())
+            for record, future in zip(records, futures):
+                self.queue.put_nowait((record, future))
+        return futures
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.write(batch)
+                    return
+                batch.append(item)
+            self.write(batch)
+
+    def stop(self):
+        # records queued before stop() are still written
+        self.queue.put(None)
+
+    def busy(self):
+        return self.queue.qsize() > 0
+
+    def write(self, batch):
+        try:
+            conn = self.pool.acquire()
+            try:
+                results = self.insert(conn, [record for record, _ in batch])
+            finally:
+                self.pool.release(conn)
+        except Exception as error:
+            self.failed += len(batch)
+            logger.exception('writing %d treatments failed', len(batch))
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        self.batches += 1
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+        if self.on_commit is not None and any(result['status'] == 'created' for result in results):
+            self.on_commit()
+
+    def insert(self, conn, records):
+        # a record that cannot be stored is rejected on its own; it never
+        # rolls back the others in the batch
+        names = self.lookups.refresh(conn)
+        checked = []
+        for record in records:
+            try:
+                checked.append((record_values(names, record), None))
+            except ValueError as problem:
+                checked.append((None, str(problem)))
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            client_ids = sorted({record['clientId'] for record in records})
+            known = dict(conn.execute('SELECT clientId, appliedTreatmentId FROM TreatmentSubmission WHERE clientId IN (%s)'
+                                      % ','.join('?' * len(client_ids)), client_ids).fetchall())
+            results = []
+            for record, (values, problem) in zip(records, checked):
+                client_id = record['clientId']
+                if client_id in known:
+                    self.duplicates += 1
+                    results.append({'clientId': client_id, 'status': 'duplicate', 'id': known[client_id]})
+                    continue
+                if problem is not None:
+                    self.rejected += 1
+                    results.append({'clientId': client_id, 'status': 'rejected', 'error': problem})
+                    continue
+                conn.execute('SAVEPOINT record')
+                try:
+                    treatment_id = conn.execute(INSERT_TREATMENT + ' RETURNING id', values).fetchone()[0]
+                    conn.execute('INSERT INTO TreatmentSubmission(clientId, appliedTreatmentId) VALUES(?,?)', (client_id, treatment_id))
+                except sqlite3.IntegrityError as error:
+                    conn.execute('ROLLBACK TO record')
+                    conn.execute('RELEASE record')
+                    self.rejected += 1
+                    results.append({'clientId': client_id, 'status': 'rejected', 'error': str(error)})
+                    continue
+                conn.execute('RELEASE record')
+                # a retry queued behind the original in the same batch
+                known[client_id] = treatment_id
+                self.created += 1
+                results.append({'clientId': client_id, 'status': 'created', 'id': treatment_id})
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return results
+
+    def stats(self):
+        return {'alive': self.is_alive(), 'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize, 'batches': self.batches,
+                'created': self.created, 'duplicates': self.duplicates, 'rejected': self.rejected, 'refused': self.refused,
+                'failed': self.failed}
@@ -0,0 +1,201 @@
+import collections
+import logging
+import sys
+import threading
+import time
+
+
+slow_query_logger = logging.getLogger('gardenlog.slow_queries')
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    # Prometheus-style counters and histograms, keyed by metric name and a
+    # tuple of (label, value) pairs.
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.help = {}
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name, labels] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            if (name, labels) not in self.histograms:
+                self.histograms[name, labels] = [[0] * len(self.buckets), 0, 0.0]
+            counts, _, _ = histogram = self.histograms[name, labels]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self, gauges=()):
+        # gauges: (name, labels, value) read at scrape time
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, kind))
+            described.add(name)
+
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                header(name)
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+            for (name, labels), (counts, count, total) in sorted(self.histograms.items()):
+                header(name)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', format_value(bound)),)), bucket_count))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        for name, labels, value in gauges:
+            header(name)
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{%s}' % ','.join('%s="%s"' % (name, value) for (name, _), value in zip(labels, escaped))
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class RequestRecorder:
+    # Collects the spans (seconds per phase) and the queries of one request.
+
+    def __init__(self, metrics, slow_query_threshold, slow_queries):
+        self.metrics = metrics
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_queries = slow_queries
+        self.started = time.perf_counter()
+        self.spans = collections.defaultdict(float)
+        self.queries = []
+
+    def span(self, name, seconds):
+        self.spans[name] += seconds
+
+    def finish(self, conn, endpoint):
+        for query in self.queries:
+            query.finish(conn)
+        labels = (('endpoint', endpoint or 'none'),)
+        for name, seconds in self.spans.items():
+            self.metrics.observe('gardenlog_request_span_seconds', labels + (('span', name),), seconds)
+        self.metrics.observe('gardenlog_request_seconds', labels, time.perf_counter() - self.started)
+
+    def server_timing(self):
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in self.spans.items())
+
+
+class InstrumentedConnection:
+    # Stands in for a connection in the query functions: execute() is timed
+    # and its cursor records fetch time and row count, labelled with the name
+    # of the function that ran the statement.
+
+    def __init__(self, conn, recorder):
+        self.conn = conn
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def execute(self, sql, parameters=()):
+        query = InstrumentedCursor(sys._getframe(1).f_code.co_name, sql, parameters, self.recorder)
+        started = time.perf_counter()
+        query.cursor = self.conn.execute(sql, parameters)
+        query.add('query', time.perf_counter() - started)
+        self.recorder.queries.append(query)
+        return query
+
+
+class InstrumentedCursor:
+    def __init__(self, name, sql, parameters, recorder):
+        self.name = name
+        self.sql = sql
+        self.parameters = parameters
+        self.recorder = recorder
+        self.cursor = None
+        self.elapsed = 0.0
+        self.rows = 0
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def add(self, span, seconds, rows=0):
+        self.elapsed += seconds
+        self.rows += rows
+        self.recorder.span(span, seconds)
+
+    def __iter__(self):
+        while True:
+            started = time.perf_counter()
+            row = self.cursor.fetchone()
+            self.add('fetch', time.perf_counter() - started, row is not None)
+            if row is None:
+                return
+            yield row
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self.cursor.fetchone()
+        self.add('fetch', time.perf_counter() - started, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = self.cursor.fetchmany(self.cursor.arraysize if size is None else size)
+        self.add('fetch', time.perf_counter() - started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self.cursor.fetchall()
+        self.add('fetch', time.perf_counter() - started, len(rows))
+        return rows
+
+    def finish(self, conn):
+        if self.finished:
+            return
+        self.finished = True
+        labels = (('query', self.name),)
+        metrics = self.recorder.metrics
+        metrics.observe('gardenlog_query_seconds', labels, self.elapsed)
+        metrics.inc('gardenlog_query_rows_total', labels, self.rows)
+        if self.elapsed < self.recorder.slow_query_threshold:
+            return
+        metrics.inc('gardenlog_slow_queries_total', labels)
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + self.sql, self.parameters)]
+        entry = {'query': self.name, 'seconds': self.elapsed, 'rows': self.rows, 'sql': ' '.join(self.sql.split()),
+                 'parameters': list(self.parameters), 'plan': plan, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self.recorder.slow_queries.append(entry)
+        slow_query_logger.warning('%s took %.3fs for %d rows: %s %r\n  %s', self.name, self.elapsed, self.rows,
+                                  entry['sql'], entry['parameters'], '\n  '.join(plan))
+
+
+def describe_metrics(metrics):
+    metrics.describe('gardenlog_request_seconds', 'histogram', 'Request duration by endpoint.')
+    metrics.describe('gardenlog_request_span_seconds', 'histogram', 'Time spent per request in connect, query, fetch and render.')
+    metrics.describe('gardenlog_query_seconds', 'histogram', 'Execution plus fetch time per query function.')
+    metrics.describe('gardenlog_query_rows_total', 'counter', 'Rows fetched per query function.')
+    metrics.describe('gardenlog_slow_queries_total', 'counter', 'Queries slower than SLOW_QUERY_THRESHOLD.')
+    metrics.describe('gardenlog_pool_connections', 'gauge', 'Open and idle pooled connections.')
+    metrics.describe('gardenlog_pool_waits_total', 'counter', 'Connection requests that had to wait.')
+    metrics.describe('gardenlog_report_cache_lookups_total', 'counter', 'Report cache lookups by result.')
+    return metrics
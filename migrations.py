@@ -0,0 +1,518 @@
+import argparse
+import sqlite3
+import sys
+
+
+# Each migration is (version, description, script). The schema version of a
+# database is kept in PRAGMA user_version; scripts are applied in order inside
+# one transaction each, so a failed upgrade leaves the previous version intact.
+MIGRATIONS = [
+    (1, 'base schema', '''
+    CREATE TABLE IF NOT EXISTS PlantSpecies (
+      id INTEGER PRIMARY KEY,
+      name TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS Plant (
+       id INTEGER PRIMARY KEY,
+       speciesId INTEGER NOT NULL,
+       description TEXT NOT NULL,
+       FOREIGN KEY(speciesId) REFERENCES PlantSpecies(id)
+       );
+
+    CREATE TABLE IF NOT EXISTS TreatmentType (
+      id INTEGER PRIMARY KEY,
+      description TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS AppliedTreatment (
+       id INTEGER PRIMARY KEY,
+       treatmentTypeId INTEGER NOT NULL,
+       plantId INTEGER NOT NULL,
+       date REAL NOT NULL,
+       FOREIGN KEY(treatmentTypeId) REFERENCES TreatmentType(id),
+       FOREIGN KEY(plantId) REFERENCES Plant(id)
+       );
+
+    CREATE TABLE IF NOT EXISTS SafetyLimit (
+       id INTEGER PRIMARY KEY,
+       treatmentTypeId INTEGER NOT NULL,
+       speciesId INTEGER NOT NULL,
+       maxApplications INTEGER NOT NULL,
+       daysBetweenApplications INTEGER NOT NULL,
+       applyBefore TEXT NOT NULL,
+       minDaysBeforeConsumption INTEGER NOT NULL,
+       FOREIGN KEY(treatmentTypeId) REFERENCES TreatmentType(id),
+       FOREIGN KEY(speciesId) REFERENCES PlantSpecies(id),
+       UNIQUE(treatmentTypeId,speciesId)
+       );
+    '''),
+    # SafetyLimit(treatmentTypeId, speciesId) is already served by the index
+    # behind its UNIQUE constraint.
+    (2, 'covering indexes for report queries', '''
+    CREATE INDEX IF NOT EXISTS AppliedTreatment_date ON AppliedTreatment(date, plantId, treatmentTypeId);
+    CREATE INDEX IF NOT EXISTS AppliedTreatment_plant_date ON AppliedTreatment(plantId, date, treatmentTypeId);
+    CREATE INDEX IF NOT EXISTS AppliedTreatment_treatment_date ON AppliedTreatment(treatmentTypeId, date, plantId);
+    '''),
+    # Expiry dates are materialized per applied treatment so that "still in
+    # effect as of X" is a range lookup instead of an expression over every
+    # row. Only treatments with a matching SafetyLimit get a row, like the
+    # INNER JOIN the reports used to do.
+    (3, 'precomputed treatment expiry dates', '''
+    CREATE TABLE TreatmentExpiry (
+       appliedTreatmentId INTEGER PRIMARY KEY,
+       plantId INTEGER NOT NULL,
+       treatmentTypeId INTEGER NOT NULL,
+       date REAL NOT NULL,
+       repeatAllowedFrom REAL NOT NULL,
+       safeToConsumeFrom REAL NOT NULL,
+       FOREIGN KEY(appliedTreatmentId) REFERENCES AppliedTreatment(id)
+       );
+    CREATE INDEX TreatmentExpiry_repeat ON TreatmentExpiry(repeatAllowedFrom, date, plantId, treatmentTypeId);
+    CREATE INDEX TreatmentExpiry_consume ON TreatmentExpiry(safeToConsumeFrom, date, plantId, treatmentTypeId);
+
+    CREATE VIEW TreatmentExpirySource AS
+    SELECT t.id as appliedTreatmentId, t.plantId as plantId, t.treatmentTypeId as treatmentTypeId, p.speciesId as speciesId, t.date as date,
+           t.date + l.daysBetweenApplications as repeatAllowedFrom, t.date + l.minDaysBeforeConsumption as safeToConsumeFrom
+      FROM AppliedTreatment t
+      INNER JOIN Plant p
+      ON t.plantId = p.id
+      INNER JOIN SafetyLimit l
+      ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId;
+
+    INSERT INTO TreatmentExpiry
+    SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+      FROM TreatmentExpirySource;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_insert AFTER INSERT ON AppliedTreatment
+    BEGIN
+      INSERT INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE appliedTreatmentId = NEW.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_update AFTER UPDATE ON AppliedTreatment
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE appliedTreatmentId = OLD.id;
+      INSERT INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE appliedTreatmentId = NEW.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_delete AFTER DELETE ON AppliedTreatment
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE appliedTreatmentId = OLD.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_limit_insert AFTER INSERT ON SafetyLimit
+    BEGIN
+      INSERT OR REPLACE INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE treatmentTypeId = NEW.treatmentTypeId AND speciesId = NEW.speciesId;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_limit_update AFTER UPDATE ON SafetyLimit
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE treatmentTypeId = OLD.treatmentTypeId
+        AND plantId IN (SELECT id FROM Plant WHERE speciesId = OLD.speciesId);
+      INSERT OR REPLACE INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE treatmentTypeId = NEW.treatmentTypeId AND speciesId = NEW.speciesId;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_limit_delete AFTER DELETE ON SafetyLimit
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE treatmentTypeId = OLD.treatmentTypeId
+        AND plantId IN (SELECT id FROM Plant WHERE speciesId = OLD.speciesId);
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_plant_update AFTER UPDATE OF id, speciesId ON Plant
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE plantId = OLD.id;
+      INSERT INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE plantId = NEW.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_plant_delete AFTER DELETE ON Plant
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE plantId = OLD.id;
+    END;
+    '''),
+    # DataVersion holds a counter per table that is bumped by every write, so
+    # cached report results can be checked for staleness with one cheap read.
+    (4, 'per-table data version counters', '''
+    CREATE TABLE DataVersion (
+       tableName TEXT PRIMARY KEY,
+       version INTEGER NOT NULL
+       ) WITHOUT ROWID;
+    INSERT INTO DataVersion(tableName, version) VALUES
+       ('PlantSpecies', 0), ('Plant', 0), ('TreatmentType', 0), ('AppliedTreatment', 0), ('SafetyLimit', 0);
+''' + ''.join('''
+    CREATE TRIGGER DataVersion_%(table)s_%(event)s AFTER %(event)s ON %(table)s
+    BEGIN
+      UPDATE DataVersion SET version = version + 1 WHERE tableName = '%(table)s';
+    END;
+''' % {'table': table, 'event': event}
+    for table in ('PlantSpecies', 'Plant', 'TreatmentType', 'AppliedTreatment', 'SafetyLimit')
+    for event in ('INSERT', 'UPDATE', 'DELETE'))),
+    # Applications per plant, treatment type and season (calendar year), kept
+    # up to date by triggers. lastDate lets a report tell whether the season
+    # total already includes applications after its as-of date.
+    (5, 'per-season application counts', '''
+    CREATE TABLE TreatmentSeasonCount (
+       season INTEGER NOT NULL,
+       plantId INTEGER NOT NULL,
+       treatmentTypeId INTEGER NOT NULL,
+       applications INTEGER NOT NULL,
+       lastDate REAL NOT NULL,
+       PRIMARY KEY(season, plantId, treatmentTypeId)
+       ) WITHOUT ROWID;
+    CREATE INDEX AppliedTreatment_plant_treatment_date ON AppliedTreatment(plantId, treatmentTypeId, date);
+
+    CREATE VIEW TreatmentSeasonCountSource AS
+    SELECT CAST(strftime('%Y', date) AS INTEGER) as season, plantId, treatmentTypeId, COUNT(*) as applications, max(date) as lastDate
+      FROM AppliedTreatment
+      GROUP BY season, plantId, treatmentTypeId;
+
+    INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+    SELECT season, plantId, treatmentTypeId, applications, lastDate
+      FROM TreatmentSeasonCountSource;
+
+    CREATE TRIGGER TreatmentSeasonCount_insert AFTER INSERT ON AppliedTreatment
+    BEGIN
+      INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+      VALUES(CAST(strftime('%Y', NEW.date) AS INTEGER), NEW.plantId, NEW.treatmentTypeId, 1, NEW.date)
+      ON CONFLICT(season, plantId, treatmentTypeId) DO UPDATE SET applications = applications + 1, lastDate = max(lastDate, excluded.lastDate);
+    END;
+
+    CREATE TRIGGER TreatmentSeasonCount_delete AFTER DELETE ON AppliedTreatment
+    BEGIN
+      UPDATE TreatmentSeasonCount
+         SET applications = applications - 1,
+             lastDate = coalesce((SELECT max(t.date) FROM AppliedTreatment t
+                                   WHERE t.plantId = OLD.plantId AND t.treatmentTypeId = OLD.treatmentTypeId
+                                     AND t.date >= julianday(printf('%04d-01-01', season)) AND t.date < julianday(printf('%04d-01-01', season + 1))), 0)
+       WHERE season = CAST(strftime('%Y', OLD.date) AS INTEGER) AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId;
+      DELETE FROM TreatmentSeasonCount
+       WHERE season = CAST(strftime('%Y', OLD.date) AS INTEGER) AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId AND applications <= 0;
+    END;
+
+    CREATE TRIGGER TreatmentSeasonCount_update AFTER UPDATE OF plantId, treatmentTypeId, date ON AppliedTreatment
+    BEGIN
+      UPDATE TreatmentSeasonCount
+         SET applications = applications - 1,
+             lastDate = coalesce((SELECT max(t.date) FROM AppliedTreatment t
+                                   WHERE t.plantId = OLD.plantId AND t.treatmentTypeId = OLD.treatmentTypeId
+                                     AND t.date >= julianday(printf('%04d-01-01', season)) AND t.date < julianday(printf('%04d-01-01', season + 1))), 0)
+       WHERE season = CAST(strftime('%Y', OLD.date) AS INTEGER) AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId;
+      DELETE FROM TreatmentSeasonCount
+       WHERE season = CAST(strftime('%Y', OLD.date) AS INTEGER) AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId AND applications <= 0;
+      INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+      VALUES(CAST(strftime('%Y', NEW.date) AS INTEGER), NEW.plantId, NEW.treatmentTypeId, 1, NEW.date)
+      ON CONFLICT(season, plantId, treatmentTypeId) DO UPDATE SET applications = applications + 1, lastDate = max(lastDate, excluded.lastDate);
+    END;
+    '''),
+    # Precomputed report rows for a whole as-of date (see snapshots.py). k1..k4
+    # hold the report's keyset columns, padded with 0, so pages can be read
+    # in report order; the info row records the data versions the snapshot
+    # was built from.
+    (6, 'daily compliance snapshots', '''
+    CREATE TABLE ComplianceSnapshot (
+       asOfDate TEXT NOT NULL,
+       report TEXT NOT NULL,
+       k1 NOT NULL,
+       k2 NOT NULL,
+       k3 NOT NULL,
+       k4 NOT NULL,
+       data TEXT NOT NULL,
+       PRIMARY KEY(asOfDate, report, k1, k2, k3, k4)
+       ) WITHOUT ROWID;
+    CREATE TABLE ComplianceSnapshotInfo (
+       asOfDate TEXT PRIMARY KEY,
+       versions TEXT NOT NULL,
+       builtAt TEXT NOT NULL,
+       rows INTEGER NOT NULL
+       );
+    '''),
+    (7, 'case-insensitive description indexes for typeahead search', '''
+    CREATE INDEX Plant_description ON Plant(description COLLATE NOCASE);
+    CREATE INDEX TreatmentType_description ON TreatmentType(description COLLATE NOCASE);
+    '''),
+    # client-supplied ids of treatments posted to the ingestion API, so a
+    # retried submission is acknowledged with the row it created the first time
+    (8, 'treatment submissions', '''
+    CREATE TABLE TreatmentSubmission (
+       clientId TEXT PRIMARY KEY,
+       appliedTreatmentId INTEGER NOT NULL,
+       FOREIGN KEY(appliedTreatmentId) REFERENCES AppliedTreatment(id)
+       ) WITHOUT ROWID;
+    '''),
+    # Dates become integer day numbers (see queries.julian_day) and
+    # AppliedTreatment gets a season column, stored when the row is written,
+    # that the season-bounded queries and the season counts select on:
+    # they seek into one season of the plant indexes and compare integers
+    # instead of calling julianday() and strftime() per row. The tables are
+    # rebuilt; legacy_alter_table stops the rename from checking the views
+    # and triggers that refer to them while they are being replaced.
+    (9, 'integer day numbers and season partition key', '''
+    PRAGMA legacy_alter_table = ON;
+
+    CREATE TABLE AppliedTreatment_new (
+       id INTEGER PRIMARY KEY,
+       treatmentTypeId INTEGER NOT NULL,
+       plantId INTEGER NOT NULL,
+       date INTEGER NOT NULL,
+       season INTEGER NOT NULL GENERATED ALWAYS AS (CAST(strftime('%Y', date) AS INTEGER)) STORED,
+       FOREIGN KEY(treatmentTypeId) REFERENCES TreatmentType(id),
+       FOREIGN KEY(plantId) REFERENCES Plant(id)
+       );
+    INSERT INTO AppliedTreatment_new(id, treatmentTypeId, plantId, date)
+    SELECT id, treatmentTypeId, plantId, CAST(date + 0.5 AS INTEGER) FROM AppliedTreatment;
+    DROP TABLE AppliedTreatment;
+    ALTER TABLE AppliedTreatment_new RENAME TO AppliedTreatment;
+
+    CREATE INDEX AppliedTreatment_date ON AppliedTreatment(date, plantId, treatmentTypeId);
+    CREATE INDEX AppliedTreatment_plant_date ON AppliedTreatment(plantId, season, date, treatmentTypeId);
+    CREATE INDEX AppliedTreatment_treatment_date ON AppliedTreatment(treatmentTypeId, date, plantId);
+    CREATE INDEX AppliedTreatment_plant_treatment_date ON AppliedTreatment(plantId, treatmentTypeId, season, date);
+
+    DROP TABLE TreatmentExpiry;
+    CREATE TABLE TreatmentExpiry (
+       appliedTreatmentId INTEGER PRIMARY KEY,
+       plantId INTEGER NOT NULL,
+       treatmentTypeId INTEGER NOT NULL,
+       date INTEGER NOT NULL,
+       repeatAllowedFrom INTEGER NOT NULL,
+       safeToConsumeFrom INTEGER NOT NULL,
+       FOREIGN KEY(appliedTreatmentId) REFERENCES AppliedTreatment(id)
+       );
+    CREATE INDEX TreatmentExpiry_repeat ON TreatmentExpiry(repeatAllowedFrom, date, plantId, treatmentTypeId);
+    CREATE INDEX TreatmentExpiry_consume ON TreatmentExpiry(safeToConsumeFrom, date, plantId, treatmentTypeId);
+    INSERT INTO TreatmentExpiry
+    SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+      FROM TreatmentExpirySource;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_insert AFTER INSERT ON AppliedTreatment
+    BEGIN
+      INSERT INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE appliedTreatmentId = NEW.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_update AFTER UPDATE ON AppliedTreatment
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE appliedTreatmentId = OLD.id;
+      INSERT INTO TreatmentExpiry
+      SELECT appliedTreatmentId, plantId, treatmentTypeId, date, repeatAllowedFrom, safeToConsumeFrom
+        FROM TreatmentExpirySource WHERE appliedTreatmentId = NEW.id;
+    END;
+
+    CREATE TRIGGER TreatmentExpiry_treatment_delete AFTER DELETE ON AppliedTreatment
+    BEGIN
+      DELETE FROM TreatmentExpiry WHERE appliedTreatmentId = OLD.id;
+    END;
+
+    DROP VIEW TreatmentSeasonCountSource;
+    DROP TABLE TreatmentSeasonCount;
+    CREATE TABLE TreatmentSeasonCount (
+       season INTEGER NOT NULL,
+       plantId INTEGER NOT NULL,
+       treatmentTypeId INTEGER NOT NULL,
+       applications INTEGER NOT NULL,
+       lastDate INTEGER NOT NULL,
+       PRIMARY KEY(season, plantId, treatmentTypeId)
+       ) WITHOUT ROWID;
+
+    CREATE VIEW TreatmentSeasonCountSource AS
+    SELECT season, plantId, treatmentTypeId, COUNT(*) as applications, max(date) as lastDate
+      FROM AppliedTreatment
+      GROUP BY season, plantId, treatmentTypeId;
+
+    INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+    SELECT season, plantId, treatmentTypeId, applications, lastDate
+      FROM TreatmentSeasonCountSource;
+
+    CREATE TRIGGER TreatmentSeasonCount_insert AFTER INSERT ON AppliedTreatment
+    BEGIN
+      INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+      VALUES(NEW.season, NEW.plantId, NEW.treatmentTypeId, 1, NEW.date)
+      ON CONFLICT(season, plantId, treatmentTypeId) DO UPDATE SET applications = applications + 1, lastDate = max(lastDate, excluded.lastDate);
+    END;
+
+    CREATE TRIGGER TreatmentSeasonCount_delete AFTER DELETE ON AppliedTreatment
+    BEGIN
+      UPDATE TreatmentSeasonCount
+         SET applications = applications - 1,
+             lastDate = coalesce((SELECT max(t.date) FROM AppliedTreatment t
+                                   WHERE t.plantId = OLD.plantId AND t.treatmentTypeId = OLD.treatmentTypeId AND t.season = OLD.season), 0)
+       WHERE season = OLD.season AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId;
+      DELETE FROM TreatmentSeasonCount
+       WHERE season = OLD.season AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId AND applications <= 0;
+    END;
+
+    CREATE TRIGGER TreatmentSeasonCount_update AFTER UPDATE OF plantId, treatmentTypeId, date ON AppliedTreatment
+    BEGIN
+      UPDATE TreatmentSeasonCount
+         SET applications = applications - 1,
+             lastDate = coalesce((SELECT max(t.date) FROM AppliedTreatment t
+                                   WHERE t.plantId = OLD.plantId AND t.treatmentTypeId = OLD.treatmentTypeId AND t.season = OLD.season), 0)
+       WHERE season = OLD.season AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId;
+      DELETE FROM TreatmentSeasonCount
+       WHERE season = OLD.season AND plantId = OLD.plantId AND treatmentTypeId = OLD.treatmentTypeId AND applications <= 0;
+      INSERT INTO TreatmentSeasonCount(season, plantId, treatmentTypeId, applications, lastDate)
+      VALUES(NEW.season, NEW.plantId, NEW.treatmentTypeId, 1, NEW.date)
+      ON CONFLICT(season, plantId, treatmentTypeId) DO UPDATE SET applications = applications + 1, lastDate = max(lastDate, excluded.lastDate);
+    END;
+''' + ''.join('''
+    CREATE TRIGGER DataVersion_AppliedTreatment_%(event)s AFTER %(event)s ON AppliedTreatment
+    BEGIN
+      UPDATE DataVersion SET version = version + 1 WHERE tableName = 'AppliedTreatment';
+    END;
+''' % {'event': event} for event in ('INSERT', 'UPDATE', 'DELETE')) + '''
+    -- results cached or snapshotted from the old values are stale
+    UPDATE DataVersion SET version = version + 1 WHERE tableName = 'AppliedTreatment';
+    DELETE FROM ComplianceSnapshot;
+    DELETE FROM ComplianceSnapshotInfo;
+
+    PRAGMA legacy_alter_table = OFF;
+    '''),
+    # Full-text search over the catalog (see search.py). CatalogSearch holds
+    # the words of plant, treatment type and species names for word and
+    # prefix queries, CatalogTrigrams their trigrams for substring and fuzzy
+    # ones. Both are contentless, the names stay in their tables: an entry's
+    # rowid is id * 4 + kind (1 plant, 2 treatment type, 3 species), and
+    # triggers add and remove entries with the old and new names.
+    (10, 'full-text catalog search', '''
+    CREATE VIEW CatalogEntry AS
+    SELECT id * 4 + 1 as entryKey, description as name FROM Plant
+    UNION ALL
+    SELECT id * 4 + 2, description FROM TreatmentType
+    UNION ALL
+    SELECT id * 4 + 3, name FROM PlantSpecies;
+
+    CREATE VIRTUAL TABLE CatalogSearch USING fts5(name, content = '', tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3');
+    CREATE VIRTUAL TABLE CatalogTrigrams USING fts5(name, content = '', tokenize = 'trigram');
+    INSERT INTO CatalogSearch(rowid, name) SELECT entryKey, name FROM CatalogEntry;
+    INSERT INTO CatalogTrigrams(rowid, name) SELECT entryKey, name FROM CatalogEntry;
+''' + ''.join('''
+    CREATE TRIGGER CatalogSearch_%(table)s_insert AFTER INSERT ON %(table)s
+    BEGIN
+      INSERT INTO CatalogSearch(rowid, name) VALUES(NEW.id * 4 + %(kind)d, NEW.%(column)s);
+      INSERT INTO CatalogTrigrams(rowid, name) VALUES(NEW.id * 4 + %(kind)d, NEW.%(column)s);
+    END;
+
+    CREATE TRIGGER CatalogSearch_%(table)s_delete AFTER DELETE ON %(table)s
+    BEGIN
+      INSERT INTO CatalogSearch(CatalogSearch, rowid, name) VALUES('delete', OLD.id * 4 + %(kind)d, OLD.%(column)s);
+      INSERT INTO CatalogTrigrams(CatalogTrigrams, rowid, name) VALUES('delete', OLD.id * 4 + %(kind)d, OLD.%(column)s);
+    END;
+
+    CREATE TRIGGER CatalogSearch_%(table)s_update AFTER UPDATE OF id, %(column)s ON %(table)s
+    BEGIN
+      INSERT INTO CatalogSearch(CatalogSearch, rowid, name) VALUES('delete', OLD.id * 4 + %(kind)d, OLD.%(column)s);
+      INSERT INTO CatalogTrigrams(CatalogTrigrams, rowid, name) VALUES('delete', OLD.id * 4 + %(kind)d, OLD.%(column)s);
+      INSERT INTO CatalogSearch(rowid, name) VALUES(NEW.id * 4 + %(kind)d, NEW.%(column)s);
+      INSERT INTO CatalogTrigrams(rowid, name) VALUES(NEW.id * 4 + %(kind)d, NEW.%(column)s);
+    END;
+''' % {'table': table, 'column': column, 'kind': kind}
+    for table, column, kind in (('Plant', 'description', 1), ('TreatmentType', 'description', 2), ('PlantSpecies', 'name', 3)))),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def _statements(script):
+    statement = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    if statement.strip():
+        yield statement
+
+def migrate(conn, target=LATEST_VERSION):
+    # The version is re-read under a write lock, so several workers starting
+    # against the same file apply every migration exactly once.
+    applied = []
+    for version, description, script in MIGRATIONS:
+        if version > target or schema_version(conn) >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if schema_version(conn) < version:
+                for statement in _statements(script):
+                    conn.execute(statement)
+                conn.execute('PRAGMA user_version = %d' % version)
+                applied.append((version, description))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    return applied
+
+
+class _ExplainingConnection:
+    # Stands in for a connection so the report query functions can be reused
+    # unchanged: every statement is prefixed with EXPLAIN QUERY PLAN.
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, parameters=()):
+        return self.conn.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+
+def report_query_calls(as_of_date='2022-07-28', plant_id=1, treatment_id=1):
+    import queries
+    return [
+        ('treatment_date_limits_in_effect', lambda conn: queries.treatment_date_limits_in_effect(conn, as_of_date)),
+        ('safe_to_consume_dates', lambda conn: queries.safe_to_consume_dates(conn, as_of_date)),
+        ('treatments_no_longer_applicable', lambda conn: queries.treatments_no_longer_applicable(conn, as_of_date)),
+        ('treatments_applied_without_limit_info', lambda conn: queries.treatments_applied_without_limit_info(conn, as_of_date)),
+        ('all_limit_info_for_treatment', lambda conn: queries.all_limit_info_for_treatment(conn, treatment_id)),
+        ('all_treatments_for_plant', lambda conn: queries.all_treatments_for_plant(conn, as_of_date, plant_id)),
+        ('search_plants', lambda conn: queries.search_plants(conn, 'a')),
+        ('search_treatments', lambda conn: queries.search_treatments(conn, 'a')),
+    ]
+
+def full_scans(conn):
+    explaining = _ExplainingConnection(conn)
+    problems = []
+    for name, call in report_query_calls():
+        for row in call(explaining):
+            detail = row[3]
+            if detail.startswith('SCAN ') and not detail.startswith('SCAN (subquery'):
+                problems.append((name, detail))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create, upgrade and check the gardenlog database schema.')
+    parser.add_argument('command', choices=('upgrade', 'version', 'check'))
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--target', type=int, default=LATEST_VERSION)
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        if args.command == 'upgrade':
+            for version, description in migrate(conn, args.target):
+                print('applied', version, ':', description)
+            print('schema version', schema_version(conn))
+        elif args.command == 'version':
+            print(schema_version(conn), 'of', LATEST_VERSION)
+        else:
+            problems = full_scans(conn)
+            for name, detail in problems:
+                print('FULL SCAN in', name, ':', detail)
+            return 1 if problems else 0
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
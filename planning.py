@@ -0,0 +1,181 @@
+import threading
+from datetime import date
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from cache import data_versions
+from compliance import iso_date
+from queries import julian_day
+
+
+# What-if evaluation of a candidate treatment for every plant and a set of
+# candidate dates. The treatment history is held as NumPy arrays sorted by
+# (plant, date); combining plant and date into one float key lets a single
+# searchsorted call answer "last/next application before/after x" for all
+# plants and dates at once.
+
+class SprayPlanner:
+
+    TABLES = ('AppliedTreatment', 'Plant', 'SafetyLimit')
+
+    def __init__(self):
+        if np is None:
+            raise RuntimeError('spray planning needs numpy')
+        self.lock = threading.Lock()
+        self.versions = None
+
+    def refresh(self, conn):
+        versions = data_versions(conn)
+        versions = tuple(versions[table] for table in self.TABLES)
+        with self.lock:
+            if versions != self.versions:
+                self.load(conn)
+                self.versions = versions
+
+    def load(self, conn):
+        plants = conn.execute('SELECT id, speciesId, description FROM Plant ORDER BY id').fetchall()
+        self.plant_ids = np.array([plant[0] for plant in plants], dtype=np.int64)
+        self.plant_species = np.array([plant[1] for plant in plants], dtype=np.int64)
+        self.plant_descriptions = [plant[2] for plant in plants]
+
+        limits = conn.execute('''
+        SELECT treatmentTypeId, speciesId, maxApplications, daysBetweenApplications, minDaysBeforeConsumption, applyBefore
+        FROM SafetyLimit
+        ORDER BY treatmentTypeId, speciesId
+        ''').fetchall()
+        self.limit_keys = np.array([(limit[0], limit[1]) for limit in limits], dtype=np.int64).reshape(-1, 2)
+        self.limit_values = np.array([limit[2:5] for limit in limits], dtype=np.int64).reshape(-1, 3)
+        self.apply_before = [limit[5] for limit in limits]
+
+        history = np.array(conn.execute('''
+        SELECT t.plantId, t.treatmentTypeId, t.date, coalesce(t.date + l.minDaysBeforeConsumption, t.date)
+        FROM AppliedTreatment t
+        INNER JOIN Plant p
+        ON t.plantId = p.id
+        LEFT JOIN SafetyLimit l
+        ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
+        ''').fetchall(), dtype=np.float64).reshape(-1, 4)
+        plant = np.searchsorted(self.plant_ids, history[:, 0].astype(np.int64))
+        order = np.lexsort((history[:, 2], plant))
+        # a trailing sentinel row for a plant that does not exist: lookups
+        # that run off either end of the arrays land on it and never match
+        self.history_plant = np.append(plant[order], len(self.plant_ids))
+        self.history_type = np.append(history[order, 1].astype(np.int64), -1)
+        self.history_date = np.append(history[order, 2], np.inf)
+
+        # running maximum of the safe-to-consume dates within each plant;
+        # offsetting every plant above the previous one lets one accumulate
+        # pass do the whole array
+        consume = np.append(history[order, 3], -np.inf)
+        finite = consume[:-1]
+        low = finite.min() if len(finite) else 0.0
+        step = finite.max() - low + 1 if len(finite) else 1.0
+        offset = self.history_plant * step
+        self.history_consume = np.maximum.accumulate(np.where(np.isfinite(consume), consume - low, 0) + offset) - offset + low
+        self.history_consume[-1] = -np.inf
+
+    def evaluate(self, treatment_type_id, candidate_dates, plant_ids=None):
+        with self.lock:
+            return self._evaluate(treatment_type_id, candidate_dates, plant_ids)
+
+    def _evaluate(self, treatment_type_id, candidate_dates, plant_ids):
+        x = np.array([julian_day(day) for day in candidate_dates], dtype=np.float64)[None, :]
+        if plant_ids is None:
+            plants = np.arange(len(self.plant_ids))
+        else:
+            wanted = np.array(sorted(set(plant_ids)), dtype=np.int64)
+            plants = np.searchsorted(self.plant_ids, wanted)
+            plants = plants[np.append(self.plant_ids, -1)[plants] == wanted]
+        plant = plants[:, None]
+
+        # the safety limit of the candidate treatment for each plant's species
+        limit_keys = np.append(self.limit_keys[:, 0] << 32 | self.limit_keys[:, 1], np.iinfo(np.int64).max)
+        wanted = np.int64(treatment_type_id) << 32 | self.plant_species[plants]
+        limit = np.searchsorted(limit_keys, wanted)
+        has_limit = (limit_keys[limit] == wanted)[:, None]
+        values = np.append(self.limit_values, [[0, 0, 0]], axis=0)[limit]
+        max_applications, days_between, min_days = values[:, 0:1], values[:, 1:2], values[:, 2:3]
+
+        # one key per (plant, date); each plant gets a slot wide enough for
+        # the history, the candidates and the longest repeat window
+        margin = days_between.max(initial=0) + 400
+        base = min(self.history_date[:-1].min(initial=x.min()), x.min()) - margin
+        span = max(self.history_date[:-1].max(initial=x.max()), x.max()) + margin - base
+
+        def keys(plant, day):
+            return plant * span + (day - base)
+
+        treated = np.append(np.flatnonzero(self.history_type == treatment_type_id), len(self.history_type) - 1)
+        treated_plant = self.history_plant[treated]
+        treated_date = self.history_date[treated]
+        treated_keys = keys(treated_plant, treated_date)
+
+        # last application of the treatment on or before x and the first one
+        # after it; applying on x must keep daysBetweenApplications to both
+        before = np.searchsorted(treated_keys, keys(plant, x), side='right') - 1
+        last_date = np.where(treated_plant[before] == plant, treated_date[before], np.nan)
+        next_date = np.where(treated_plant[before + 1] == plant, treated_date[before + 1], np.nan)
+        with np.errstate(invalid='ignore'):
+            too_soon = (x < last_date + days_between) | (next_date < x + days_between)
+        safe_to_repeat = np.fmax(last_date, np.where(next_date < x + days_between, next_date, np.nan)) + days_between
+
+        # applications in the candidate date's season (calendar year)
+        years = [day.year for day in candidate_dates]
+        season_start = np.array([julian_day(date(year, 1, 1)) for year in years])[None, :]
+        season_end = np.array([julian_day(date(year + 1, 1, 1)) for year in years])[None, :]
+        applications = (np.searchsorted(treated_keys, keys(plant, season_end))
+                        - np.searchsorted(treated_keys, keys(plant, season_start)))
+        season_exhausted = applications >= max_applications
+
+        # latest safe-to-consume date of the plant's history up to x, pushed
+        # out by the candidate treatment's own waiting time
+        latest = np.searchsorted(keys(self.history_plant, self.history_date), keys(plant, x), side='right') - 1
+        existing = np.where(self.history_plant[latest] == plant, self.history_consume[latest], -np.inf)
+        safe_to_consume_from = np.maximum(existing, np.where(has_limit, x + min_days, -np.inf))
+
+        return {
+            'plants': plants,
+            'limits': np.where(has_limit[:, 0], limit, -1),
+            'allowed': has_limit & ~too_soon & ~season_exhausted,
+            'too_soon': has_limit & too_soon,
+            'safe_to_repeat': safe_to_repeat,
+            'applications': applications,
+            'season_exhausted': has_limit & season_exhausted,
+            'safe_to_consume_from': safe_to_consume_from,
+        }
+
+    def plan(self, treatment_type_id, candidate_dates, plant_ids=None):
+        # the evaluation as plain rows: one entry per plant, one per date
+        result = self.evaluate(treatment_type_id, candidate_dates, plant_ids)
+        plan = []
+        for row, plant in enumerate(result['plants']):
+            limit = None
+            index = result['limits'][row]
+            if index >= 0:
+                max_applications, days_between, min_days = (int(value) for value in self.limit_values[index])
+                limit = {'maxApplications': max_applications, 'daysBetweenApplications': days_between,
+                         'minDaysBeforeConsumption': min_days, 'applyBefore': self.apply_before[index]}
+            days = []
+            for column, candidate in enumerate(candidate_dates):
+                too_soon = bool(result['too_soon'][row, column])
+                safe_to_consume_from = float(result['safe_to_consume_from'][row, column])
+                days.append({
+                    'date': candidate.isoformat(),
+                    'allowed': bool(result['allowed'][row, column]),
+                    'tooSoon': too_soon,
+                    'safeToRepeatDate': iso_date(float(result['safe_to_repeat'][row, column])) if too_soon else None,
+                    'applicationsInSeason': int(result['applications'][row, column]),
+                    'seasonExhausted': bool(result['season_exhausted'][row, column]),
+                    'safeToConsumeDate': iso_date(safe_to_consume_from) if safe_to_consume_from > -np.inf else None,
+                })
+            plan.append({'plantId': int(self.plant_ids[plant]), 'plant': self.plant_descriptions[plant], 'limit': limit, 'days': days})
+        return plan
+
+
+def plan_treatment(conn, treatment_type_id, candidate_dates, plant_ids=None):
+    planner = SprayPlanner()
+    planner.refresh(conn)
+    return planner.plan(treatment_type_id, candidate_dates, plant_ids)
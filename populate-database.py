@@ -1,5 +1,9 @@
 import sqlite3
 
+from migrations import migrate
+from queries import (Lookups, all_limit_info_for_treatment, safe_to_consume_dates, treatment_date_limits_in_effect,
+                     treatments_applied_without_limit_info, treatments_no_longer_applicable)
+
 conn = sqlite3.connect("test.db")
 conn.row_factory = sqlite3.Row
 
@@ -10,105 +14,42 @@ def run_query(sql, param):
 
 
 class PlantSpecies:
-    TABLE = '''
-    CREATE TABLE PlantSpecies (
-      id INTEGER PRIMARY KEY,
-      name TEXT NOT NULL
-    );
-    '''
-    
     def __init__(self, name):
         self.name = name
         self.species_id = run_query('INSERT INTO PlantSpecies(name) VALUES(?)', (name,))
 
-    @staticmethod
-    def dbInit():
-        run_query(PlantSpecies.TABLE, ())
 
-        
 class Plant:
-    TABLE = '''
-    CREATE TABLE Plant (
-       id INTEGER PRIMARY KEY,
-       speciesId INTEGER NOT NULL,
-       description TEXT NOT NULL,
-       FOREIGN KEY(speciesId) REFERENCES PlantSpecies(id)
-       );
-    '''
-        
     def __init__(self, species, description):
         self.description = description
         self.species_id = species.species_id
         self.plant_id = run_query('INSERT INTO Plant(speciesId, description) VALUES(?,?)', (self.species_id, description))
 
-    @staticmethod
-    def dbInit():
-        run_query(Plant.TABLE, ())
-
 
 class TreatmentType:
-    TABLE = '''
-    CREATE TABLE TreatmentType (
-      id INTEGER PRIMARY KEY,
-      description TEXT NOT NULL
-    );
-    '''
-            
     def __init__(self, description):
         self.description = description
         self.treatment_type_id = run_query('INSERT INTO TreatmentType(description) VALUES(?)', (description,))
 
-    @staticmethod
-    def dbInit():
-        run_query(TreatmentType.TABLE, ())
-
 
 class AppliedTreatment:
-    TABLE = '''
-    CREATE TABLE AppliedTreatment (
-       id INTEGER PRIMARY KEY,
-       treatmentTypeId INTEGER NOT NULL,
-       plantId INTEGER NOT NULL,
-       date REAL NOT NULL,
-       FOREIGN KEY(treatmentTypeId) REFERENCES TreatmentType(id),
-       FOREIGN KEY(plantId) REFERENCES Plant(id)
-       );
-    '''
-
     def __init__(self, treatment: TreatmentType, plant: Plant, date):
         self.treatment_type_id = treatment.treatment_type_id
         self.plant_id = plant.plant_id
         self.treatment_date = date
-        self.applied_treatment_id = run_query('INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,julianday(?))', (self.treatment_type_id, self.plant_id, self.treatment_date))
-    
-    @staticmethod
-    def dbInit():
-        run_query(AppliedTreatment.TABLE, ())
+        self.applied_treatment_id = run_query('INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,CAST(julianday(?) + 0.5 AS INTEGER))', (self.treatment_type_id, self.plant_id, self.treatment_date))
+
 
 def apply_treatment(treatment, plants, date):
     try:
-        for plant in plants:
-            AppliedTreatment(treatment, plant, date)
+        plants = tuple(plants)
     except TypeError:
-        AppliedTreatment(treatment, plants, date)
+        plants = (plants,)
+    conn.executemany('INSERT INTO AppliedTreatment(treatmentTypeId,plantId,date) VALUES(?,?,CAST(julianday(?) + 0.5 AS INTEGER))',
+                     [(treatment.treatment_type_id, plant.plant_id, date) for plant in plants])
 
         
 class SafetyLimit:
-    TABLE = '''
-    CREATE TABLE SafetyLimit (
-       id INTEGER PRIMARY KEY,
-       treatmentTypeId INTEGER NOT NULL,
-       speciesId INTEGER NOT NULL,
-       maxApplications INTEGER NOT NULL,
-       daysBetweenApplications INTEGER NOT NULL,
-       applyBefore TEXT NOT NULL,
-       minDaysBeforeConsumption INTEGER NOT NULL,
-       FOREIGN KEY(treatmentTypeId) REFERENCES TreatmentType(id),
-       FOREIGN KEY(speciesId) REFERENCES PlantSpecies(id),
-       UNIQUE(treatmentTypeId,speciesId)
-       );
-    '''
-
     def __init__(self, treatment: TreatmentType, species: PlantSpecies, max_applications, days_between_applications, apply_before, min_days_before_consumption):
         self.treatment_type_id = treatment.treatment_type_id
         self.species_id = species.species_id
@@ -120,10 +61,6 @@ class SafetyLimit:
             self.id = run_query('INSERT INTO SafetyLimit(treatmentTypeId,speciesId,maxApplications,daysBetweenApplications,applyBefore,minDaysBeforeConsumption) VALUES(?,?,?,?,?,?)', (self.treatment_type_id, self.species_id, self.max_applications, self.days_between_applications,self.apply_before, self.min_days_before_consumption))    
         except sqlite3.IntegrityError:
             print('WARNING: Duplicate safety limit for treatmentType', self.treatment_type_id, ', speciesId', self.species_id, 'ignored!')
-            
-    @staticmethod
-    def dbInit():
-        run_query(SafetyLimit.TABLE, ())
 
 
 def add_safety_limit(treatment, species_list, max_applications, days_between_applications, apply_before, min_days_before_consumption):
@@ -133,101 +70,8 @@ def add_safety_limit(treatment, species_list, max_applications, days_between_app
     except TypeError:
         SafetyLimit(treatment, species_list, max_applications, days_between_applications, apply_before, min_days_before_consumption)
 
-def treatment_date_limits_in_effect(as_of_date):
-    QUERY = '''
-    SELECT p.description as plant, tt.description as treatment, date(t.date) as treatmentDate, date(t.date + l.daysBetweenApplications) as safeToRepeatDate
-      FROM AppliedTreatment t
-      LEFT JOIN Plant p
-      ON t.plantId = p.id
-      INNER JOIN SafetyLimit l
-      ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-      LEFT JOIN TreatmentType tt
-      ON t.treatmentTypeId = tt.id
-      WHERE t.date <= julianday(?) AND t.date + l.daysBetweenApplications >= julianday(?)
-    '''
-    return conn.execute(QUERY, (as_of_date, as_of_date))
-
-def safe_to_consume_dates(as_of_date):
-    QUERY='''
-    SELECT plant, treatment, treatmentDate, max(safeToConsumeDate) as safeToConsumeDate
-      FROM
-      (SELECT p.description as plant, tt.description as treatment, date(t.date) as treatmentDate, date(t.date + l.minDaysBeforeConsumption) as safeToConsumeDate
-      FROM AppliedTreatment t
-      LEFT JOIN Plant p
-      ON t.plantId = p.id
-      INNER JOIN SafetyLimit l
-      ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-      LEFT JOIN TreatmentType tt
-      ON t.treatmentTypeId = tt.id
-      WHERE t.date <= julianday(?) AND t.date + l.minDaysBeforeConsumption >= julianday(?)
-      )
-      GROUP BY plant
-    '''
-    return conn.execute(QUERY, (as_of_date, as_of_date))
-
-def treatments_no_longer_applicable(as_of_date):
-    QUERY='''
-    SELECT plantDescription, treatmentDescription, treatments, maxApplications
-    FROM
-    (SELECT plantId, plantDescription, treatmentTypeId, treatmentDescription, COUNT(treatmentDate) as treatments, maxApplications
-    FROM
-    (SELECT p.id as plantId, p.description as plantDescription, t.treatmentTypeId as treatmentTypeId, tt.description as treatmentDescription, t.date as treatmentDate, l.maxApplications as maxApplications
-    FROM AppliedTreatment t
-    LEFT JOIN Plant p
-    ON t.plantId = p.id
-    INNER JOIN SafetyLimit l
-    ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-    LEFT JOIN TreatmentType tt
-    ON t.treatmentTypeId = tt.id
-    WHERE t.date <= julianday(?) and t.date >= julianday(?)
-    )
-    GROUP BY plantId, treatmentTypeId
-    )
-    WHERE treatments >= maxApplications
-    '''
-    
-    start_of_year = as_of_date[0:4] + '-01-01'
-    return conn.execute(QUERY, (as_of_date, start_of_year))
-
-def treatments_applied_without_limit_info(as_of_date):
-    QUERY='''
-    SELECT tt.description as treatment, date(t.date) as date, p.description as plant
-    FROM AppliedTreatment t
-    LEFT JOIN Plant p
-    ON t.plantId = p.id
-    LEFT JOIN SafetyLimit l
-    ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
-    LEFT JOIN TreatmentType tt
-    ON t.treatmentTypeId = tt.id
-    WHERE l.id IS NULL AND t.date >= julianday(?)
-    '''
-
-    start_of_year = as_of_date[0:4] + '-01-01'
-    return conn.execute(QUERY, (start_of_year,))
-
-def all_limit_info_for_treatment(treatment):
-    QUERY='''
-    SELECT t.description as treatment,
-       p.name as species,
-       l.maxApplications as maxApplications,
-       l.daysBetweenApplications as daysBetweenApplications,
-       l.applyBefore as applyBefore,
-       l.minDaysBeforeConsumption as minDaysBeforeConsumption
-    FROM TreatmentType t
-    LEFT JOIN SafetyLimit l
-    ON t.id = l.treatmentTypeId
-    LEFT JOIN PlantSpecies p
-    ON l.speciesId = p.id
-    WHERE t.description = ?
-    '''
-    return conn.execute(QUERY, (treatment,))
-
-
-PlantSpecies.dbInit()
-Plant.dbInit()
-TreatmentType.dbInit()
-AppliedTreatment.dbInit()
-SafetyLimit.dbInit()
+
+migrate(conn)
 
 alma = PlantSpecies('alma')
 korte = PlantSpecies('korte')
@@ -523,28 +367,28 @@ as_of_date = '2022-07-28'
 print('================')
 
 print('Treatment date limits in effect')
-current_limits = treatment_date_limits_in_effect(as_of_date)
+current_limits = treatment_date_limits_in_effect(conn, as_of_date)
 for limit in current_limits:
     print(limit['plant'], '+', limit['treatment'], ':', limit['treatmentDate'], '==>', limit['safeToRepeatDate'])
 
 print('================')
     
 print('Safe to consume dates')
-current_dates = safe_to_consume_dates(as_of_date)
+current_dates = safe_to_consume_dates(conn, as_of_date)
 for date_entry in current_dates:
     print(date_entry['plant'], '+', date_entry['treatment'], ':', date_entry['treatmentDate'], '==>', date_entry['safeToConsumeDate'])
     
 print('================')
 
 print('Treatments no longer applicable')
-treatments = treatments_no_longer_applicable(as_of_date)
+treatments = treatments_no_longer_applicable(conn, as_of_date)
 for treatment in treatments:
     print(treatment['plantDescription'], '+', treatment['treatmentDescription'], ':', treatment['treatments'], '>=', treatment['maxApplications'])
 
 print('================')
 
 print('Treatments applied this year without limit info')
-treatments = treatments_applied_without_limit_info(as_of_date)
+treatments = treatments_applied_without_limit_info(conn, as_of_date)
 for treatment in treatments:
     print(treatment['plant'], '+', treatment['treatment'], ':', treatment['date'])
     
@@ -552,7 +396,7 @@ print('================')
 
 treatment = 'Signum'
 print('All limit info for a treatment (', treatment, ')')
-limits = all_limit_info_for_treatment(treatment)
+limits = all_limit_info_for_treatment(conn, Lookups().refresh(conn).treatment_ids[treatment])
 for limit in limits:
     print(limit['species'], '+', treatment, ': max', limit['maxApplications'], 'x with delay', limit['daysBetweenApplications'], 'days, applied', limit['applyBefore'], ', and safe to consume after', limit['minDaysBeforeConsumption'], 'days') 
 
@@ -0,0 +1,331 @@
+import json
+import sqlite3
+import threading
+from datetime import date, timedelta
+
+
+# Report and lookup queries shared by the web app and the command line tools.
+# Every statement is a constant string, so sqlite3 prepares it once per
+# connection and reuses it from the connection's statement cache
+# (cached_statements) on every later call.
+
+# The report queries return rows in a stable order and accept a keyset
+# cursor: `after` holds the sort key columns (REPORT_KEYS) of the last row
+# already seen and `limit` caps the page size (-1 for no limit).
+REPORT_KEYS = {
+    'date_limits': ('sortDate', 'id'),
+    'safe': ('plant',),
+    'not_applicable': ('plantId', 'treatmentTypeId'),
+    'no_info': ('sortDate', 'plantId', 'treatmentTypeId', 'id'),
+    'plant_info': ('sortDate', 'treatmentTypeId', 'id'),
+}
+
+def treatment_date_limits_in_effect(conn, as_of_date, after=None, limit=-1):
+    # Unary + keeps e.date out of index selection, so the expiry range drives
+    # the scan even when ANALYZE statistics suggest a skip-scan on date.
+    QUERY = '''
+    SELECT e.appliedTreatmentId as id, e.date as sortDate, p.description as plant, tt.description as treatment, date(e.date) as treatmentDate, date(e.repeatAllowedFrom) as safeToRepeatDate
+      FROM TreatmentExpiry e
+      INNER JOIN Plant p
+      ON e.plantId = p.id
+      LEFT JOIN TreatmentType tt
+      ON e.treatmentTypeId = tt.id
+      WHERE +e.date <= ? AND e.repeatAllowedFrom >= ? AND (+e.date, e.appliedTreatmentId) > (?, ?)
+      ORDER BY e.date, e.appliedTreatmentId
+      LIMIT ?
+    '''
+    day = AsOfDate(as_of_date).day
+    after = after or (0, 0)
+    return conn.execute(QUERY, (day, day, *after, limit))
+
+def safe_to_consume_dates(conn, as_of_date, after=None, limit=-1):
+    # One row per plant: the latest safe date, ties going to the latest
+    # treatment, then the highest id (as archive.safe_to_consume does).
+    QUERY='''
+    SELECT plant, tt.description as treatment, date(latest.date) as treatmentDate, date(latest.safeToConsumeFrom) as safeToConsumeDate
+      FROM
+      (SELECT p.description as plant, e.treatmentTypeId, e.date, e.safeToConsumeFrom,
+              row_number() OVER (PARTITION BY p.description ORDER BY e.safeToConsumeFrom DESC, e.date DESC, e.appliedTreatmentId DESC) as rank
+      FROM TreatmentExpiry e
+      INNER JOIN Plant p
+      ON e.plantId = p.id
+      WHERE e.date <= ? AND e.safeToConsumeFrom >= ? AND (? IS NULL OR p.description > ?)
+      ) latest
+      LEFT JOIN TreatmentType tt
+      ON latest.treatmentTypeId = tt.id
+      WHERE rank = 1
+      ORDER BY plant
+      LIMIT ?
+    '''
+    day = AsOfDate(as_of_date).day
+    after_plant = after[0] if after else None
+    return conn.execute(QUERY, (day, day, after_plant, after_plant, limit))
+
+def treatments_no_longer_applicable(conn, as_of_date, after=None, limit=-1):
+    # Season totals come from TreatmentSeasonCount; only when a season already
+    # has applications after as_of_date are they counted from the treatments.
+    # CROSS JOIN keeps the season lookup as the outer loop once ANALYZE
+    # statistics exist.
+    QUERY='''
+    SELECT plantId, treatmentTypeId, plantDescription, treatmentDescription, treatments, maxApplications
+    FROM
+    (SELECT c.plantId as plantId, c.treatmentTypeId as treatmentTypeId, p.description as plantDescription, tt.description as treatmentDescription, l.maxApplications as maxApplications,
+      CASE WHEN c.lastDate <= ? THEN c.applications
+      ELSE (SELECT COUNT(*) FROM AppliedTreatment t
+            WHERE t.plantId = c.plantId AND t.treatmentTypeId = c.treatmentTypeId AND t.season = c.season AND t.date <= ?)
+      END as treatments
+    FROM TreatmentSeasonCount c
+    CROSS JOIN Plant p
+    ON c.plantId = p.id
+    INNER JOIN SafetyLimit l
+    ON c.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
+    LEFT JOIN TreatmentType tt
+    ON c.treatmentTypeId = tt.id
+    WHERE c.season = ? AND (c.plantId, c.treatmentTypeId) > (?, ?)
+    )
+    WHERE treatments >= maxApplications AND treatments > 0
+    ORDER BY plantId, treatmentTypeId
+    LIMIT ?
+    '''
+
+    as_of = AsOfDate(as_of_date)
+    after = after or (0, 0)
+    return conn.execute(QUERY, (as_of.day, as_of.day, as_of.season, *after, limit))
+
+def treatments_applied_without_limit_info(conn, as_of_date, after=None, limit=-1):
+    QUERY='''
+    SELECT t.id as id, t.date as sortDate, t.plantId as plantId, t.treatmentTypeId as treatmentTypeId, tt.description as treatment, date(t.date) as date, p.description as plant
+    FROM AppliedTreatment t
+    LEFT JOIN Plant p
+    ON t.plantId = p.id
+    LEFT JOIN SafetyLimit l
+    ON t.treatmentTypeId = l.treatmentTypeId AND l.speciesId = p.speciesId
+    LEFT JOIN TreatmentType tt
+    ON t.treatmentTypeId = tt.id
+    WHERE l.id IS NULL AND t.date >= ? AND (t.date, t.plantId, t.treatmentTypeId, t.id) > (?, ?, ?, ?)
+    ORDER BY t.date, t.plantId, t.treatmentTypeId, t.id
+    LIMIT ?
+    '''
+    after = after or (0, 0, 0, 0)
+    return conn.execute(QUERY, (AsOfDate(as_of_date).season_start, *after, limit))
+
+def all_limit_info_for_treatment(conn, treatment_id):
+    QUERY='''
+    SELECT t.description as treatment,
+       p.name as species,
+       l.maxApplications as maxApplications,
+       l.daysBetweenApplications as daysBetweenApplications,
+       l.applyBefore as applyBefore,
+       l.minDaysBeforeConsumption as minDaysBeforeConsumption
+    FROM TreatmentType t
+    LEFT JOIN SafetyLimit l
+    ON t.id = l.treatmentTypeId
+    LEFT JOIN PlantSpecies p
+    ON l.speciesId = p.id
+    WHERE t.id = ?
+    '''
+    return conn.execute(QUERY, (treatment_id,))
+
+def list_of_treatments(conn):
+    QUERY='''
+    SELECT id, description
+    FROM TreatmentType
+    '''
+    return conn.execute(QUERY)
+
+def search_treatments(conn, prefix, limit=20):
+    QUERY='''
+    SELECT id, description
+    FROM TreatmentType
+    WHERE description >= ? COLLATE NOCASE AND description < ? COLLATE NOCASE
+    ORDER BY description COLLATE NOCASE
+    LIMIT ?
+    '''
+    return conn.execute(QUERY, prefix_range(prefix) + (limit,))
+
+def prefix_range(prefix):
+    # every string starting with prefix sorts below prefix + the largest code point
+    return prefix, prefix + '\U0010ffff'
+
+def treatment_description(conn, treatment_id):
+    QUERY='''
+    SELECT description
+    FROM TreatmentType
+    WHERE id = ?
+    '''
+    return conn.execute(QUERY, (treatment_id,))
+
+def all_treatments_for_plant(conn, as_of_date, plant_id, after=None, limit=-1):
+    QUERY='''SELECT t.id as id, t.date as sortDate, p.id as plantId, p.description as plantDescription, t.treatmentTypeId as treatmentTypeId, tt.description as treatmentDescription, date(t.date) as treatmentDate
+    FROM AppliedTreatment t
+    LEFT JOIN Plant p
+    ON t.plantId = p.id
+    LEFT JOIN TreatmentType tt
+    ON t.treatmentTypeId = tt.id
+    WHERE t.plantId = ? and p.id = t.plantId and t.season = ? and t.date <= ? and (t.date, t.treatmentTypeId, t.id) > (?, ?, ?)
+    ORDER BY t.date, t.treatmentTypeId, t.id
+    LIMIT ?
+    '''
+    as_of = AsOfDate(as_of_date)
+    after = after or (0, 0, 0)
+    return conn.execute(QUERY, (plant_id, as_of.season, as_of.day, *after, limit))
+    
+def list_of_plants(conn):
+    QUERY='''
+    SELECT id, description
+    FROM Plant
+    '''
+    return conn.execute(QUERY)
+
+def search_plants(conn, prefix, limit=20):
+    # Typeahead: plants whose description starts with prefix, ignoring ASCII
+    # case, read in order from the NOCASE index on description.
+    QUERY='''
+    SELECT id, description
+    FROM Plant
+    WHERE description >= ? COLLATE NOCASE AND description < ? COLLATE NOCASE
+    ORDER BY description COLLATE NOCASE
+    LIMIT ?
+    '''
+    return conn.execute(QUERY, prefix_range(prefix) + (limit,))
+
+def plant_description(conn, plant_id):
+    QUERY='''
+    SELECT description
+    FROM Plant
+    WHERE id = ?
+    '''
+    return conn.execute(QUERY, (plant_id,))
+
+# Dates are stored as integer day numbers: the Julian day number, which
+# SQLite's date() and strftime() read as noon of that day.
+JULIAN_DAY_OF_ORDINAL_ZERO = 1721425
+
+def julian_day(day):
+    return day.toordinal() + JULIAN_DAY_OF_ORDINAL_ZERO
+
+class AsOfDate(str):
+    # An ISO date validated once, carrying the day numbers the report queries
+    # compare with: the day itself, its season (calendar year) and the first
+    # day of that season. Being a str it stands in for the date string in
+    # cache keys, snapshots and templates.
+
+    def __new__(cls, value):
+        if isinstance(value, AsOfDate):
+            return value
+        parsed = value if isinstance(value, date) else date.fromisoformat(value)
+        self = super().__new__(cls, parsed.isoformat())
+        self.day = julian_day(parsed)
+        self.season = parsed.year
+        self.season_start = julian_day(date(parsed.year, 1, 1))
+        return self
+
+def plant_calendar(conn, plant_ids, first_day, last_day):
+    # Answers all_treatments_for_plant, treatment_date_limits_in_effect and
+    # safe_to_consume_dates for every plant and every day from first_day to
+    # last_day out of one ordered pass over the plants' applied treatments.
+    # Treatments older than the longest safety window cannot affect the range.
+    PLANTS='''
+    SELECT id as plantId, description as plant
+    FROM Plant
+    WHERE ? IS NULL OR id IN (SELECT value FROM json_each(?))
+    ORDER BY id
+    '''
+    TREATMENTS='''
+    SELECT t.plantId as plantId, t.id as id, t.treatmentTypeId as treatmentTypeId, tt.description as treatment, t.date as date, date(t.date) as treatmentDate,
+           e.repeatAllowedFrom as repeatAllowedFrom, date(e.repeatAllowedFrom) as safeToRepeatDate,
+           e.safeToConsumeFrom as safeToConsumeFrom, date(e.safeToConsumeFrom) as safeToConsumeDate
+    FROM AppliedTreatment t
+    LEFT JOIN TreatmentExpiry e
+    ON e.appliedTreatmentId = t.id
+    LEFT JOIN TreatmentType tt
+    ON t.treatmentTypeId = tt.id
+    WHERE (? IS NULL OR t.plantId IN (SELECT value FROM json_each(?))) AND t.date >= ? AND t.date <= ?
+    ORDER BY t.plantId, t.date, t.id
+    '''
+    ids = json.dumps(sorted(plant_ids)) if plant_ids is not None else None
+    window = conn.execute('SELECT coalesce(max(max(daysBetweenApplications, minDaysBeforeConsumption)), 0) FROM SafetyLimit').fetchone()[0]
+    season_start = date(first_day.year, 1, 1)
+    earliest = min(season_start, first_day - timedelta(days = window))
+    days = [first_day + timedelta(days = offset) for offset in range((last_day - first_day).days + 1)]
+
+    calendar = {row['plantId']: {'plantId': row['plantId'], 'plant': row['plant'], 'treatments': [], 'days': []}
+                for row in conn.execute(PLANTS, (ids, ids))}
+    history = {plant_id: [] for plant_id in calendar}
+    for row in conn.execute(TREATMENTS, (ids, ids, julian_day(earliest), julian_day(last_day))):
+        if row['plantId'] in history:
+            history[row['plantId']].append(row)
+
+    for plant_id, entry in calendar.items():
+        treatments = history[plant_id]
+        entry['treatments'] = [{'treatmentTypeId': t['treatmentTypeId'], 'treatment': t['treatment'], 'treatmentDate': t['treatmentDate']}
+                               for t in treatments if t['date'] >= julian_day(season_start)]
+        for day in days:
+            today = julian_day(day)
+            limits = []
+            safe = None
+            for t in treatments:
+                if t['date'] > today:
+                    break
+                if t['repeatAllowedFrom'] is None:
+                    continue
+                if t['repeatAllowedFrom'] >= today:
+                    limits.append({'treatment': t['treatment'], 'treatmentDate': t['treatmentDate'], 'safeToRepeatDate': t['safeToRepeatDate']})
+                if t['safeToConsumeFrom'] >= today and (safe is None or t['safeToConsumeFrom'] > safe['safeToConsumeFrom']):
+                    safe = t
+            entry['days'].append({
+                'date': day.isoformat(),
+                'dateLimits': limits,
+                'safeToConsume': None if safe is None else {'treatment': safe['treatment'], 'treatmentDate': safe['treatmentDate'], 'safeToConsumeDate': safe['safeToConsumeDate']},
+            })
+    return list(calendar.values())
+
+
+# Result modes: the query functions only call conn.execute(), so they can be
+# handed one of these instead of a connection to get plain tuples (cheapest
+# for bulk work) or sqlite3.Row objects whatever the connection's row_factory.
+
+class _ResultMode:
+    def __init__(self, conn, row_factory):
+        self.conn = conn
+        self.row_factory = row_factory
+
+    def execute(self, sql, parameters=()):
+        cursor = self.conn.cursor()
+        cursor.row_factory = self.row_factory
+        return cursor.execute(sql, parameters)
+
+def as_tuples(conn):
+    return _ResultMode(conn, None)
+
+def as_rows(conn):
+    return _ResultMode(conn, sqlite3.Row)
+
+
+class Lookups:
+    # id <-> description maps of plants and treatment types, reloaded only
+    # when the DataVersion counters of those tables move.
+
+    VERSIONS = '''
+    SELECT version
+    FROM DataVersion
+    WHERE tableName IN ('Plant', 'TreatmentType')
+    ORDER BY tableName
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = None
+
+    def refresh(self, conn):
+        versions = as_tuples(conn).execute(self.VERSIONS).fetchall()
+        with self.lock:
+            if versions != self.versions:
+                plants = list_of_plants(as_tuples(conn)).fetchall()
+                treatments = list_of_treatments(as_tuples(conn)).fetchall()
+                self.plants = [{'id': plant_id, 'description': description} for plant_id, description in plants]
+                self.treatments = [{'id': treatment_id, 'description': description} for treatment_id, description in treatments]
+                self.plant_ids = {description: plant_id for plant_id, description in plants}
+                self.treatment_ids = {description: treatment_id for treatment_id, description in treatments}
+                self.versions = versions
+        return self
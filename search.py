@@ -0,0 +1,115 @@
+import argparse
+import json
+import re
+import sqlite3
+import sys
+
+from migrations import migrate
+
+
+# Ranked search over plant, treatment type and species names, backed by the
+# CatalogSearch and CatalogTrigrams FTS5 tables (migration 10). The words of
+# a query are matched as prefixes of the words of a name, so "jona alma"
+# finds "Jonagored almafa", ranked by bm25. When that leaves room in the
+# results, names sharing at least FUZZY_THRESHOLD of the query's trigrams
+# are added, so fragments ("gored") and misspellings ("jonagord") still find
+# their entry.
+
+KINDS = {'plant': 1, 'treatment': 2, 'species': 3}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+FUZZY_THRESHOLD = 0.5
+# fuzzy candidates read per result asked for, before the threshold
+FUZZY_CANDIDATES = 5
+WORD = re.compile(r'\w+')
+
+MATCH_QUERY = '''
+SELECT s.rowid as entryKey, coalesce(p.description, tt.description, ps.name) as name
+FROM {table} s
+LEFT JOIN Plant p
+ON s.rowid % 4 = 1 AND p.id = s.rowid / 4
+LEFT JOIN TreatmentType tt
+ON s.rowid % 4 = 2 AND tt.id = s.rowid / 4
+LEFT JOIN PlantSpecies ps
+ON s.rowid % 4 = 3 AND ps.id = s.rowid / 4
+WHERE {table} MATCH ? AND (? IS NULL OR s.rowid % 4 IN (SELECT value FROM json_each(?)))
+ORDER BY s.rank
+LIMIT ?
+'''
+PREFIX_QUERY = MATCH_QUERY.format(table='CatalogSearch')
+TRIGRAM_QUERY = MATCH_QUERY.format(table='CatalogTrigrams')
+
+
+def words(text):
+    return WORD.findall(text.lower())
+
+def trigrams(text):
+    return {word[start:start + 3] for word in words(text) for start in range(len(word) - 2)}
+
+def quote(token):
+    # a string literal in an FTS5 query, so the user's text is never parsed
+    # as query syntax
+    return '"%s"' % token.replace('"', '""')
+
+def prefix_match(text):
+    return ' '.join(quote(word) + '*' for word in words(text))
+
+def trigram_match(query_trigrams):
+    return ' OR '.join(quote(trigram) for trigram in sorted(query_trigrams))
+
+
+def search_catalog(conn, text, kinds=None, limit=20):
+    # [{kind, id, name, match}], best first: 'prefix' matches, then 'fuzzy'
+    # ones by the share of the query's trigrams they contain
+    codes = json.dumps(sorted(KINDS[kind] for kind in kinds)) if kinds else None
+    found = {}
+    words_query = prefix_match(text)
+    if words_query:
+        for entry_key, name in conn.execute(PREFIX_QUERY, (words_query, codes, codes, limit)):
+            found[entry_key] = (name, 'prefix')
+    query_trigrams = trigrams(text)
+    if len(found) < limit and query_trigrams:
+        candidates = []
+        missing = limit - len(found)
+        rows = conn.execute(TRIGRAM_QUERY, (trigram_match(query_trigrams), codes, codes, limit * FUZZY_CANDIDATES))
+        for position, (entry_key, name) in enumerate(rows):
+            if entry_key in found:
+                continue
+            similarity = len(query_trigrams & trigrams(name)) / len(query_trigrams)
+            if similarity >= FUZZY_THRESHOLD:
+                candidates.append((-similarity, position, entry_key, name))
+        for _, _, entry_key, name in sorted(candidates)[:missing]:
+            found[entry_key] = (name, 'fuzzy')
+    return [{'kind': KIND_NAMES[entry_key % 4], 'id': entry_key // 4, 'name': name, 'match': match}
+            for entry_key, (name, match) in found.items()]
+
+def rebuild(conn):
+    # refills both indexes from the catalog tables
+    with conn:
+        for table in ('CatalogSearch', 'CatalogTrigrams'):
+            conn.execute("INSERT INTO %s(%s) VALUES('delete-all')" % (table, table))
+            conn.execute('INSERT INTO %s(rowid, name) SELECT entryKey, name FROM CatalogEntry' % table)
+    return conn.execute('SELECT COUNT(*) FROM CatalogEntry').fetchone()[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search plants, treatment types and species, or rebuild the search index.')
+    parser.add_argument('query', help='text to search for, or "rebuild"')
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--kind', action='append', choices=sorted(KINDS), help='restrict to a kind of entry (repeatable)')
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database)
+    try:
+        migrate(conn)
+        if args.query == 'rebuild':
+            print('search index :', rebuild(conn), 'entries')
+            return 0
+        for result in search_catalog(conn, args.query, args.kind, args.limit):
+            print('%-9s %6d  %-6s  %s' % (result['kind'], result['id'], result['match'], result['name']))
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
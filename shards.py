@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+from db import pool_from_config
+from migrations import migrate
+from snapshots import SNAPSHOT_QUERIES
+
+
+# Every tenant (garden or farm) lives in its own SQLite file,
+# <SHARD_DIRECTORY>/<tenant>.db, so tenants never share a writer lock. Requests
+# pick their tenant with a /t/<tenant>/ path prefix; requests without one use
+# DATABASE as before.
+
+TENANT_NAME = re.compile(r'[A-Za-z0-9_-]{1,64}$')
+TENANT_PREFIX = '/t/'
+
+
+class UnknownTenant(LookupError):
+    pass
+
+
+def shard_path(directory, tenant):
+    if not TENANT_NAME.match(tenant):
+        raise UnknownTenant(tenant)
+    return os.path.join(directory, tenant + '.db')
+
+def list_tenants(directory):
+    names = (name[:-3] for name in os.listdir(directory) if name.endswith('.db'))
+    return sorted(name for name in names if TENANT_NAME.match(name))
+
+def split_tenant(environ):
+    # Moves a /t/<tenant> path prefix into SCRIPT_NAME, so routing is
+    # unchanged and url_for() keeps generating links inside the tenant.
+    path = environ.get('PATH_INFO', '')
+    if 'gardenlog.tenant' not in environ and path.startswith(TENANT_PREFIX):
+        tenant, _, rest = path[len(TENANT_PREFIX):].partition('/')
+        environ['gardenlog.tenant'] = tenant
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + TENANT_PREFIX + tenant
+        environ['PATH_INFO'] = '/' + rest
+    return environ
+
+
+class TenantMiddleware:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        return self.wsgi_app(split_tenant(environ), start_response)
+
+
+class Tenant:
+    # A tenant's connection pool and everything built on it (lookups,
+    # compliance engine, read pool, refresher and writer threads, ...), kept
+    # and closed together.
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.extensions = {}
+        self.lock = threading.RLock()
+
+    def extension(self, name, factory):
+        # threads do not survive fork(): anything carrying the pid of another
+        # process is built again
+        with self.lock:
+            instance = self.extensions.get(name)
+            if instance is None or getattr(instance, 'pid', os.getpid()) != os.getpid():
+                instance = self.extensions[name] = factory()
+            return instance
+
+    def busy(self):
+        # a connection is checked out or a writer still has records queued;
+        # called under the router's lock, so it does not take the tenant's
+        parts = [self.pool] + list(self.extensions.values())
+        return any(part.busy() for part in parts if hasattr(part, 'busy'))
+
+    def close(self):
+        # threads are stopped before the pools they use are closed
+        with self.lock:
+            parts = list(self.extensions.values())[::-1]
+            self.extensions = {}
+        for part in parts:
+            if hasattr(part, 'stop'):
+                part.stop()
+        for part in parts:
+            if isinstance(part, threading.Thread) and part.is_alive() and part is not threading.current_thread():
+                part.join()
+        for part in parts + [self.pool]:
+            if hasattr(part, 'close'):
+                part.close()
+
+
+class ShardRouter:
+    # A Tenant per tenant, created on the tenant's first request; the shard
+    # file is only opened when a connection is acquired. At most max_open
+    # tenants are kept: beyond that the least recently used ones that are not
+    # busy are closed, threads and pools included.
+
+    def __init__(self, config, max_open=64):
+        self.config = config
+        self.directory = config['SHARD_DIRECTORY']
+        self.max_open = max_open
+        self.tenants = OrderedDict()
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.closed = 0
+
+    def tenant(self, name):
+        with self.lock:
+            tenant = self.tenants.get(name)
+            if tenant is not None:
+                self.tenants.move_to_end(name)
+                return tenant
+        path = shard_path(self.directory, name)
+        if not os.path.exists(path):
+            # never create a shard file for a mistyped tenant
+            raise UnknownTenant(name)
+        pool = pool_from_config(dict(self.config, DATABASE=path))
+        if self.config.get('AUTO_MIGRATE', True):
+            conn = pool.acquire()
+            try:
+                migrate(conn)
+            finally:
+                pool.release(conn)
+        with self.lock:
+            if name in self.tenants:
+                pool.close()
+                return self.tenants[name]
+            tenant = self.tenants[name] = Tenant(name, pool)
+            self.opened += 1
+            evicted = self.evict()
+        # stopping threads can take a moment, so not under the lock
+        for old in evicted:
+            old.close()
+        return tenant
+
+    def pool(self, name):
+        return self.tenant(name).pool
+
+    def evict(self):
+        evicted = []
+        for name in list(self.tenants)[:-1]:
+            if len(self.tenants) <= self.max_open:
+                break
+            if not self.tenants[name].busy():
+                evicted.append(self.tenants.pop(name))
+                self.closed += 1
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            return {'directory': self.directory, 'open_pools': len(self.tenants), 'max_open': self.max_open,
+                    'opened': self.opened, 'closed': self.closed, 'tenants': list(self.tenants)}
+
+
+def create_shard(directory, tenant):
+    path = shard_path(directory, tenant)
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+    return path
+
+
+def tenant_reports(path, as_of_date, reports):
+    # Runs in a worker process: the report rows of one shard, opened read-only.
+    conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return {report: [dict(row) for row in SNAPSHOT_QUERIES[report](conn, as_of_date)] for report in reports}
+    finally:
+        conn.close()
+
+def rebuild_cross_tenant_reports(directory, output, as_of_date, reports=tuple(SNAPSHOT_QUERIES), processes=None):
+    # Fans the report queries out over every shard and replaces the rows of
+    # as_of_date in the CrossTenantReport table of the output database.
+    from concurrent.futures import ProcessPoolExecutor
+    tenants = list_tenants(directory)
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {tenant: executor.submit(tenant_reports, shard_path(directory, tenant), as_of_date, reports)
+                   for tenant in tenants}
+        results = {tenant: future.result() for tenant, future in futures.items()}
+
+    conn = sqlite3.connect(output)
+    try:
+        with conn:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS CrossTenantReport (
+               asOfDate TEXT NOT NULL,
+               report TEXT NOT NULL,
+               tenant TEXT NOT NULL,
+               position INTEGER NOT NULL,
+               data TEXT NOT NULL,
+               PRIMARY KEY(asOfDate, report, tenant, position)
+               ) WITHOUT ROWID
+            ''')
+            conn.execute('DELETE FROM CrossTenantReport WHERE asOfDate = ? AND report IN (%s)' % ','.join('?' * len(reports)),
+                         (as_of_date,) + tuple(reports))
+            conn.executemany('INSERT INTO CrossTenantReport(asOfDate, report, tenant, position, data) VALUES(?,?,?,?,?)',
+                             ((as_of_date, report, tenant, position, json.dumps(row))
+                              for tenant, result in results.items()
+                              for report, rows in result.items()
+                              for position, row in enumerate(rows)))
+    finally:
+        conn.close()
+    return {tenant: {report: len(rows) for report, rows in result.items()} for tenant, result in results.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage tenant shards and rebuild cross-tenant reports.')
+    parser.add_argument('command', choices=('list', 'create', 'report'))
+    parser.add_argument('tenant', nargs='?', help='tenant to create')
+    parser.add_argument('--directory', default='tenants')
+    parser.add_argument('--date', default=date.today().isoformat(), help='as-of date of the reports')
+    parser.add_argument('--report', action='append', choices=sorted(SNAPSHOT_QUERIES), help='report to rebuild (default all)')
+    parser.add_argument('--output', default='cross-tenant.db')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        for tenant in list_tenants(args.directory):
+            print(tenant, shard_path(args.directory, tenant))
+    elif args.command == 'create':
+        if not args.tenant:
+            parser.error('create needs a tenant')
+        try:
+            print('created', create_shard(args.directory, args.tenant))
+        except UnknownTenant:
+            parser.error('tenant names are 1-64 letters, digits, _ or -')
+        except FileExistsError as error:
+            print('already exists:', error)
+            return 1
+    else:
+        started = time.perf_counter()
+        counts = rebuild_cross_tenant_reports(args.directory, args.output, args.date, tuple(args.report or SNAPSHOT_QUERIES),
+                                              args.processes)
+        for tenant, reports in counts.items():
+            print(tenant, ' '.join('%s=%d' % item for item in reports.items()))
+        print(len(counts), 'tenants in %.2fs' % (time.perf_counter() - started), '->', args.output)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
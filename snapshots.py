@@ -0,0 +1,187 @@
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import queries
+from cache import REPORT_TABLES, data_versions
+from migrations import migrate
+
+
+logger = logging.getLogger('gardenlog.snapshots')
+
+# Reports kept in the daily snapshot, with the query that computes them live.
+SNAPSHOT_QUERIES = {
+    'date_limits': queries.treatment_date_limits_in_effect,
+    'safe': queries.safe_to_consume_dates,
+    'not_applicable': queries.treatments_no_longer_applicable,
+    'no_info': queries.treatments_applied_without_limit_info,
+}
+
+# every snapshot report reads the same tables
+SNAPSHOT_TABLES = REPORT_TABLES['date_limits']
+
+KEY_COLUMNS = 4
+
+
+def snapshot_versions(conn):
+    versions = data_versions(queries.as_tuples(conn))
+    return ','.join('%s=%d' % (table, versions[table]) for table in SNAPSHOT_TABLES)
+
+def padded_key(values):
+    values = list(values)
+    return values + [0] * (KEY_COLUMNS - len(values))
+
+
+def build_snapshot(conn, as_of_date, prune_before=None):
+    # All four reports are computed in one read transaction and written in
+    # the same transaction, so the recorded versions match the rows. If
+    # another connection writes in the meantime the snapshot would already
+    # be stale: it is dropped and None returned.
+    conn.execute('BEGIN')
+    try:
+        versions = snapshot_versions(conn)
+        entries = []
+        for report, query in SNAPSHOT_QUERIES.items():
+            for row in query(queries.as_rows(conn), as_of_date):
+                row = dict(row)
+                entries.append([as_of_date, report] + padded_key(row[key] for key in queries.REPORT_KEYS[report]) + [json.dumps(row)])
+        conn.execute('DELETE FROM ComplianceSnapshot WHERE asOfDate = ?', (as_of_date,))
+        conn.executemany('INSERT INTO ComplianceSnapshot(asOfDate, report, k1, k2, k3, k4, data) VALUES(?,?,?,?,?,?,?)', entries)
+        conn.execute('INSERT OR REPLACE INTO ComplianceSnapshotInfo(asOfDate, versions, builtAt, rows) VALUES(?,?,?,?)',
+                     (as_of_date, versions, datetime.now().isoformat(timespec='seconds'), len(entries)))
+        if prune_before is not None:
+            conn.execute('DELETE FROM ComplianceSnapshot WHERE asOfDate < ?', (prune_before,))
+            conn.execute('DELETE FROM ComplianceSnapshotInfo WHERE asOfDate < ?', (prune_before,))
+        conn.execute('COMMIT')
+    except sqlite3.OperationalError as error:
+        conn.execute('ROLLBACK')
+        if 'locked' in str(error) or 'busy' in str(error):
+            return None
+        raise
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return len(entries)
+
+def snapshot_current(conn, as_of_date):
+    row = queries.as_tuples(conn).execute('SELECT versions FROM ComplianceSnapshotInfo WHERE asOfDate = ?', (as_of_date,)).fetchone()
+    return row is not None and row[0] == snapshot_versions(conn)
+
+def snapshot_rows(conn, report, as_of_date, after=None, limit=-1):
+    # The report page from the snapshot of as_of_date, or None when there is
+    # no snapshot for that date or it was built before the latest write.
+    if not snapshot_current(conn, as_of_date):
+        return None
+    QUERY = '''
+    SELECT data
+    FROM ComplianceSnapshot
+    WHERE asOfDate = ? AND report = ? AND (k1, k2, k3, k4) > (?, ?, ?, ?)
+    ORDER BY k1, k2, k3, k4
+    LIMIT ?
+    '''
+    after = padded_key(after) if after else [-1, -1, -1, -1]
+    cursor = queries.as_tuples(conn).execute(QUERY, [as_of_date, report] + after + [limit])
+    return [json.loads(data) for data, in cursor]
+
+
+class SnapshotRefresher(threading.Thread):
+    # Keeps today's snapshot current: checks the data versions every
+    # `interval` seconds and right after midnight, and rebuilds when the
+    # snapshot is missing or stale. wake() asks for an immediate check, for
+    # callers that just wrote to the database.
+
+    def __init__(self, pool, interval=30.0):
+        super().__init__(name='gardenlog-snapshots', daemon=True)
+        self.pool = pool
+        self.interval = interval
+        self.pid = os.getpid()
+        self.woken = threading.Event()
+        self.stopped = False
+        self.builds = 0
+        self.conflicts = 0
+        self.errors = 0
+        self.last_build = None
+
+    def wake(self):
+        self.woken.set()
+
+    def stop(self):
+        self.stopped = True
+        self.woken.set()
+
+    def seconds_to_wait(self):
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return min(self.interval, (midnight - now).total_seconds() + 1.0)
+
+    def run(self):
+        while not self.stopped:
+            self.refresh()
+            self.woken.wait(self.seconds_to_wait())
+            self.woken.clear()
+
+    def refresh(self):
+        today = date.today().isoformat()
+        try:
+            conn = self.pool.acquire()
+            try:
+                if snapshot_current(conn, today):
+                    return
+                started = time.perf_counter()
+                rows = build_snapshot(conn, today, prune_before=today)
+            finally:
+                self.pool.release(conn)
+        except Exception:
+            self.errors += 1
+            logger.exception('building the snapshot for %s failed', today)
+            return
+        if rows is None:
+            self.conflicts += 1
+            return
+        self.builds += 1
+        self.last_build = {'asOfDate': today, 'rows': rows, 'seconds': time.perf_counter() - started}
+
+    def stats(self):
+        return {'alive': self.is_alive(), 'interval': self.interval, 'builds': self.builds, 'conflicts': self.conflicts,
+                'errors': self.errors, 'last_build': self.last_build}
+
+
+def snapshot_status(conn):
+    current = snapshot_versions(conn)
+    return [{'asOfDate': as_of_date, 'rows': rows, 'builtAt': built_at, 'current': versions == current}
+            for as_of_date, versions, built_at, rows in queries.as_tuples(conn).execute(
+                'SELECT asOfDate, versions, builtAt, rows FROM ComplianceSnapshotInfo ORDER BY asOfDate')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or inspect the precomputed compliance report snapshots.')
+    parser.add_argument('command', choices=('build', 'status'))
+    parser.add_argument('--database', default='test.db')
+    parser.add_argument('--date', default=date.today().isoformat(), help='as-of date of the snapshot to build')
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    try:
+        migrate(conn)
+        if args.command == 'build':
+            rows = build_snapshot(conn, args.date)
+            if rows is None:
+                print('database changed while building, try again')
+                return 1
+            print('snapshot', args.date, ':', rows, 'rows')
+        else:
+            for snapshot in snapshot_status(conn):
+                print(snapshot['asOfDate'], snapshot['rows'], 'rows, built', snapshot['builtAt'],
+                      'current' if snapshot['current'] else 'stale')
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())